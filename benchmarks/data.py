@@ -0,0 +1,109 @@
+"""
+    Synthetic data generator for the benchmarks.
+
+    Builds the tests app's Ad, RawAdData and MonthlyAdReport shapes at scale.
+    Rows are generated from a seeded random number generator so that runs
+    are reproducible, and loaded with COPY on PostgreSQL or executemany
+    elsewhere with explicit created timestamps (bulk_create would overwrite
+    them through auto_now_add).
+"""
+from datetime import timedelta
+from itertools import islice
+import random
+
+from django.db import connection, transaction
+
+from timeseries.utils import utcnow
+from timeseries.writers import CopyReader, copy_text
+
+CHUNK_SIZE = 10000
+
+
+def populate(owners, depth, step=timedelta(hours=1), seed=0):
+    """
+        Creates owners ads, each with depth hourly (by default) RawAdData
+        rows ending now and one MonthlyAdReport row per 30 raw rows.
+        Returns the number of related rows created.
+    """
+    from tests.models import Ad, MonthlyAdReport, RawAdData
+
+    Ad.objects.bulk_create([Ad() for _ in range(owners)], batch_size=500)
+    ad_ids = list(Ad.objects.order_by('id').values_list('id', flat=True))
+    rng = random.Random(seed)
+    end = utcnow()
+
+    def rawdata():
+        for ad_id in ad_ids:
+            views = rng.randint(0, 1000)
+            for point in range(depth):
+                views += rng.randint(0, 10)
+                yield (
+                    ad_id, end - step * (depth - point), views,
+                    rng.randint(0, views)
+                )
+
+    def reports():
+        for ad_id in ad_ids:
+            for point in range(0, depth, 30):
+                yield (
+                    ad_id, end - step * (depth - point),
+                    rng.uniform(0, 1000), rng.uniform(0, 100)
+                )
+
+    count = load(RawAdData, ('ad', 'created', 'views', 'clicks'), rawdata())
+    count += load(
+        MonthlyAdReport, ('ad', 'created', 'avg_views', 'avg_clicks'),
+        reports()
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'ANALYZE' if connection.vendor != 'mysql' else 'SELECT 1'
+        )
+    return count
+
+
+def load(model, field_names, rows):
+    """
+        Loads tuples of values of the given fields into the model's table
+        without instantiating models, in a single transaction of
+        CHUNK_SIZE rows per statement.
+    """
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in field_names]
+    table = qn(opts.db_table)
+    columns = ', '.join(qn(field.column) for field in fields)
+    rows = iter(rows)
+    count = 0
+    # SQLite would otherwise commit every row of executemany
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            counted = []
+
+            def lines():
+                for row in rows:
+                    counted.append(None)
+                    yield '\t'.join(
+                        copy_text(field.get_db_prep_save(value, connection))
+                        for field, value in zip(fields, row)
+                    ) + '\n'
+
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN'.format(table, columns),
+                CopyReader(lines())
+            )
+            return len(counted)
+
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, columns, ', '.join(['%s'] * len(fields))
+        )
+        while True:
+            chunk = [
+                [field.get_db_prep_save(value, connection)
+                 for field, value in zip(fields, row)]
+                for row in islice(rows, CHUNK_SIZE)
+            ]
+            if not chunk:
+                return count
+            cursor.executemany(sql, chunk)
+            count += len(chunk)
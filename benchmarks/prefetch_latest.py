@@ -0,0 +1,63 @@
+"""
+    Compares the prefetch_latest strategies on deep histories.
+
+    Runs against a throwaway test database created from tests.settings, so
+    the backend is picked with the TEST_DB_CONFIG environment variable.
+
+    Usage:
+        TEST_DB_CONFIG=postgres python -m benchmarks.prefetch_latest \\
+            --owners 200 --depth 5000
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+
+def measure(strategy, repeat):
+    from tests.models import Ad
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        list(Ad.objects.prefetch_latest('rawdata', strategy=strategy))
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--owners', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from timeseries.utils import LATEST_STRATEGIES
+    from benchmarks.data import populate
+
+    strategies = ['window']
+    if connection.vendor == 'postgresql':
+        strategies = ['distinct', 'lateral', 'window']
+
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True
+    )
+    try:
+        populate(args.owners, args.depth)
+        print('{} owners x {} rows on {}'.format(
+            args.owners, args.depth, connection.vendor
+        ))
+        for name in strategies:
+            best = measure(LATEST_STRATEGIES[name], args.repeat)
+            print('{:<10} {:>10.2f} ms'.format(name, best * 1000))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+    Times the TimeSeriesQuerySet methods on synthetic data at scale.
+
+    Runs against a throwaway test database created from tests.settings, so
+    the backend is picked with the TEST_DB_CONFIG environment variable. Each
+    scenario reports its best and median wall time, then its query count and
+    peak Python memory allocation from an extra untimed run. Results can be
+    written as JSON and compared against a previously saved run, exiting
+    with status 1 when a scenario got slower than the tolerance allows or
+    runs more queries.
+
+    Usage:
+        TEST_DB_CONFIG=postgres python -m benchmarks.suite \\
+            --owners 100000 --depth 1000 --output baseline.json
+        TEST_DB_CONFIG=postgres python -m benchmarks.suite \\
+            --owners 100000 --depth 1000 --baseline baseline.json
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def get_scenarios(connection, update_owners):
+    """
+        Returns an ordered dictionary of scenario names to callables running
+        the scenario once.
+    """
+    from tests.models import Ad, ad_data_collector
+    from timeseries.utils import LATEST_STRATEGIES, LatestQ
+
+    scenarios = OrderedDict([
+        ('filter_outdated', lambda: list(
+            Ad.objects.filter_outdated('rawdata').values_list('pk', flat=True)
+        )),
+        ('filter_outdated_all', lambda: list(
+            Ad.objects.filter_outdated(
+                'rawdata', 'monthlyreports', mode='all'
+            ).values_list('pk', flat=True)
+        )),
+        ('last_updated', lambda: list(
+            Ad.objects.last_updated('rawdata').values_list(
+                'pk', 'rawdata_last_updated'
+            )
+        )),
+        ('annotate_latest', lambda: list(
+            Ad.objects.annotate_latest('rawdata', 'views').order_by(
+                '-rawdata_latest_views'
+            ).values_list('pk', flat=True)[:100]
+        )),
+        ('latestq', lambda: list(
+            Ad.objects.last_updated('rawdata').filter(
+                LatestQ('rawdata', views__gt=1000)
+            ).values_list('pk', flat=True)
+        )),
+    ])
+    strategies = ['window']
+    if connection.vendor == 'postgresql':
+        strategies = ['distinct', 'lateral', 'window']
+    for name in strategies:
+        scenarios['prefetch_latest_{}'.format(name)] = (
+            lambda strategy=LATEST_STRATEGIES[name]: list(
+                Ad.objects.prefetch_latest('rawdata', strategy=strategy)
+            )
+        )
+    # every repetition appends a row per owner, keeping the depth stable
+    scenarios['update_timeseries'] = lambda: Ad.objects.filter(
+        pk__in=Ad.objects.order_by('pk').values('pk')[:update_owners]
+    ).update_timeseries('rawdata', ad_data_collector, force=True)
+    return scenarios
+
+
+def run_scenario(scenario, connection, repeat):
+    """
+        Runs the scenario repeat times and returns its best and median wall
+        time in seconds, then once more, untimed, to count its queries and
+        measure its peak memory allocation in bytes (None when tracemalloc
+        is unavailable), so that neither skews the timings.
+    """
+    from timeseries.instrumentation import QueryCounter
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        scenario()
+        timings.append(time.time() - start)
+    timings.sort()
+
+    peak = None
+    counter = QueryCounter(connection)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        with counter:
+            scenario()
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    return OrderedDict([
+        ('seconds', timings[0]),
+        ('median', timings[len(timings) // 2]),
+        ('queries', counter.queries),
+        ('peak_memory', peak),
+    ])
+
+
+def compare(results, baseline, tolerance):
+    """
+        Returns a list of messages describing the scenarios of results that
+        are more than tolerance (a fraction) slower than in baseline, or run
+        more queries.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        limit = previous['seconds'] * (1 + tolerance)
+        if result['seconds'] > limit:
+            regressions.append('{}: {:.2f} ms, baseline {:.2f} ms'.format(
+                name, result['seconds'] * 1000, previous['seconds'] * 1000
+            ))
+        if result['queries'] > previous['queries']:
+            regressions.append('{}: {} queries, baseline {}'.format(
+                name, result['queries'], previous['queries']
+            ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--owners', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--update-owners', type=int, default=1000, dest='update_owners',
+        help='Number of owners updated by the update_timeseries scenario.'
+    )
+    parser.add_argument(
+        '--scenario', action='append', dest='scenarios',
+        help='Runs only the given scenario, may be repeated.'
+    )
+    parser.add_argument('--output', help='Writes the results as JSON.')
+    parser.add_argument(
+        '--baseline', help='Compares the results against a saved JSON run.'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Allowed slowdown against the baseline, as a fraction.'
+    )
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat must be a positive integer')
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from benchmarks.data import populate
+
+    scenarios = get_scenarios(connection, args.update_owners)
+    unknown = set(args.scenarios or ()) - set(scenarios)
+    if unknown:
+        parser.error(
+            'unknown scenarios: {}'.format(', '.join(sorted(unknown)))
+        )
+
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True
+    )
+    try:
+        start = time.time()
+        rows = populate(args.owners, args.depth, seed=args.seed)
+        print('{} owners, {} rows on {} in {:.1f} s'.format(
+            args.owners, rows, connection.vendor, time.time() - start
+        ))
+        results = OrderedDict()
+        for name, scenario in scenarios.items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            result = results[name] = run_scenario(
+                scenario, connection, args.repeat
+            )
+            print('{:<28} {:>10.2f} ms {:>6} queries {:>10}'.format(
+                name, result['seconds'] * 1000, result['queries'],
+                '' if result['peak_memory'] is None else
+                '{:.1f} MiB'.format(result['peak_memory'] / 1048576.0)
+            ))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(OrderedDict([
+                ('vendor', connection.vendor),
+                ('django', django.get_version()),
+                ('python', platform.python_version()),
+                ('owners', args.owners),
+                ('depth', args.depth),
+                ('seed', args.seed),
+                ('results', results),
+            ]), fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for message in regressions:
+            print('REGRESSION', message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ setup(
     author="Anthony Almarza",
     name="django-timeseries",
     version=timeseries.__version__,
-    packages=find_packages(exclude=["test*", ]),
+    packages=find_packages(exclude=["test*", "benchmarks*"]),
     url="https://github.com/anthonyalmarza/timeseries",
     description=(
         "`timeseries` is a set of django application tools designed to "
@@ -20,6 +20,10 @@ setup(
     ],
     keywords=['timeseries', 'django', 'data', 'latest'],
     install_requires=['django', 'psycopg2'],
-    extras_require={'dev': ['ipdb', 'mock', 'tox', 'coverage']},
+    extras_require={
+        'dev': ['ipdb', 'mock', 'tox', 'coverage'],
+        'arrays': ['numpy'],
+        'pandas': ['numpy', 'pandas'],
+    },
     include_package_data=True
 )
@@ -0,0 +1,49 @@
+"""
+    Async collectors used by the asyncio tests. N.B. Python 3.6+ only.
+"""
+import asyncio
+
+from .models import fake_data, fake_report
+
+
+async def async_ad_data_collector(ad):
+    """
+        should return a dictionary (or an iterable of dictionaries) of data
+        needed to successfully create a RawAdData instance for the given ad
+    """
+    await asyncio.sleep(0)
+    return fake_data(ad)
+
+
+async def async_report_data_collector(queryset):
+    """
+        should yield dictionaries of data needed to successfully create a
+        MonthlyAdReport instance
+    """
+    for ad in queryset:
+        await asyncio.sleep(0)
+        yield fake_report(ad)
+
+
+def probe_collector():
+    """
+        Returns a coroutine collector along with a dictionary that records the
+        maximum number of calls it had in flight.
+    """
+    state = {'in_flight': 0, 'max_in_flight': 0}
+
+    async def collector(ad):
+        state['in_flight'] += 1
+        state['max_in_flight'] = max(
+            state['max_in_flight'], state['in_flight']
+        )
+        await asyncio.sleep(0.01)
+        state['in_flight'] -= 1
+        return [fake_data(ad), fake_data(ad)]
+
+    return collector, state
+
+
+async def failing_collector(ad):
+    await asyncio.sleep(0)
+    raise RuntimeError('upstream unavailable')
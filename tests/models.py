@@ -1,6 +1,10 @@
 from datetime import timedelta
 from django.db import models
-from timeseries.utils import TimeSeriesModel, TimeSeriesQuerySet
+from django.db.models import Avg, Count, Sum
+from timeseries.utils import (
+    BlockField, TimeSeriesBlockModel, TimeSeriesModel, TimeSeriesQuerySet,
+    TimeSeriesManager
+)
 
 
 class AdQuerySet(TimeSeriesQuerySet):
@@ -48,6 +52,117 @@ class MonthlyAdReport(TimeSeriesModel):
     avg_clicks = models.FloatField()
 
 
+class WeeklyAdReport(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(days=7)
+
+    # computed in the database from the ad's raw data
+    TIMESERIES_ROLLUP_SOURCE = 'rawdata'
+    TIMESERIES_ROLLUP_AGGREGATES = {
+        'avg_views': Avg('views'),
+        'total_clicks': Sum('clicks'),
+        'samples': Count('id'),
+    }
+
+    ad = models.ForeignKey(Ad, related_name='weeklyreports')
+
+    avg_views = models.FloatField()
+    total_clicks = models.BigIntegerField()
+    samples = models.IntegerField()
+    notes = models.CharField(max_length=32, default='rollup')
+
+
+class Campaign(models.Model):
+
+    # opt-in denormalized latest created timestamp of the stats relation
+    stats_last_updated = models.DateTimeField(null=True, db_index=True)
+
+    objects = TimeSeriesManager()
+
+
+class CampaignStats(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(hours=1)
+
+    # rows are kept for 2 days after being rolled up into the daily stats
+    TIMESERIES_RETENTION = timedelta(days=2)
+    TIMESERIES_DOWNSAMPLE = 'dailystats'
+
+    campaign = models.ForeignKey(Campaign, related_name='stats')
+
+    impressions = models.BigIntegerField(default=0)
+    spend = models.FloatField(default=0)
+
+
+class DailyCampaignStats(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(days=1)
+
+    TIMESERIES_ROLLUP_SOURCE = 'stats'
+    TIMESERIES_ROLLUP_AGGREGATES = {
+        'impressions': Sum('impressions'),
+        'spend': Sum('spend'),
+    }
+
+    campaign = models.ForeignKey(Campaign, related_name='dailystats')
+
+    impressions = models.BigIntegerField()
+    spend = models.FloatField()
+
+
+class PartitionedAdData(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(hours=1)
+
+    # one partition per day on PostgreSQL, see timeseries.partitions
+    TIMESERIES_PARTITION = timedelta(days=1)
+    TIMESERIES_RETENTION = timedelta(days=3)
+
+    ad = models.ForeignKey(Ad, related_name='partitioneddata')
+
+    views = models.BigIntegerField(default=0)
+
+
+class PartitionedCampaignAdData(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(hours=1)
+
+    TIMESERIES_PARTITION = timedelta(days=1)
+    TIMESERIES_RETENTION = timedelta(days=3)
+
+    # each row belongs to the timeseries of its ad and of its campaign
+    ad = models.ForeignKey(Ad, related_name='partitionedcampaigndata')
+    campaign = models.ForeignKey(Campaign, related_name='partitionedaddata')
+
+    # partitioning appends created to the unique constraint
+    reference = models.CharField(max_length=32, unique=True)
+
+
+class HourlyAdData(TimeSeriesModel):
+
+    TIMESERIES_INTERVAL = timedelta(hours=1)
+
+    # retried updates replace the row of the current hour
+    TIMESERIES_UPSERT = 'update'
+
+    ad = models.ForeignKey(Ad, related_name='hourlydata')
+
+    views = models.BigIntegerField(default=0)
+
+
+class MinuteAdData(TimeSeriesBlockModel):
+
+    TIMESERIES_INTERVAL = timedelta(minutes=1)
+
+    # a row per ad and hour holds its per minute points
+    TIMESERIES_BLOCK = timedelta(hours=1)
+
+    ad = models.ForeignKey(Ad, related_name='minutedata')
+
+    views = BlockField('int64')
+    ctr = BlockField('float64')
+
+
 def fake_data(obj):
     return {
         'views': obj.id,
@@ -80,3 +195,16 @@ def report_data_collector(queryset):
     """
     for ad in queryset:
         yield fake_report(ad)
+
+
+def campaign_stats_collector(queryset):
+    """
+        should return an iterable that yields dictionaries of data
+        needed to successfully create a CampaignStats instance
+    """
+    for campaign in queryset:
+        yield {
+            'impressions': campaign.id,
+            'spend': campaign.id,
+            'campaign': campaign
+        }
@@ -7,6 +7,7 @@ SECRET_KEY = 'tdzf@9g8lofi@lo$=126jrka1ydzjix^!8j)vg$6cd+kz^ei5h'
 
 INSTALLED_APPS = [
     'django.contrib.contenttypes',
+    'timeseries',
     'tests'
 ]
 
@@ -16,15 +17,26 @@ db_user = os.environ.get('TEST_DB_USER', os.environ.get('USER', ''))
 db_name = 'timerseries_tests' + os.environ.get('TEST_DB_NAME', '')
 
 DB_CONFIGS = {
-    # N.B. sqlite doesn't support DISTINCT ON for some reason... ???
     'postgres': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
         'NAME': db_name,
         'USER': db_user,
         'PASSWORD': ''
+    },
+    # N.B. sqlite doesn't support DISTINCT ON, prefetch_latest falls back to
+    # window functions which require SQLite 3.25+. The test database is kept
+    # on disk so that it can be shared by worker threads and processes.
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, db_name + '.sqlite3'),
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_' + db_name + '.sqlite3')
+        }
     }
 }
 
 DATABASES = {
     'default': DB_CONFIGS.get(test_db)
 }
+
+USE_TZ = True
@@ -1,11 +1,63 @@
-from .models import Ad, RawAdData, MonthlyAdReport
+from .models import (
+    Ad, RawAdData, MonthlyAdReport, WeeklyAdReport, Campaign, CampaignStats,
+    DailyCampaignStats, HourlyAdData, MinuteAdData, PartitionedAdData,
+    PartitionedCampaignAdData, ad_data_collector, campaign_stats_collector,
+    fake_data, fake_report, report_data_collector
+)
 
-from datetime import timedelta
-from django.test import TestCase
-from timeseries.utils import utcnow, LatestQ
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from django.apps.registry import Apps
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import models
+from django.db.models import Avg, Count, Max, Sum
+from django.db.models.options import FieldDoesNotExist
+from django.utils.timezone import utc
+from django.db import DataError, connection
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from timeseries import blocks
+from timeseries.checks import check_latest_indexes
+from timeseries.instrumentation import (
+    MetricsRegistry, StatsdSink, register_sink, unregister_sink
+)
+from timeseries.scheduler import Scheduler
+from timeseries.signals import phase_finished
+from timeseries.partitions import (
+    create_partitions, drop_expired_partitions, get_partitions,
+    is_partitioned, partition_table
+)
+from timeseries.retention import prune_timeseries
+from timeseries.utils import (
+    utcnow, LatestQ, UpdateSummary, LATEST_STRATEGIES, TimeSeriesModel,
+    BlockField, IntervalBucketField, floor_bucket, get_latest_strategy,
+    has_latest_index, latest_window
+)
+from timeseries.writers import CopyReader, copy_text
 
 import django
 import mock
+import sys
+import time
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import psycopg2
+    from psycopg2.extras import Json
+except ImportError:
+    psycopg2 = None
 
 
 def time_machine(_time):
@@ -94,6 +146,389 @@ class TimeSeriesTests(TestCase):
         Ad.objects.update_reports(force=True)
         self.assertEqual(MonthlyAdReport.objects.count(), 30)
 
+    def test_update_timeseries_batched(self):
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, batch_size=3
+        )
+        self.assertIsInstance(output, UpdateSummary)
+        self.assertEqual(output.rows, 10)
+        self.assertEqual(output.batches, 4)
+        self.assertEqual(output.failures, [])
+        self.assertEqual(RawAdData.objects.count(), 10)
+
+        # nothing is outdated so nothing should be written
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, batch_size=3
+        )
+        self.assertEqual(output.rows, 0)
+        self.assertEqual(output.batches, 0)
+
+    def test_update_timeseries_batched_failures(self):
+        ids = list(Ad.objects.order_by('id').values_list('id', flat=True))
+
+        def collector(queryset):
+            for ad in queryset.order_by('id'):
+                data = fake_report(ad)
+                if ad.id == ids[4]:
+                    # violates the NOT NULL constraint
+                    data['avg_views'] = None
+                yield data
+
+        output = Ad.objects.update_timeseries(
+            'monthlyreports', collector, batch_size=2
+        )
+        self.assertEqual(output.rows, 8)
+        self.assertEqual(output.batches, 4)
+        self.assertEqual(len(output.failures), 1)
+        self.assertEqual(output.failures[0][0], 2)
+        self.assertEqual(MonthlyAdReport.objects.count(), 8)
+
+    def test_update_timeseries_write_backend(self):
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, backend='bulk_create'
+        )
+        self.assertIsInstance(output, UpdateSummary)
+        self.assertEqual((output.rows, output.batches), (10, 1))
+
+        written = []
+
+        def backend(rev_rel, rows, using):
+            rows = list(rows)
+            written.extend(rows)
+            return [data['ad'].pk for data in rows]
+
+        output = Ad.objects.update_timeseries(
+            'monthlyreports', report_data_collector, batch_size=4,
+            backend=backend
+        )
+        self.assertEqual((output.rows, output.batches), (10, 3))
+        self.assertEqual(len(written), 10)
+        self.assertEqual(MonthlyAdReport.objects.count(), 0)
+
+        with self.assertRaises(ValueError):
+            Ad.objects.update_timeseries(
+                'rawdata', ad_data_collector, force=True, backend='unknown'
+            )
+
+    def test_update_timeseries_copy(self):
+        if connection.vendor != 'postgresql':
+            with self.assertRaises(NotImplementedError):
+                Ad.objects.update_timeseries(
+                    'rawdata', ad_data_collector, backend='copy'
+                )
+            return
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, batch_size=3, backend='copy'
+        )
+        self.assertEqual((output.rows, output.batches), (10, 4))
+        ad = Ad.objects.first()
+        data = ad.rawdata.get()
+        self.assertEqual((data.views, data.clicks), (ad.id, ad.id))
+        self.assertIsNotNone(data.created)
+
+    def test_copy_text(self):
+        created = datetime(2020, 1, 1, tzinfo=utc)
+        self.assertEqual(copy_text(None), '\\N')
+        self.assertEqual(copy_text(True), 't')
+        self.assertEqual(copy_text(0.1), '0.1')
+        self.assertEqual(copy_text(created), '2020-01-01T00:00:00+00:00')
+        self.assertEqual(copy_text(u'a\tb\\c\n'), u'a\\tb\\\\c\\n')
+        self.assertEqual(copy_text(bytearray(b'ab\n')), '\\\\x61620a')
+        self.assertEqual(
+            copy_text([1, None, [u'a"b', u'c\\d']]),
+            u'{"1",NULL,{"a\\\\"b","c\\\\\\\\d"}}'
+        )
+        self.assertEqual(copy_text({u'k': None}), u'"k"=>NULL')
+        if psycopg2 is not None:
+            self.assertEqual(
+                copy_text(psycopg2.Binary(b'ab')), '\\\\x6162'
+            )
+            self.assertEqual(
+                copy_text(Json({u'a': u'b\\c'})), u'{"a": "b\\\\\\\\c"}'
+            )
+            with self.assertRaises(TypeError):
+                copy_text(psycopg2.extensions.AsIs('1'))
+
+        reader = CopyReader([u'1\t\u00e9\n', u'2\t\\N\n'])
+        self.assertEqual(reader.read(3), b'1\t\xc3')
+        self.assertEqual(reader.read(), b'\xa9\n2\t\\N\n')
+        self.assertEqual(reader.read(8), b'')
+
+    def test_last_updated_multiple_relations(self):
+        Ad.objects.update_rawdata()
+        first = Ad.objects.order_by('id').first()
+        Ad.objects.filter(pk=first.pk).update_reports()
+
+        queryset = Ad.objects.last_updated('rawdata', 'monthlyreports')
+        # correlated subqueries rather than one join per relation
+        self.assertNotIn('JOIN', str(queryset.query))
+        ad = queryset.get(pk=first.pk)
+        self.assertEqual(ad.rawdata_last_updated, ad.rawdata.get().created)
+        self.assertEqual(
+            ad.monthlyreports_last_updated, ad.monthlyreports.get().created
+        )
+        self.assertEqual(
+            queryset.filter(monthlyreports_last_updated__isnull=True).count(),
+            9
+        )
+        with self.assertRaises(TypeError):
+            Ad.objects.last_updated()
+
+    def test_filter_outdated_multiple_relations(self):
+        first = Ad.objects.order_by('id').first()
+        Ad.objects.filter(pk=first.pk).update_rawdata()
+        Ad.objects.exclude(pk=first.pk).update_reports()
+
+        names = ('rawdata', 'monthlyreports')
+        self.assertEqual(Ad.objects.filter_outdated(*names).count(), 10)
+        self.assertEqual(
+            Ad.objects.filter_outdated(*names, mode='all').count(), 0
+        )
+        Ad.objects.filter(pk=first.pk).update_reports()
+        self.assertEqual(Ad.objects.filter_outdated(*names).count(), 9)
+        self.assertEqual(
+            Ad.objects.filter_outdated(*names, mode='all').count(), 0
+        )
+        with time_machine(utcnow() + timedelta(days=2)):
+            self.assertEqual(
+                Ad.objects.filter_outdated(*names, mode='all').count(), 0
+            )
+            self.assertEqual(
+                Ad.objects.filter_outdated('rawdata').count(), 10
+            )
+
+        with self.assertRaises(ValueError):
+            Ad.objects.filter_outdated(*names, mode='some')
+        with self.assertRaises(TypeError):
+            Ad.objects.filter_outdated(*names, strict=True)
+
+    def test_update_timeseries_since(self):
+        seen = {}
+
+        def collector(queryset):
+            for ad in queryset:
+                seen[ad.pk] = (
+                    ad.rawdata_last_updated,
+                    getattr(ad, 'rawdata_latest_views', None)
+                )
+                yield {'ad': ad, 'views': ad.pk, 'clicks': 0}
+
+        with CaptureQueriesContext(connection) as queries:
+            Ad.objects.update_timeseries('rawdata', collector, since=True)
+        self.assertEqual(self.count_selects(queries), 1)
+        self.assertEqual(len(seen), 10)
+        self.assertEqual(set(seen.values()), {(None, None)})
+
+        latest = dict(
+            (data.ad_id, data) for data in RawAdData.objects.all()
+        )
+        tomorrow = utcnow() + RawAdData.TIMESERIES_INTERVAL
+        with time_machine(tomorrow):
+            with CaptureQueriesContext(connection) as queries:
+                summary = Ad.objects.update_timeseries(
+                    'rawdata', collector, since=['views'], batch_size=5
+                )
+        # the owners are annotated in the filter_outdated query
+        self.assertEqual(self.count_selects(queries), 1)
+        self.assertEqual(summary.rows, 10)
+        self.assertEqual(seen, dict(
+            (pk, (data.created, data.views)) for pk, data in latest.items()
+        ))
+
+        seen.clear()
+        Ad.objects.update_timeseries(
+            'rawdata', collector, force=True, since='views'
+        )
+        self.assertEqual(len(seen), 10)
+        self.assertTrue(all(views is not None for _, views in seen.values()))
+
+    def count_selects(self, queries):
+        return len([
+            query for query in queries.captured_queries
+            if query['sql'].startswith('SELECT')
+        ])
+
+    def add_rawdata(self, ad, *days_ago):
+        now = utcnow()
+        for days in days_ago:
+            data = RawAdData.objects.create(ad=ad, views=0, clicks=0)
+            RawAdData.objects.filter(pk=data.pk).update(
+                created=now - timedelta(days=days)
+            )
+
+    def test_find_gaps(self):
+        ads = list(Ad.objects.order_by('id')[:3])
+        self.add_rawdata(ads[0], 6, 5, 3, 2, 1.1)
+        self.add_rawdata(ads[1], 6, 5, 4, 3, 2, 1)
+        queryset = Ad.objects.filter(pk__in=[ad.pk for ad in ads])
+        created = dict(
+            (ad.pk, sorted(ad.rawdata.values_list('created', flat=True)))
+            for ad in ads
+        )
+
+        gaps = queryset.find_gaps('rawdata')
+        self.assertEqual(gaps, [(ads[0].pk, created[ads[0].pk][1],
+                                 created[ads[0].pk][2])])
+
+        now = utcnow()
+        start = now - timedelta(days=7)
+        with time_machine(now):
+            gaps = queryset.find_gaps('rawdata', start=start)
+        self.assertEqual([(gap.owner, gap.start, gap.end) for gap in gaps], [
+            (ads[0].pk, created[ads[0].pk][1], created[ads[0].pk][2]),
+            (ads[2].pk, start, now),
+        ])
+        # the last row of ads[0] is 1.1 days old
+        gaps = queryset.find_gaps('rawdata', tolerance=timedelta(hours=1))
+        self.assertEqual(
+            [gap.owner for gap in gaps], [ads[0].pk, ads[0].pk]
+        )
+        self.assertEqual(gaps[-1].start, created[ads[0].pk][-1])
+
+    def test_backfill(self):
+        ads = list(Ad.objects.order_by('id')[:3])
+        self.add_rawdata(ads[0], 6, 5, 2, 1)
+        queryset = Ad.objects.filter(pk__in=[ad.pk for ad in ads])
+        start = utcnow() - timedelta(days=7)
+        calls = []
+
+        def collector(owners, start, end):
+            calls.append((sorted(ad.pk for ad in owners), start, end))
+            for ad in owners:
+                created = start + RawAdData.TIMESERIES_INTERVAL
+                while created < end - timedelta(hours=1):
+                    yield {'ad': ad, 'created': created, 'views': ad.pk}
+                    created += RawAdData.TIMESERIES_INTERVAL
+
+        summary = queryset.backfill(
+            'rawdata', collector, start=start, batch_size=1
+        )
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0][0], [ads[0].pk])
+        self.assertEqual(summary.failures, [])
+        self.assertEqual(summary.rows, 2 + 6 + 6)
+        self.assertEqual(queryset.find_gaps('rawdata', start=start), [])
+        self.assertEqual(
+            RawAdData.objects.filter(ad=ads[1], created__gte=start).count(), 6
+        )
+
+    def test_as_of(self):
+        ads = list(Ad.objects.order_by('id')[:3])
+        self.add_rawdata(ads[0], 6, 4, 2)
+        self.add_rawdata(ads[1], 3)
+        queryset = Ad.objects.filter(pk__in=[ad.pk for ad in ads])
+        created = dict(
+            (ad.pk, sorted(ad.rawdata.values_list('created', flat=True)))
+            for ad in ads
+        )
+        now = utcnow()
+        at = now - timedelta(days=3)
+
+        for name in ('distinct', 'lateral', 'window'):
+            if name != 'window' and connection.vendor != 'postgresql':
+                continue
+            rows = queryset.as_of('rawdata', at, strategy=name)
+            self.assertEqual(
+                sorted((row.ad_id, row.created) for row in rows),
+                [(ads[0].pk, created[ads[0].pk][1]),
+                 (ads[1].pk, created[ads[1].pk][0])]
+            )
+            prefetched = queryset.order_by('pk').prefetch_latest(
+                'rawdata', as_of=at, strategy=name
+            )
+            self.assertEqual(
+                [ad.latest_rawdata and ad.latest_rawdata.created
+                 for ad in prefetched],
+                [created[ads[0].pk][1], created[ads[1].pk][0], None]
+            )
+
+        timestamps = [now - timedelta(days=5), at, now]
+        with self.assertNumQueries(1):
+            snapshots = queryset.as_of('rawdata', timestamps)
+        self.assertEqual(list(snapshots), timestamps)
+        self.assertEqual(
+            [dict((pk, row.created) for pk, row in snapshot.items())
+             for snapshot in snapshots.values()],
+            [{ads[0].pk: created[ads[0].pk][0]},
+             {ads[0].pk: created[ads[0].pk][1],
+              ads[1].pk: created[ads[1].pk][0]},
+             {ads[0].pk: created[ads[0].pk][2],
+              ads[1].pk: created[ads[1].pk][0]}]
+        )
+        self.assertIsInstance(
+            snapshots[now][ads[0].pk], RawAdData
+        )
+        self.assertEqual(queryset.as_of('rawdata', []), {})
+
+        # dates stand for midnight in the current time zone
+        tomorrow = (now + timedelta(days=1)).date()
+        latest = [(ads[0].pk, created[ads[0].pk][2]),
+                  (ads[1].pk, created[ads[1].pk][0])]
+        self.assertEqual(sorted(
+            (row.ad_id, row.created)
+            for row in queryset.as_of('rawdata', tomorrow)
+        ), latest)
+        self.assertEqual(sorted(
+            (pk, row.created) for pk, row in
+            queryset.as_of('rawdata', [tomorrow])[tomorrow].items()
+        ), latest)
+        # strings are parsed rather than iterated
+        self.assertEqual(sorted(
+            (row.ad_id, row.created)
+            for row in queryset.as_of('rawdata', tomorrow.isoformat())
+        ), latest)
+        self.assertEqual(sorted(
+            (pk, row.created) for pk, row in queryset.as_of(
+                'rawdata', (tomorrow.isoformat(),)
+            )[tomorrow.isoformat()].items()
+        ), latest)
+        with self.assertRaises(ValueError):
+            queryset.as_of('rawdata', 'tomorrow')
+        with self.assertRaises(TypeError):
+            queryset.as_of('rawdata', set([tomorrow]))
+        with self.assertRaises(TypeError):
+            queryset.as_of('minutedata', now)
+
+    def test_annotate_latest(self):
+        Ad.objects.update_rawdata()
+        with time_machine(utcnow() + timedelta(days=2)):
+            Ad.objects.update_timeseries(
+                'rawdata', lambda ads: [
+                    {'ad': ad, 'views': 100 - ad.id, 'clicks': 1}
+                    for ad in ads
+                ]
+            )
+        last = Ad.objects.order_by('id').last()
+        RawAdData.objects.create(ad=last, views=1000, clicks=2)
+        Ad.objects.create()
+
+        queryset = Ad.objects.annotate_latest('rawdata', 'views', 'clicks')
+        self.assertNotIn('JOIN', str(queryset.query))
+        ads = list(queryset.order_by('-rawdata_latest_views'))
+        self.assertEqual(ads[0].pk, last.pk)
+        self.assertEqual(ads[0].rawdata_latest_views, 1000)
+        self.assertEqual(ads[0].rawdata_latest_clicks, 2)
+        self.assertEqual(
+            [ad.rawdata_latest_views for ad in ads[1:-1]],
+            sorted([ad.rawdata_latest_views for ad in ads[1:-1]],
+                   reverse=True)
+        )
+        # owners without related instances get None
+        self.assertIsNone(ads[-1].rawdata_latest_views)
+
+        self.assertEqual(
+            queryset.filter(rawdata_latest_clicks=1).count(), 9
+        )
+        self.assertEqual(
+            queryset.filter(pk=last.pk).values_list(
+                'rawdata_latest_views', flat=True
+            ).get(),
+            1000
+        )
+        with self.assertRaises(TypeError):
+            Ad.objects.annotate_latest('rawdata')
+
+    @skipUnlessDBFeature('can_distinct_on_fields')
     def test_latest_q_function(self):
         just_before = utcnow()
         for _ in range(10):
@@ -167,6 +602,83 @@ class TimeSeriesTests(TestCase):
                 None
             )
 
+    def test_prefetch_latest_strategies(self):
+        just_before = utcnow()
+        for days in range(1, 4):
+            with time_machine(just_before + timedelta(days=days, seconds=1)):
+                Ad.objects.update_rawdata()
+                Ad.objects.update_reports(force=True)
+
+        strategies = ['window']
+        if connection.vendor == 'postgresql':
+            strategies.extend(['lateral', 'distinct'])
+        for strategy in strategies + [latest_window]:
+            queryset = Ad.objects.prefetch_latest(
+                'rawdata', 'monthlyreports', strategy=strategy
+            )
+            self.check_prefetch_latest_queryset(queryset, 3)
+            self.check_prefetch_latest_queryset(
+                Ad.objects.filter(
+                    id__in=Ad.objects.order_by('id')[:4]
+                ).prefetch_latest(
+                    'rawdata', 'monthlyreports', strategy=strategy
+                ).filter(
+                    id__gt=Ad.objects.order_by('id')[1].id
+                ), 3
+            )
+
+    def test_prefetch_latest_iter_chunks(self):
+        just_before = utcnow()
+        for days in range(1, 3):
+            with time_machine(just_before + timedelta(days=days, seconds=1)):
+                Ad.objects.update_rawdata()
+                Ad.objects.update_reports(force=True)
+        Ad.objects.order_by('id').first().rawdata.all().delete()
+
+        queryset = Ad.objects.prefetch_latest(
+            'rawdata', 'monthlyreports'
+        ).order_by('id')
+        # the owners, then a query per chunk and related name
+        with self.assertNumQueries(1 + 3 * 2):
+            chunks = list(queryset.iter_chunks(4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+        ads = [ad for chunk in chunks for ad in chunk]
+        self.assertIsNone(ads[0].latest_rawdata)
+        for ad in ads[1:]:
+            self.assertEqual(ad.latest_rawdata, ad.rawdata.latest())
+            self.assertEqual(
+                ad.latest_monthlyreports, ad.monthlyreports.latest()
+            )
+
+        ads = list(queryset.iterator(chunk_size=3))
+        self.assertEqual(len(ads), 10)
+        self.assertEqual(ads[-1].latest_rawdata, ads[-1].rawdata.latest())
+        # the queryset itself still parses its prefetched results
+        self.check_prefetch_latest_queryset(queryset.filter(
+            id__in=[ad.id for ad in ads[1:]]
+        ), 3)
+
+        with self.assertRaises(ValueError):
+            next(queryset.iter_chunks(0))
+
+    def test_get_latest_strategy(self):
+        default = get_latest_strategy(connection)
+        if connection.vendor == 'postgresql':
+            self.assertEqual(default, LATEST_STRATEGIES['lateral'])
+        else:
+            self.assertEqual(default, LATEST_STRATEGIES['window'])
+        self.assertEqual(
+            get_latest_strategy(connection, 'distinct'),
+            LATEST_STRATEGIES['distinct']
+        )
+        self.assertEqual(
+            get_latest_strategy(connection, latest_window), latest_window
+        )
+        with self.assertRaises(ValueError):
+            Ad.objects.prefetch_latest('rawdata', strategy='unknown')
+        with self.assertRaises(TypeError):
+            Ad.objects.prefetch_latest('rawdata', stategy='window')
+
     def check_prefetch_latest_queryset(self, queryset, num_quiries=None):
         if num_quiries is not None:
             with self.assertNumQueries(num_quiries):
@@ -198,3 +710,1362 @@ class TimeSeriesTests(TestCase):
             ad.rawdata.latest()
         )
         self.assertIsNone(ad.latest_monthlyreports)
+
+
+class ShardedUpdateTests(TransactionTestCase):
+
+    def setUp(self):
+        for _ in range(10):
+            Ad.objects.create()
+
+    def test_update_timeseries_thread_workers(self):
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, workers=3
+        )
+        self.assertIsInstance(output, UpdateSummary)
+        self.assertEqual(output.rows, 10)
+        self.assertEqual(output.failures, [])
+        self.assertEqual(len(output.shards), 3)
+        self.assertEqual(
+            [shard.rows for shard in output.shards], [4, 4, 2]
+        )
+        self.assertEqual(RawAdData.objects.count(), 10)
+        self.assertEqual(
+            RawAdData.objects.values('ad').distinct().count(), 10
+        )
+
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, workers=3
+        )
+        self.assertEqual(output.rows, 0)
+        self.assertEqual(output.shards, [])
+
+        def collector(queryset):
+            for ad in queryset:
+                self.assertIsNotNone(ad.rawdata_last_updated)
+                yield fake_data(ad)
+
+        output = Ad.objects.update_timeseries(
+            'rawdata', collector, force=True, workers=3, since=True
+        )
+        self.assertEqual((output.rows, output.failures), (10, []))
+
+    def test_update_timeseries_shard_errors(self):
+        first_id = Ad.objects.order_by('id').first().id
+
+        def collector(queryset):
+            for ad in queryset:
+                if ad.id == first_id:
+                    raise RuntimeError('upstream unavailable')
+                yield fake_report(ad)
+
+        output = Ad.objects.update_timeseries(
+            'monthlyreports', collector, batch_size=1, workers=2
+        )
+        self.assertEqual(output.rows, 5)
+        self.assertEqual(len(output.failures), 1)
+        batch_number, err = output.failures[0]
+        self.assertIsNone(batch_number)
+        self.assertIsInstance(err, RuntimeError)
+        self.assertEqual(len(output.shards[0].failures), 1)
+        self.assertEqual(output.shards[1].failures, [])
+        self.assertEqual(MonthlyAdReport.objects.count(), 5)
+
+    def test_update_timeseries_shard_ranges(self):
+        pks = list(Ad.objects.order_by('pk').values_list('pk', flat=True))
+        # the shards are primary key ranges of the filtered queryset
+        output = Ad.objects.exclude(pk=pks[4]).update_timeseries(
+            'rawdata', ad_data_collector, workers=3
+        )
+        self.assertEqual(output.rows, 9)
+        self.assertEqual(
+            [shard.rows for shard in output.shards], [3, 3, 3]
+        )
+        self.assertFalse(RawAdData.objects.filter(ad=pks[4]).exists())
+
+    def test_update_timeseries_process_workers(self):
+        output = Ad.objects.update_timeseries(
+            'rawdata', ad_data_collector, workers=2, pool='process'
+        )
+        self.assertEqual(output.rows, 10)
+        self.assertEqual(len(output.shards), 2)
+        self.assertEqual(RawAdData.objects.count(), 10)
+
+    def test_update_timeseries_invalid_pool(self):
+        with self.assertRaises(ValueError):
+            Ad.objects.update_timeseries(
+                'rawdata', ad_data_collector, workers=2, pool='fibers'
+            )
+
+    def test_update_timeseries_claim_arguments(self):
+        with self.assertRaises(ValueError):
+            Ad.objects.update_timeseries(
+                'rawdata', ad_data_collector, workers=2, claim=True
+            )
+        if connection.vendor != 'postgresql':
+            with self.assertRaises(NotImplementedError):
+                Ad.objects.update_timeseries(
+                    'rawdata', ad_data_collector, claim=True
+                )
+
+    @unittest.skipUnless(
+        connection.vendor == 'postgresql', 'claiming requires PostgreSQL'
+    )
+    def test_update_timeseries_claim_concurrently(self):
+        collected = []
+
+        def collector(queryset):
+            for ad in queryset:
+                collected.append(ad.id)
+                # keeps the claim open while the other workers claim
+                time.sleep(0.01)
+                yield fake_data(ad)
+
+        def work(_):
+            try:
+                return Ad.objects.update_timeseries(
+                    'rawdata', collector, batch_size=2, claim=True
+                )
+            finally:
+                connection.close()
+
+        pool = ThreadPool(4)
+        try:
+            summaries = pool.map(work, range(4))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(sum(summary.rows for summary in summaries), 10)
+        self.assertEqual(sorted(collected), sorted(
+            Ad.objects.values_list('id', flat=True)
+        ))
+        self.assertEqual(RawAdData.objects.count(), 10)
+        self.assertEqual(
+            RawAdData.objects.values('ad').distinct().count(), 10
+        )
+
+
+@unittest.skipIf(
+    sys.version_info < (3, 6), 'async collectors require Python 3.6+'
+)
+class AsyncCollectorTests(TestCase):
+
+    def setUp(self):
+        Ad.objects.bulk_create([Ad() for _ in range(10)])
+
+    def test_coroutine_collector(self):
+        from .async_collectors import async_ad_data_collector
+        output = Ad.objects.update_timeseries(
+            'rawdata', async_ad_data_collector
+        )
+        self.assertEqual(len(output), 10)
+        self.assertEqual(
+            RawAdData.objects.values('ad').distinct().count(), 10
+        )
+
+    def test_async_generator_collector(self):
+        from .async_collectors import async_report_data_collector
+        output = Ad.objects.update_timeseries(
+            'monthlyreports', async_report_data_collector, batch_size=4
+        )
+        self.assertEqual(output.rows, 10)
+        self.assertEqual(output.batches, 3)
+        self.assertEqual(MonthlyAdReport.objects.count(), 10)
+
+    def test_coroutine_collector_concurrency(self):
+        from .async_collectors import probe_collector
+        collector, state = probe_collector()
+        output = Ad.objects.update_timeseries(
+            'rawdata', collector, concurrency=3, batch_size=5
+        )
+        self.assertEqual(output.rows, 20)
+        self.assertEqual(state['max_in_flight'], 3)
+        self.assertEqual(RawAdData.objects.count(), 20)
+
+    def test_coroutine_collector_errors(self):
+        from .async_collectors import failing_collector
+        with self.assertRaises(RuntimeError):
+            Ad.objects.update_timeseries('rawdata', failing_collector)
+        self.assertEqual(RawAdData.objects.count(), 0)
+
+
+class SchedulerTests(TestCase):
+
+    def setUp(self):
+        for _ in range(3):
+            Ad.objects.create()
+        self.later = utcnow() + RawAdData.TIMESERIES_INTERVAL + \
+            timedelta(seconds=1)
+
+    def test_run_pending(self):
+        scheduler = Scheduler(batch_size=2, reload_interval=timedelta(days=2))
+        scheduler.add(Ad.objects.all(), 'rawdata', ad_data_collector)
+        self.assertEqual(scheduler.run_pending(), 3)
+        self.assertEqual(RawAdData.objects.count(), 3)
+        # nothing is due until the interval has passed
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertGreater(
+            scheduler.next_due(), utcnow() + timedelta(hours=23)
+        )
+
+        Ad.objects.create()
+        # new owners are only picked up on refresh
+        self.assertEqual(scheduler.run_pending(), 0)
+        scheduler.refresh()
+        self.assertEqual(scheduler.run_pending(), 1)
+
+        with time_machine(self.later):
+            self.assertEqual(scheduler.run_pending(), 4)
+        self.assertEqual(RawAdData.objects.count(), 8)
+
+    def test_reload_intervals(self):
+        scheduler = Scheduler(
+            reload_interval=60, full_reload_interval=timedelta(days=2)
+        )
+        scheduler.add(Ad.objects.all(), 'rawdata', ad_data_collector)
+        self.assertEqual(scheduler.run_pending(), 3)
+        loaded = scheduler.loaded
+
+        ad = Ad.objects.create()
+        with time_machine(utcnow() + timedelta(minutes=1)):
+            # only the new owner is added
+            self.assertEqual(scheduler.run_pending(), 1)
+        self.assertEqual(len(scheduler.heap), 4)
+        self.assertEqual(scheduler.loaded, loaded)
+
+        # owners updated by another process are rescheduled, not updated
+        other = Ad.objects.create()
+        scheduler.refresh()
+        Ad.objects.filter(pk=other.pk).update_timeseries(
+            'rawdata', ad_data_collector
+        )
+        self.assertEqual(scheduler.run_pending(), 1)
+        self.assertEqual(other.rawdata.count(), 1)
+        self.assertGreater(
+            scheduler.next_due(), utcnow() + timedelta(hours=23)
+        )
+
+        Ad.objects.filter(pk=ad.pk).delete()
+        with time_machine(utcnow() + timedelta(days=2)):
+            self.assertEqual(scheduler.run_pending(), 4)
+        self.assertGreater(scheduler.loaded, loaded)
+
+    def test_errors(self):
+        def collector(queryset):
+            raise ValueError('unavailable')
+
+        errors = []
+        scheduler = Scheduler(
+            on_error=lambda job, pks, err: errors.append((pks, err))
+        )
+        scheduler.add(Ad.objects.all(), 'rawdata', collector)
+        self.assertEqual(scheduler.run_pending(), 3)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(errors[0][0]), 3)
+        # failed owners are retried an interval later
+        self.assertEqual(scheduler.run_pending(), 0)
+        with time_machine(self.later):
+            self.assertEqual(scheduler.run_pending(), 3)
+
+        scheduler = Scheduler()
+        scheduler.add(Ad.objects.all(), 'rawdata', collector)
+        with self.assertRaises(ValueError):
+            scheduler.run_pending()
+
+    def test_run(self):
+        sleeps = []
+        scheduler = Scheduler(reload_interval=60, sleep=sleeps.append)
+        scheduler.add(Ad.objects.all(), 'rawdata', ad_data_collector)
+        scheduler.run(iterations=2)
+        self.assertEqual(RawAdData.objects.count(), 3)
+        # sleeps until the next reload as nothing is due before
+        self.assertEqual(len(sleeps), 2)
+        self.assertLessEqual(sleeps[0], 60)
+        self.assertGreater(sleeps[0], 55)
+
+    def test_scheduler_command(self):
+        call_command(
+            'timeseries_scheduler',
+            'tests.Ad.rawdata:tests.models.ad_data_collector',
+            once=True, verbosity=0
+        )
+        self.assertEqual(RawAdData.objects.count(), 3)
+        with self.assertRaises(CommandError):
+            call_command('timeseries_scheduler', 'tests.Ad.rawdata', once=True)
+        with self.assertRaises(CommandError):
+            call_command(
+                'timeseries_scheduler',
+                'tests.Campaign.stats:tests.models.missing', once=True
+            )
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        for _ in range(5):
+            Ad.objects.create()
+        self.events = []
+        register_sink(self.events.append)
+        self.addCleanup(unregister_sink, self.events.append)
+
+    def phases(self):
+        return [event.phase for event in self.events]
+
+    def test_update_phases(self):
+        Ad.objects.update_rawdata()
+        self.assertEqual(self.phases(), [
+            'filter_outdated', 'collect', 'instantiate', 'write', 'update'
+        ])
+        events = dict((event.phase, event) for event in self.events)
+        self.assertEqual(events['filter_outdated'].owners, 5)
+        self.assertEqual(events['filter_outdated'].queries, 1)
+        self.assertEqual(events['filter_outdated'].related_name, 'rawdata')
+        self.assertEqual(events['collect'].rows, 5)
+        # the collector evaluates the outdated owners
+        self.assertEqual(events['collect'].queries, 1)
+        self.assertIs(events['instantiate'].model, RawAdData)
+        self.assertEqual(events['write'].rows, 5)
+        self.assertGreaterEqual(events['write'].queries, 1)
+        self.assertEqual(events['update'].rows, 5)
+        self.assertEqual(events['update'].label, 'tests.ad')
+        for event in self.events:
+            self.assertGreaterEqual(event.duration, event.db_time)
+            self.assertEqual(event.errors, 0)
+
+    def test_batched_phases(self):
+        ids = list(Ad.objects.order_by('id').values_list('id', flat=True))
+
+        def collector(queryset):
+            for ad in queryset.order_by('id'):
+                data = fake_report(ad)
+                if ad.id == ids[0]:
+                    data['avg_views'] = None
+                yield data
+
+        Ad.objects.update_timeseries(
+            'monthlyreports', collector, batch_size=2
+        )
+        writes = [event for event in self.events if event.phase == 'write']
+        self.assertEqual([event.rows for event in writes], [None, 2, 1])
+        self.assertEqual([event.errors for event in writes], [1, 0, 0])
+        self.assertEqual(self.events[-1].phase, 'update')
+        self.assertEqual(
+            (self.events[-1].rows, self.events[-1].errors), (3, 1)
+        )
+
+    def test_errors_propagate(self):
+        def collector(queryset):
+            for ad in queryset:
+                raise RuntimeError('unavailable')
+            yield
+
+        with self.assertRaises(RuntimeError):
+            Ad.objects.update_timeseries('rawdata', collector)
+        self.assertEqual(
+            self.phases(), ['filter_outdated', 'collect', 'update']
+        )
+        self.assertEqual(
+            [event.errors for event in self.events], [0, 1, 1]
+        )
+
+    def test_prefetch_latest(self):
+        Ad.objects.update_rawdata()
+        del self.events[:]
+        ads = list(Ad.objects.prefetch_latest('rawdata'))
+        self.assertEqual(len(ads), 5)
+        self.assertEqual(self.phases(), ['prefetch_latest'])
+        self.assertEqual(self.events[0].queries, 1)
+        self.assertEqual(self.events[0].owners, 5)
+        self.assertEqual(self.events[0].related_name, 'rawdata')
+
+    def test_signal_and_sinks(self):
+        received = []
+
+        def receiver(sender, event, **kwargs):
+            received.append((sender, event.phase))
+
+        phase_finished.connect(receiver)
+        self.addCleanup(phase_finished.disconnect, receiver)
+        registry = register_sink(MetricsRegistry())
+        self.addCleanup(unregister_sink, registry)
+
+        class Client(object):
+            calls = []
+
+            def timing(self, name, value):
+                self.calls.append(name)
+
+            def incr(self, name, count):
+                self.calls.append(name)
+
+        statsd = register_sink(StatsdSink(Client(), prefix='ads'))
+        self.addCleanup(unregister_sink, statsd)
+
+        Ad.objects.update_rawdata()
+        self.assertIn((Ad, 'update'), received)
+        self.assertIn((RawAdData, 'write'), received)
+        self.assertEqual(
+            registry.get('timeseries_rows_total', phase='update'), 5
+        )
+        self.assertEqual(
+            registry.get('timeseries_phase_total', model='tests.ad'), 3
+        )
+        self.assertIn(
+            'timeseries_rows_total{model="tests.ad",related_name="rawdata",'
+            'phase="update"} 5.0',
+            registry.render()
+        )
+        self.assertIn('ads.tests.ad.rawdata.update.rows', Client.calls)
+
+
+class LastUpdatedFieldTests(TestCase):
+
+    def setUp(self):
+        for _ in range(5):
+            Campaign.objects.create()
+
+    def update_stats(self, **kwargs):
+        return Campaign.objects.update_timeseries(
+            'stats', campaign_stats_collector, **kwargs
+        )
+
+    def assertLastUpdatedInSync(self):
+        for campaign in Campaign.objects.all():
+            latest = campaign.stats.latest() if campaign.stats.exists() \
+                else None
+            self.assertEqual(
+                campaign.stats_last_updated,
+                latest.created if latest else None
+            )
+
+    def test_update_timeseries_maintains_field(self):
+        self.assertFalse(
+            Campaign.objects.filter(stats_last_updated__isnull=False).exists()
+        )
+        self.update_stats()
+        self.assertLastUpdatedInSync()
+
+        with time_machine(utcnow() + CampaignStats.TIMESERIES_INTERVAL):
+            self.update_stats(batch_size=2)
+        self.assertEqual(CampaignStats.objects.count(), 10)
+        self.assertLastUpdatedInSync()
+
+    def test_filter_outdated_uses_field(self):
+        queryset = Campaign.objects.filter_outdated('stats')
+        sql = str(queryset.query).upper()
+        self.assertNotIn('MAX(', sql)
+        self.assertNotIn('JOIN', sql)
+        self.assertEqual(queryset.count(), 5)
+
+        self.update_stats()
+        self.assertEqual(Campaign.objects.filter_outdated('stats').count(), 0)
+
+        self.update_stats()
+        self.assertEqual(CampaignStats.objects.count(), 5)
+
+        with time_machine(utcnow() + CampaignStats.TIMESERIES_INTERVAL):
+            self.assertEqual(
+                Campaign.objects.filter_outdated('stats').count(), 5
+            )
+
+    def test_last_updated_uses_field(self):
+        self.update_stats()
+        campaign = Campaign.objects.last_updated('stats').first()
+        self.assertEqual(
+            campaign.stats_last_updated, campaign.stats.latest().created
+        )
+
+    def test_refresh_last_updated(self):
+        CampaignStats.objects.bulk_create([
+            CampaignStats(campaign=campaign)
+            for campaign in Campaign.objects.all()[:3]
+        ])
+        self.assertEqual(
+            Campaign.objects.filter(stats_last_updated__isnull=True).count(),
+            5
+        )
+        self.assertEqual(Campaign.objects.refresh_last_updated('stats'), 5)
+        self.assertLastUpdatedInSync()
+
+    def test_rebuild_last_updated_command(self):
+        CampaignStats.objects.bulk_create([
+            CampaignStats(campaign=campaign)
+            for campaign in Campaign.objects.all()
+        ])
+        call_command(
+            'timeseries_rebuild_last_updated', 'tests.Campaign.stats',
+            batch_size=2, verbosity=0
+        )
+        self.assertLastUpdatedInSync()
+
+        CampaignStats.objects.all().delete()
+        call_command('timeseries_rebuild_last_updated', verbosity=0)
+        self.assertLastUpdatedInSync()
+
+
+class LatestIndexTests(TestCase):
+
+    def build_models(self, index):
+        test_apps = Apps()
+
+        class Owner(models.Model):
+
+            class Meta:
+                app_label = 'tests'
+                apps = test_apps
+
+        class OwnerData(TimeSeriesModel):
+
+            TIMESERIES_INTERVAL = 60
+            TIMESERIES_INDEX = index
+
+            owner = models.ForeignKey(Owner, related_name='data')
+
+            class Meta(TimeSeriesModel.Meta):
+                app_label = 'tests'
+                apps = test_apps
+
+        return OwnerData
+
+    def test_latest_index_added(self):
+        for model in (RawAdData, MonthlyAdReport, CampaignStats):
+            field = [
+                field for field in model._meta.fields if field.many_to_one
+            ][0]
+            self.assertTrue(has_latest_index(model, field))
+        if django.VERSION[:2] >= (1, 11):
+            self.assertIn(
+                ['ad', '-created'],
+                [index.fields for index in RawAdData._meta.indexes]
+            )
+        self.assertEqual(check_latest_indexes(), [])
+
+    def test_latest_index_opt_out(self):
+        OwnerData = self.build_models(index=False)
+        self.assertFalse(
+            has_latest_index(OwnerData, OwnerData._meta.get_field('owner'))
+        )
+        errors = check_latest_indexes([mock.Mock(
+            get_models=mock.Mock(return_value=[OwnerData])
+        )])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].id, 'timeseries.W001')
+
+    def test_latest_index_declared(self):
+        OwnerData = self.build_models(index=False)
+        OwnerData._meta.index_together = (('owner', 'created'), )
+        errors = check_latest_indexes([mock.Mock(
+            get_models=mock.Mock(return_value=[OwnerData])
+        )])
+        self.assertEqual(errors, [])
+
+
+class ResampleTests(TestCase):
+
+    def setUp(self):
+        self.start = datetime(2020, 1, 1, tzinfo=utc)
+        self.first = Campaign.objects.create()
+        self.second = Campaign.objects.create()
+        self.add_stats(self.first, 10, 10)
+        self.add_stats(self.first, 50, 30)
+        self.add_stats(self.first, 150, 5)
+        self.add_stats(self.second, 75, 7)
+
+    def add_stats(self, campaign, minutes, impressions):
+        stats = CampaignStats.objects.create(
+            campaign=campaign, impressions=impressions, spend=impressions * 2
+        )
+        # created is set on save by auto_now_add
+        CampaignStats.objects.filter(pk=stats.pk).update(
+            created=self.start + timedelta(minutes=minutes)
+        )
+
+    def hour(self, hours):
+        return self.start + timedelta(hours=hours)
+
+    def test_resample(self):
+        rows = Campaign.objects.resample(
+            'stats', {'impressions': Sum, 'spend': Avg}
+        )
+        self.assertEqual(list(rows), [
+            {'campaign': self.first.pk, 'bucket': self.hour(0),
+             'impressions__sum': 40, 'spend__avg': 40.0},
+            {'campaign': self.first.pk, 'bucket': self.hour(2),
+             'impressions__sum': 5, 'spend__avg': 10.0},
+            {'campaign': self.second.pk, 'bucket': self.hour(1),
+             'impressions__sum': 7, 'spend__avg': 14.0},
+        ])
+
+    def test_resample_range_and_bucket(self):
+        rows = Campaign.objects.filter(pk=self.first.pk).resample(
+            'stats', {'peak': Max('impressions')}, bucket=30 * 60,
+            start=self.start + timedelta(minutes=20)
+        )
+        self.assertEqual(list(rows), [
+            {'campaign': self.first.pk,
+             'bucket': self.start + timedelta(minutes=30), 'peak': 30},
+            {'campaign': self.first.pk,
+             'bucket': self.start + timedelta(minutes=150), 'peak': 5},
+        ])
+
+    def test_resample_fill(self):
+        rows = Campaign.objects.resample(
+            'stats', {'impressions': Sum}, start=self.start, end=self.hour(3),
+            fill=True
+        )
+        self.assertEqual(rows, [
+            {'campaign': self.first.pk, 'bucket': self.hour(0),
+             'impressions__sum': 40},
+            {'campaign': self.first.pk, 'bucket': self.hour(1),
+             'impressions__sum': None},
+            {'campaign': self.first.pk, 'bucket': self.hour(2),
+             'impressions__sum': 5},
+            {'campaign': self.second.pk, 'bucket': self.hour(0),
+             'impressions__sum': None},
+            {'campaign': self.second.pk, 'bucket': self.hour(1),
+             'impressions__sum': 7},
+            {'campaign': self.second.pk, 'bucket': self.hour(2),
+             'impressions__sum': None},
+        ])
+
+    def test_resample_invalid(self):
+        with self.assertRaises(ValueError):
+            Campaign.objects.resample('stats', {'impressions': Sum}, bucket=0)
+        with self.assertRaises(ValueError):
+            Campaign.objects.resample(
+                'stats', {'impressions': Sum}, fill=True
+            )
+
+
+@unittest.skipIf(numpy is None, 'requires NumPy')
+class ArrayExportTests(TestCase):
+
+    def setUp(self):
+        self.start = datetime(2020, 1, 1, tzinfo=utc)
+        self.first = Campaign.objects.create()
+        self.second = Campaign.objects.create()
+        for campaign, minutes, impressions in (
+                (self.first, 10, 10), (self.first, 50, 30),
+                (self.first, 150, 5), (self.second, 75, 7)):
+            stats = CampaignStats.objects.create(
+                campaign=campaign, impressions=impressions,
+                spend=impressions * 2
+            )
+            CampaignStats.objects.filter(pk=stats.pk).update(
+                created=self.start + timedelta(minutes=minutes)
+            )
+
+    def hour(self, hours):
+        return self.start + timedelta(hours=hours)
+
+    def minutes(self, created):
+        start = numpy.datetime64(self.start.replace(tzinfo=None), 'us')
+        return (created - start).astype('timedelta64[m]').astype(int).tolist()
+
+    def test_to_arrays(self):
+        arrays = Campaign.objects.to_arrays('stats')
+        self.assertEqual(
+            list(arrays), ['campaign', 'created', 'impressions', 'spend']
+        )
+        self.assertEqual(arrays['campaign'].tolist(), [
+            self.first.pk, self.first.pk, self.first.pk, self.second.pk
+        ])
+        self.assertEqual(arrays['created'].dtype, numpy.dtype('<M8[us]'))
+        self.assertEqual(self.minutes(arrays['created']), [10, 50, 150, 75])
+        self.assertEqual(arrays['impressions'].dtype, numpy.int64)
+        self.assertEqual(arrays['impressions'].tolist(), [10, 30, 5, 7])
+        self.assertEqual(arrays['spend'].tolist(), [20.0, 60.0, 10.0, 14.0])
+
+    def test_to_arrays_range_and_chunks(self):
+        arrays = Campaign.objects.filter(pk=self.first.pk).to_arrays(
+            'stats', fields=['spend'], start=self.hour(0), end=self.hour(2),
+            chunk_size=1
+        )
+        self.assertEqual(list(arrays), ['campaign', 'created', 'spend'])
+        self.assertEqual(arrays['spend'].tolist(), [20.0, 60.0])
+
+    def test_to_arrays_grouped(self):
+        grouped = Campaign.objects.to_arrays(
+            'stats', fields=['impressions'], group_by_owner=True
+        )
+        self.assertEqual(set(grouped), {self.first.pk, self.second.pk})
+        self.assertEqual(
+            self.minutes(grouped[self.first.pk]['created']), [10, 50, 150]
+        )
+        self.assertEqual(grouped[self.second.pk]['impressions'].tolist(), [7])
+        self.assertEqual(
+            Campaign.objects.none().to_arrays('stats', group_by_owner=True),
+            {}
+        )
+
+    def test_column_buffer_growth(self):
+        from timeseries.arrays import ColumnBuffer
+
+        column = ColumnBuffer('float64', capacity=2)
+        column.extend([1, None])
+        column.extend([3, 4, 5])
+        values = column.values()
+        self.assertEqual(len(values), 5)
+        self.assertTrue(numpy.isnan(values[1]))
+        self.assertEqual(values[4], 5)
+
+    @unittest.skipIf(pandas is None, 'requires pandas')
+    def test_to_dataframe(self):
+        frame = Campaign.objects.to_dataframe('stats', fields=['spend'])
+        self.assertEqual(
+            list(frame.columns), ['campaign', 'created', 'spend']
+        )
+        self.assertEqual(frame['spend'].sum(), 104.0)
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        Ad.objects.bulk_create([Ad() for _ in range(5)])
+        Ad.objects.update_rawdata()
+
+    def update_weekly(self, **kwargs):
+        return Ad.objects.update_timeseries('weeklyreports', **kwargs)
+
+    def test_rollup(self):
+        output = self.update_weekly()
+        self.assertIsInstance(output, UpdateSummary)
+        self.assertEqual(output.rows, 5)
+        for report in WeeklyAdReport.objects.select_related('ad'):
+            self.assertEqual(report.avg_views, report.ad.id)
+            self.assertEqual(report.total_clicks, report.ad.id)
+            self.assertEqual(report.samples, 1)
+            self.assertEqual(report.notes, 'rollup')
+
+        # nothing is outdated
+        self.assertEqual(self.update_weekly().rows, 0)
+        # forced, but there's no new raw data
+        self.assertEqual(self.update_weekly(force=True).rows, 0)
+        self.assertEqual(WeeklyAdReport.objects.count(), 5)
+
+    def test_rollup_is_incremental(self):
+        self.update_weekly()
+        Ad.objects.update_rawdata(force=True)
+        Ad.objects.update_rawdata(force=True)
+        RawAdData.objects.filter(
+            created__gt=WeeklyAdReport.objects.latest().created
+        ).update(views=100, clicks=3)
+
+        next_week = utcnow() + WeeklyAdReport.TIMESERIES_INTERVAL
+        with time_machine(next_week):
+            output = self.update_weekly()
+        self.assertEqual(output.rows, 5)
+        for ad in Ad.objects.all():
+            report = ad.weeklyreports.latest()
+            self.assertEqual(report.created, next_week)
+            self.assertEqual(report.samples, 2)
+            self.assertEqual(report.avg_views, 100)
+            self.assertEqual(report.total_clicks, 6)
+
+    def test_rollup_watermark(self):
+        first = Ad.objects.order_by('id').first()
+        raw = first.rawdata.get()
+        tomorrow = utcnow() + timedelta(days=1)
+        with time_machine(tomorrow):
+            self.update_weekly()
+        report = first.weeklyreports.get()
+        self.assertEqual(report.created, tomorrow)
+        self.assertEqual(report.rollup_end, raw.created)
+
+        # backfilled after the rollup ran, but newer than its source rows
+        backfilled = first.rawdata.create(views=10, clicks=1)
+        RawAdData.objects.filter(pk=backfilled.pk).update(
+            created=raw.created + timedelta(hours=1)
+        )
+        with time_machine(tomorrow + timedelta(days=8)):
+            self.assertEqual(self.update_weekly().rows, 1)
+        report = first.weeklyreports.latest()
+        self.assertEqual((report.samples, report.avg_views), (1, 10))
+        self.assertEqual(report.rollup_end, raw.created + timedelta(hours=1))
+
+        # backfilled at or before the watermark, never rolled up
+        late = first.rawdata.create(views=20, clicks=2)
+        RawAdData.objects.filter(pk=late.pk).update(created=raw.created)
+        with time_machine(tomorrow + timedelta(days=16)):
+            self.assertEqual(self.update_weekly().rows, 0)
+        self.assertEqual(first.weeklyreports.latest(), report)
+
+    def test_rollup_only_outdated(self):
+        first = Ad.objects.order_by('id').first()
+        Ad.objects.filter(pk=first.pk).update_timeseries('weeklyreports')
+        self.assertEqual(self.update_weekly().rows, 4)
+        self.assertEqual(
+            WeeklyAdReport.objects.values('ad').distinct().count(), 5
+        )
+
+    def test_collector_required(self):
+        with self.assertRaises(ValueError):
+            Ad.objects.update_timeseries('rawdata')
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        self.now = utcnow()
+        self.first = Campaign.objects.create()
+        self.second = Campaign.objects.create()
+        for days in (10, 5, 3, 1):
+            self.add_stats(self.first, days)
+        self.add_stats(self.second, 7)
+        self.add_stats(self.second, 6)
+
+    def add_stats(self, campaign, days_ago):
+        stats = CampaignStats.objects.create(
+            campaign=campaign, impressions=days_ago, spend=1
+        )
+        CampaignStats.objects.filter(pk=stats.pk).update(
+            created=self.now - timedelta(days=days_ago)
+        )
+
+    def days_ago(self, campaign):
+        return sorted(
+            (self.now - created).days for created in
+            campaign.stats.values_list('created', flat=True)
+        )
+
+    def test_prune_timeseries(self):
+        self.assertEqual(prune_timeseries(CampaignStats, batch_size=1), 4)
+        self.assertEqual(self.days_ago(self.first), [1])
+        # the latest row is kept even though it has expired
+        self.assertEqual(self.days_ago(self.second), [6])
+
+        # the expired rows were downsampled before being deleted
+        first = self.first.dailystats.get()
+        self.assertEqual(first.impressions, 10 + 5 + 3 + 1)
+        self.assertEqual(first.spend, 4)
+        self.assertEqual(self.second.dailystats.get().impressions, 13)
+
+        self.assertEqual(prune_timeseries(CampaignStats), 0)
+        self.assertEqual(DailyCampaignStats.objects.count(), 2)
+
+    def test_prune_without_retention(self):
+        Ad.objects.create()
+        Ad.objects.update_rawdata()
+        self.assertEqual(prune_timeseries(RawAdData), 0)
+        self.assertEqual(RawAdData.objects.count(), 1)
+
+    def test_prune_command(self):
+        call_command('timeseries_prune', batch_size=2, verbosity=0)
+        self.assertEqual(CampaignStats.objects.count(), 2)
+        call_command('timeseries_prune', 'tests.CampaignStats', verbosity=0)
+        self.assertEqual(CampaignStats.objects.count(), 2)
+
+
+class UpsertTests(TestCase):
+
+    def setUp(self):
+        for _ in range(5):
+            Ad.objects.create()
+        self.now = floor_bucket(utcnow(), 3600) + timedelta(minutes=30)
+
+    def update(self, views, force=True, repeat=1, **kwargs):
+        def collector(queryset):
+            for ad in queryset:
+                for _ in range(repeat):
+                    yield {'ad': ad, 'views': views}
+        return Ad.objects.update_timeseries(
+            'hourlydata', collector, force=force, **kwargs
+        )
+
+    def test_interval_bucket(self):
+        field = HourlyAdData._meta.get_field('interval_bucket')
+        self.assertIsInstance(field, IntervalBucketField)
+        self.assertIn(
+            ('ad', 'interval_bucket'), HourlyAdData._meta.unique_together
+        )
+        with self.assertRaises(FieldDoesNotExist):
+            RawAdData._meta.get_field('interval_bucket')
+
+        data = HourlyAdData.objects.create(ad=Ad.objects.first())
+        self.assertEqual(
+            data.interval_bucket, floor_bucket(data.created, 3600)
+        )
+
+    def test_update(self):
+        with time_machine(self.now):
+            output = self.update(1)
+            self.assertIsInstance(output, UpdateSummary)
+            self.assertEqual(output.rows, 5)
+            # a retry in the same interval replaces the rows
+            self.update(2, batch_size=2)
+            # rows of the same owner and interval are merged
+            self.update(3, repeat=2)
+        self.assertEqual(HourlyAdData.objects.count(), 5)
+        self.assertEqual(
+            set(HourlyAdData.objects.values_list('views', flat=True)), {3}
+        )
+        buckets = HourlyAdData.objects.values_list(
+            'interval_bucket', flat=True
+        )
+        self.assertEqual(set(buckets), {floor_bucket(self.now, 3600)})
+
+        with time_machine(self.now + timedelta(hours=1)):
+            self.update(4)
+            # nothing is outdated
+            self.assertEqual(self.update(5, force=False).rows, 0)
+        self.assertEqual(HourlyAdData.objects.count(), 10)
+        self.assertEqual(
+            [ad.latest_hourlydata.views for ad in
+             Ad.objects.prefetch_latest('hourlydata')],
+            [4] * 5
+        )
+
+    def test_ignore(self):
+        with mock.patch.object(HourlyAdData, 'TIMESERIES_UPSERT', 'ignore'), \
+                time_machine(self.now):
+            self.update(1)
+            self.update(2)
+        self.assertEqual(HourlyAdData.objects.count(), 5)
+        self.assertEqual(
+            set(HourlyAdData.objects.values_list('views', flat=True)), {1}
+        )
+
+    def test_upsert_backend(self):
+        with self.assertRaises(TypeError):
+            Ad.objects.update_timeseries(
+                'rawdata', ad_data_collector, backend='upsert'
+            )
+        with mock.patch.object(HourlyAdData, 'TIMESERIES_UPSERT', 'merge'):
+            with self.assertRaises(ValueError):
+                self.update(1)
+        # another backend can still be picked explicitly
+        with time_machine(self.now):
+            self.update(1)
+            output = self.update(2, backend='bulk_create')
+        self.assertEqual(len(output.failures), 1)
+        self.assertEqual(HourlyAdData.objects.count(), 5)
+        with mock.patch.object(HourlyAdData, 'TIMESERIES_PARTITION', 86400):
+            with self.assertRaises(TypeError):
+                partition_table(HourlyAdData)
+
+
+class BlockTests(TestCase):
+
+    def setUp(self):
+        self.first = Ad.objects.create()
+        self.second = Ad.objects.create()
+        self.start = datetime(2020, 1, 1, tzinfo=utc)
+
+    def minute(self, minutes):
+        return self.start + timedelta(minutes=minutes)
+
+    def write(self, *points):
+        # points are (ad, minutes, views) tuples
+        def collector(queryset):
+            for ad, minutes, views in points:
+                yield {
+                    'ad': ad, 'created': self.minute(minutes),
+                    'views': views, 'ctr': views / 100.0
+                }
+        return Ad.objects.update_timeseries(
+            'minutedata', collector, force=True
+        )
+
+    def test_codec(self):
+        times = [
+            self.minute(minutes) + timedelta(microseconds=minutes % 7)
+            for minutes in range(1440)
+        ]
+        views = [minutes * 3 + minutes % 5 for minutes in range(1440)]
+        for values, kind in ((times, 'datetime'), (views, 'int64'),
+                             ([-1, 2 ** 63 - 1, -2 ** 63], 'int64'),
+                             ([0.5, -1e300, 3.25], 'float64'), ([], 'int64')):
+            self.assertEqual(blocks.decode(blocks.encode(values, kind), kind),
+                             values)
+        # a tenth of the 16 bytes per point of the raw values
+        encoded = blocks.encode(times, 'datetime') + \
+            blocks.encode(views, 'int64')
+        self.assertLess(len(encoded), 1440 * 16 / 10)
+        nan, value = blocks.decode(
+            blocks.encode([None, 1.5], 'float64'), 'float64'
+        )
+        self.assertNotEqual(nan, nan)
+        self.assertEqual(value, 1.5)
+        with self.assertRaises(ValueError):
+            BlockField('int32')
+
+    def test_write_blocks(self):
+        self.assertIn(('ad', 'start'), MinuteAdData._meta.unique_together)
+        output = self.write((self.first, 0, 1), (self.second, 1, 5))
+        self.assertIsInstance(output, UpdateSummary)
+        self.assertEqual(output.rows, 2)
+        # appended to the open blocks, replacing the point of minute 1
+        self.write(
+            (self.first, 2, 3), (self.first, 1, 2), (self.second, 1, 6),
+            (self.second, 61, 7)
+        )
+        self.assertEqual(MinuteAdData.objects.count(), 3)
+        block = MinuteAdData.objects.get(ad=self.first)
+        self.assertEqual(block.start, self.start)
+        self.assertEqual(block.size, 3)
+        self.assertEqual(block.created, self.minute(2))
+        points = block.decode()
+        self.assertEqual(
+            points['created'], [self.minute(0), self.minute(1), self.minute(2)]
+        )
+        self.assertEqual(points['views'], [1, 2, 3])
+        self.assertEqual(points['ctr'], [0.01, 0.02, 0.03])
+        self.assertEqual(
+            MinuteAdData.objects.get(ad=self.second, start=self.start)
+            .decode()['views'], [6]
+        )
+
+        ads = Ad.objects.last_updated('minutedata').prefetch_latest(
+            'minutedata'
+        ).order_by('pk')
+        self.assertEqual(
+            [ad.minutedata_last_updated for ad in ads],
+            [self.minute(2), self.minute(61)]
+        )
+        self.assertEqual(
+            [ad.latest_minutedata.latest_point() for ad in ads], [
+                {'created': self.minute(2), 'views': 3, 'ctr': 0.03},
+                {'created': self.minute(61), 'views': 7, 'ctr': 0.07},
+            ]
+        )
+
+    def test_write_blocks_concurrently(self):
+        from timeseries import writers
+        insert_rows = writers.insert_rows
+        raced = []
+
+        def racing_insert_rows(rev_rel, rows, using, mode=None, **kwargs):
+            if mode == 'ignore' and not raced:
+                # another writer creates the block after it was found
+                # missing, before the empty block is inserted
+                raced.append(True)
+                self.write((self.first, 1, 2))
+            return insert_rows(rev_rel, rows, using, mode, **kwargs)
+
+        with mock.patch.object(writers, 'insert_rows', racing_insert_rows):
+            self.write((self.first, 0, 1))
+        block = MinuteAdData.objects.get(ad=self.first)
+        self.assertEqual(block.decode()['views'], [1, 2])
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            Ad.objects.annotate_latest('minutedata', 'views')
+        with self.assertRaises(TypeError):
+            Ad.objects.find_gaps('minutedata')
+        with self.assertRaises(TypeError):
+            Ad.objects.update_timeseries(
+                'rawdata', ad_data_collector, backend='block'
+            )
+        with mock.patch.object(MinuteAdData, 'TIMESERIES_PARTITION', 3600):
+            with self.assertRaises(TypeError):
+                create_partitions(MinuteAdData)
+
+    def test_invalid_points(self):
+        def collector(queryset):
+            # views is missing from the first ad's point
+            yield {'ad': self.first, 'created': self.start}
+            yield {'ad': self.second, 'created': self.start, 'views': 2}
+
+        output = Ad.objects.update_timeseries(
+            'minutedata', collector, batch_size=1
+        )
+        self.assertEqual((output.rows, output.batches), (1, 1))
+        self.assertEqual(len(output.failures), 1)
+        number, error = output.failures[0]
+        self.assertEqual(number, 0)
+        self.assertIsInstance(error, DataError)
+        block = MinuteAdData.objects.get()
+        self.assertEqual(block.ad_id, self.second.pk)
+        # missing floats are stored as NaN
+        ctr, = block.decode()['ctr']
+        self.assertNotEqual(ctr, ctr)
+        for value, kind in ((None, 'int64'), (2 ** 63, 'int64'),
+                            ('1', 'float64'), (self.start.date(), 'datetime')):
+            self.assertFalse(blocks.is_valid(value, kind))
+
+    @unittest.skipIf(numpy is None, 'requires NumPy')
+    def test_to_arrays(self):
+        from timeseries.arrays import decode_array
+
+        self.write(
+            (self.first, 0, 1), (self.first, 30, 2), (self.first, 70, 4),
+            (self.second, 65, 8)
+        )
+        block = MinuteAdData.objects.get(ad=self.first, start=self.start)
+        self.assertEqual(
+            decode_array(block.views, 'int64').tolist(), [1, 2]
+        )
+        self.assertEqual(
+            decode_array(block.ctr, 'float64').tolist(), [0.01, 0.02]
+        )
+
+        arrays = Ad.objects.to_arrays('minutedata')
+        self.assertEqual(list(arrays), ['ad', 'created', 'views', 'ctr'])
+        self.assertEqual(arrays['ad'].tolist(), [
+            self.first.pk, self.first.pk, self.first.pk, self.second.pk
+        ])
+        self.assertEqual(arrays['created'].dtype, numpy.dtype('<M8[us]'))
+        self.assertEqual(arrays['views'].tolist(), [1, 2, 4, 8])
+        arrays = Ad.objects.to_arrays('minutedata', chunk_size=1)
+        self.assertEqual(arrays['views'].tolist(), [1, 2, 4, 8])
+        with self.assertRaises(ValueError):
+            Ad.objects.to_arrays('minutedata', chunk_size=-1)
+
+        arrays = Ad.objects.to_arrays(
+            'minutedata', fields=['views'], start=self.minute(30),
+            end=self.minute(70)
+        )
+        self.assertEqual(arrays['views'].tolist(), [2, 8])
+        grouped = Ad.objects.filter(pk=self.second.pk).to_arrays(
+            'minutedata', group_by_owner=True
+        )
+        self.assertEqual(grouped[self.second.pk]['ctr'].tolist(), [0.08])
+        empty = Ad.objects.none().to_arrays('minutedata')
+        self.assertEqual(empty['created'].dtype, numpy.dtype('<M8[us]'))
+        self.assertEqual(len(empty['views']), 0)
+        with self.assertRaises(ValueError):
+            Ad.objects.to_arrays('minutedata', fields=['size'])
+
+    @unittest.skipIf(numpy is None, 'requires NumPy')
+    def test_resample(self):
+        self.write(
+            (self.first, 0, 1), (self.first, 30, 3), (self.first, 130, 4),
+            (self.second, 65, 8)
+        )
+        rows = Ad.objects.resample(
+            'minutedata', {'views': Sum, 'ctr': Avg, 'points': Count('id')}
+        )
+        self.assertEqual(rows, [
+            {'ad': self.first.pk, 'bucket': self.minute(0),
+             'views__sum': 4, 'ctr__avg': 0.02, 'points': 2},
+            {'ad': self.first.pk, 'bucket': self.minute(120),
+             'views__sum': 4, 'ctr__avg': 0.04, 'points': 1},
+            {'ad': self.second.pk, 'bucket': self.minute(60),
+             'views__sum': 8, 'ctr__avg': 0.08, 'points': 1},
+        ])
+        rows = Ad.objects.filter(pk=self.second.pk).resample(
+            'minutedata', {'peak': Max('views')}, start=self.start,
+            end=self.minute(120), fill=True
+        )
+        self.assertEqual(rows, [
+            {'ad': self.second.pk, 'bucket': self.minute(0), 'peak': None},
+            {'ad': self.second.pk, 'bucket': self.minute(60), 'peak': 8},
+        ])
+        with self.assertRaises(ValueError):
+            Ad.objects.resample('minutedata', {'size': Sum})
+
+
+class LatestCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        for _ in range(3):
+            Ad.objects.create()
+        self.empty = Ad.objects.create()
+        self.ads = Ad.objects.exclude(pk=self.empty.pk)
+        patcher = mock.patch.object(RawAdData, 'TIMESERIES_CACHE', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+
+    def update(self, views):
+        def collector(queryset):
+            for ad in queryset:
+                yield {'ad': ad, 'views': views, 'clicks': ad.id}
+        return self.ads.update_timeseries('rawdata', collector, force=True)
+
+    def latest(self, queryset=None):
+        queryset = Ad.objects.all() if queryset is None else queryset
+        return dict(
+            (ad.pk, ad.latest_rawdata and ad.latest_rawdata.views)
+            for ad in queryset.prefetch_latest('rawdata')
+        )
+
+    def test_read_through(self):
+        self.update(1)
+        caches['default'].clear()
+        expected = dict((ad.pk, 1) for ad in self.ads)
+        expected[self.empty.pk] = None
+        # the owners and the latest rows of the misses
+        with self.assertNumQueries(2):
+            self.assertEqual(self.latest(), expected)
+        # only the owners, owners without data are cached too
+        with self.assertNumQueries(1):
+            self.assertEqual(self.latest(), expected)
+        with self.assertNumQueries(1):
+            ad = Ad.objects.prefetch_latest('rawdata').get(pk=self.empty.pk)
+        self.assertIsNone(ad.latest_rawdata)
+        ad = Ad.objects.prefetch_latest('rawdata').get(pk=self.ads[0].pk)
+        self.assertIsInstance(ad.latest_rawdata, RawAdData)
+        self.assertEqual(ad.latest_rawdata.clicks, ad.pk)
+        self.assertEqual(
+            ad.latest_rawdata.created, ad.rawdata.latest().created
+        )
+
+    def test_write_through(self):
+        self.update(1)
+        first = RawAdData.objects.latest().created
+        with time_machine(utcnow() + timedelta(seconds=1)):
+            self.update(2)
+        # point in time lookups bypass the cache
+        ads = Ad.objects.exclude(pk=self.empty.pk).prefetch_latest(
+            'rawdata', as_of=first
+        )
+        self.assertEqual(set(ad.latest_rawdata.views for ad in ads), {1})
+        with self.assertNumQueries(2):
+            chunks = list(
+                Ad.objects.prefetch_latest('rawdata').iter_chunks(2)
+            )
+        self.assertEqual(
+            [ad.latest_rawdata.views for ad in chunks[0]], [2, 2]
+        )
+        # batched updates refresh the cache as well
+        with time_machine(utcnow() + timedelta(seconds=2)):
+            self.ads.update_timeseries(
+                'rawdata', ad_data_collector, force=True, batch_size=2
+            )
+        with self.assertNumQueries(1):
+            latest = self.latest(Ad.objects.exclude(pk=self.empty.pk))
+        self.assertEqual(latest, dict((pk, pk) for pk in latest))
+
+    @unittest.skipIf(django.VERSION[:2] < (1, 10), 'requires Django 1.10+')
+    def test_cache_fields(self):
+        with mock.patch.object(RawAdData, 'TIMESERIES_CACHE_FIELDS',
+                               ['views']):
+            self.update(1)
+            ad = Ad.objects.prefetch_latest('rawdata').get(pk=self.ads[0].pk)
+        self.assertEqual(ad.latest_rawdata.views, 1)
+        self.assertEqual(
+            ad.latest_rawdata.get_deferred_fields(), {'clicks'}
+        )
+
+
+class PartitionTests(TestCase):
+
+    def setUp(self):
+        self.now = utcnow()
+        self.ad = Ad.objects.create()
+        for days in (5, 4, 1, 0):
+            self.add_data(days)
+
+    def add_data(self, days_ago):
+        data = PartitionedAdData.objects.create(ad=self.ad, views=days_ago)
+        PartitionedAdData.objects.filter(pk=data.pk).update(
+            created=self.now - timedelta(days=days_ago)
+        )
+
+    @unittest.skipIf(
+        connection.vendor == 'postgresql',
+        'Partitioning is supported on PostgreSQL'
+    )
+    def test_partitioning_unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            partition_table(PartitionedAdData)
+        with self.assertRaises(TypeError):
+            create_partitions(RawAdData)
+        # pruning falls back to batched deletes
+        self.assertEqual(prune_timeseries(PartitionedAdData), 2)
+
+
+@unittest.skipUnless(
+    connection.vendor == 'postgresql' and
+    connection.pg_version >= 110000,
+    'Declarative partitioning requires PostgreSQL 11+'
+)
+class PostgresPartitionTests(PartitionTests):
+
+    def setUp(self):
+        partition_table(PartitionedAdData)
+        partition_table(PartitionedCampaignAdData)
+        super(PostgresPartitionTests, self).setUp()
+
+    def test_partition_table(self):
+        self.assertTrue(is_partitioned(PartitionedAdData))
+        self.assertFalse(is_partitioned(RawAdData))
+        self.assertEqual(get_partitions(PartitionedAdData), [])
+        # converting twice is a no-op
+        partition_table(PartitionedAdData)
+
+        created = create_partitions(PartitionedAdData, ahead=1)
+        # rows older than the retention stay in the default partition
+        self.assertEqual(len(created), 3 + 1 + 1)
+        self.assertEqual(create_partitions(PartitionedAdData, ahead=1), [])
+        self.assertEqual(PartitionedAdData.objects.count(), 4)
+        ad = Ad.objects.prefetch_latest('partitioneddata').get()
+        self.assertEqual(ad.partitioneddata.get().views, 0)
+
+    def test_partition_table_constraints(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = to_regclass(%s) AND contype = 'u'",
+                [PartitionedCampaignAdData._meta.db_table]
+            )
+            self.assertEqual(
+                [row[0] for row in cursor.fetchall()],
+                ['UNIQUE (reference, created)']
+            )
+        campaign = Campaign.objects.create()
+        PartitionedCampaignAdData.objects.create(
+            ad=self.ad, campaign=campaign, reference='a'
+        )
+        self.assertEqual(
+            self.ad.partitionedcampaigndata.get().campaign, campaign
+        )
+
+    def test_drop_expired_partitions(self):
+        create_partitions(PartitionedAdData, ahead=0)
+        later = self.now + timedelta(days=3)
+        with time_machine(later):
+            dropped = drop_expired_partitions(PartitionedAdData)
+        self.assertEqual(len(dropped), 3)
+        self.assertEqual(len(get_partitions(PartitionedAdData)), 1)
+        # rows older than the retention live in the default partition and
+        # are left to prune_timeseries
+        self.assertEqual(
+            sorted(PartitionedAdData.objects.values_list('views', flat=True)),
+            [0, 4, 5]
+        )
+
+    def test_drop_expired_partitions_keeps_latest(self):
+        create_partitions(PartitionedAdData, ahead=0)
+        self.ad.partitioneddata.filter(views=0).delete()
+        with time_machine(self.now + timedelta(days=3)):
+            drop_expired_partitions(PartitionedAdData)
+            self.assertEqual(
+                sorted(self.ad.partitioneddata.values_list(
+                    'views', flat=True
+                )),
+                [1, 4, 5]
+            )
+            self.assertEqual(prune_timeseries(PartitionedAdData), 2)
+        self.assertEqual(self.ad.partitioneddata.get().views, 1)
+
+    def test_drop_expired_partitions_keeps_latest_of_any_owner(self):
+        campaign = Campaign.objects.create()
+        other = Ad.objects.create()
+        # the older row is the latest of self.ad but not of the campaign
+        for days_ago, ad in ((2, self.ad), (1, other)):
+            data = PartitionedCampaignAdData.objects.create(
+                ad=ad, campaign=campaign, reference=str(days_ago)
+            )
+            PartitionedCampaignAdData.objects.filter(pk=data.pk).update(
+                created=self.now - timedelta(days=days_ago)
+            )
+        create_partitions(PartitionedCampaignAdData, ahead=0)
+        with time_machine(self.now + timedelta(days=3)):
+            dropped = drop_expired_partitions(PartitionedCampaignAdData)
+        self.assertEqual(len(dropped), 2)
+        self.assertEqual(
+            sorted(PartitionedCampaignAdData.objects.values_list(
+                'reference', flat=True
+            )),
+            ['1', '2']
+        )
+
+    def test_partitions_command(self):
+        call_command('timeseries_partitions', ahead=0, verbosity=0)
+        self.assertEqual(len(get_partitions(PartitionedAdData)), 4)
+        with self.assertRaises(CommandError):
+            call_command('timeseries_partitions', 'tests.RawAdData')
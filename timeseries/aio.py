@@ -0,0 +1,140 @@
+"""
+    asyncio support for update_timeseries collectors.
+
+    N.B. requires Python 3.5+ and is only imported by timeseries.utils when an
+    async collector is given.
+"""
+import asyncio
+import inspect
+import threading
+
+DEFAULT_CONCURRENCY = 100
+
+_DONE = object()
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_async_results(collector, queryset, concurrency=None):
+    """
+        Runs an async collector on an event loop in a background thread and
+        yields the dictionaries it produces in the calling thread, so that
+        model instantiation and bulk_create calls happen off the event loop
+        and on the caller's database connection.
+
+        Coroutine function collectors are called once per instance of the
+        queryset, with at most "concurrency" calls in flight at any time, and
+        must return a dictionary, an iterable of dictionaries or None.
+
+        Async generator function collectors are called with the queryset, in
+        the same way as synchronous collectors.
+
+        N.B. the queryset is evaluated in the calling thread before the event
+        loop starts. Collectors should not run further database queries as
+        these would be made from the event loop's thread.
+    """
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY
+    if concurrency < 1:
+        raise ValueError('concurrency must be a positive integer')
+
+    owners = list(queryset)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    def call(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    try:
+        output = call(_make_queue(concurrency * 2))
+        task = call(
+            _start(collector, queryset, owners, concurrency, output)
+        )
+        try:
+            while True:
+                for item in call(_drain(output, concurrency)):
+                    if item is _DONE:
+                        return
+                    if isinstance(item, _Failure):
+                        raise item.error
+                    yield item
+        finally:
+            call(_cancel(task))
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _make_queue(maxsize):
+    # the queue must be created on the loop it is used by
+    return asyncio.Queue(maxsize=maxsize)
+
+
+async def _start(collector, queryset, owners, concurrency, output):
+    return asyncio.ensure_future(
+        _produce(collector, queryset, owners, concurrency, output)
+    )
+
+
+async def _cancel(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+async def _drain(output, limit):
+    # hands items over to the calling thread in chunks to amortise the cost
+    # of crossing threads
+    items = [await output.get()]
+    while len(items) < limit and not output.empty():
+        items.append(output.get_nowait())
+    return items
+
+
+async def _produce(collector, queryset, owners, concurrency, output):
+    try:
+        if inspect.iscoroutinefunction(collector):
+            await _gather_per_instance(collector, owners, concurrency, output)
+        else:
+            async for data in collector(queryset):
+                await output.put(data)
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        await output.put(_Failure(err))
+    else:
+        await output.put(_DONE)
+
+
+async def _gather_per_instance(collector, owners, concurrency, output):
+    pending = iter(owners)
+
+    async def worker():
+        for owner in pending:
+            result = await collector(owner)
+            if result is None:
+                continue
+            if isinstance(result, dict):
+                result = [result]
+            for data in result:
+                await output.put(data)
+
+    tasks = [
+        asyncio.ensure_future(worker())
+        for _ in range(min(concurrency, len(owners)))
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
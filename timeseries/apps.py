@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class TimeSeriesConfig(AppConfig):
+
+    name = 'timeseries'
+    verbose_name = 'TimeSeries'
+
+    def ready(self):
+        from timeseries.checks import check_latest_indexes
+        checks.register(check_latest_indexes, checks.Tags.models)
@@ -0,0 +1,280 @@
+"""
+    Columnar NumPy and pandas export of timeseries relations, and the
+    vectorized decoding of TimeSeriesBlockModel blocks.
+
+    N.B. requires NumPy (and pandas for to_dataframe) and is only imported by
+    timeseries.utils when TimeSeriesQuerySet.to_arrays or to_dataframe are
+    called, or resample on a block relation.
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from itertools import islice
+import zlib
+
+import numpy as np
+import django
+from django.conf import settings
+from django.utils.timezone import utc
+
+from timeseries.blocks import EPOCH, WORD_SIZE
+
+DEFAULT_CHUNK_SIZE = 2000
+
+INITIAL_CAPACITY = 1024
+
+BLOCK_DTYPES = {
+    'datetime': 'datetime64[us]',
+    'int64': 'int64',
+    'float64': 'float64',
+}
+
+RESAMPLE_FUNCTIONS = ('Avg', 'Count', 'Max', 'Min', 'Sum')
+
+DTYPES = {
+    'AutoField': 'int64',
+    'BigAutoField': 'int64',
+    'BigIntegerField': 'int64',
+    'IntegerField': 'int64',
+    'PositiveIntegerField': 'int64',
+    'PositiveSmallIntegerField': 'int64',
+    'SmallIntegerField': 'int64',
+    'FloatField': 'float64',
+    'DecimalField': 'float64',
+    'BooleanField': 'bool',
+    'DateTimeField': 'datetime64[us]',
+}
+
+
+class ColumnBuffer(object):
+    """
+        Preallocated NumPy array that doubles its capacity when full.
+    """
+
+    def __init__(self, dtype, convert=None, capacity=INITIAL_CAPACITY):
+        self.array = np.empty(capacity, dtype=dtype)
+        self.convert = convert
+        self.size = 0
+
+    def extend(self, values):
+        if self.convert is not None:
+            values = [self.convert(value) for value in values]
+        end = self.size + len(values)
+        if end > len(self.array):
+            array = np.empty(max(end, len(self.array) * 2), self.array.dtype)
+            array[:self.size] = self.array[:self.size]
+            self.array = array
+        self.array[self.size:end] = values
+        self.size = end
+
+    def values(self):
+        # drops the unused capacity
+        if self.size == len(self.array):
+            return self.array
+        return self.array[:self.size].copy()
+
+
+def get_column(field):
+    """
+        Returns a ColumnBuffer of the NumPy dtype matching the model field.
+        Nullable integer fields are stored as floats (None becomes NaN) and
+        nullable booleans and unknown field types as objects.
+    """
+    if field.is_relation:
+        field = field.foreign_related_fields[0]
+    dtype = DTYPES.get(field.get_internal_type(), 'object')
+    if field.null and dtype == 'int64':
+        dtype = 'float64'
+    elif field.null and dtype == 'bool':
+        dtype = 'object'
+    convert = to_naive_utc if dtype.startswith('datetime64') else None
+    return ColumnBuffer(dtype, convert)
+
+
+def to_naive_utc(value):
+    # NumPy's datetime64 has no timezone support
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(utc).replace(tzinfo=None)
+
+
+def fetch_arrays(queryset, names, fields, chunk_size=None):
+    """
+        Streams the values of the given fields of the queryset into an
+        ordered dictionary of arrays keyed by names. The queryset is iterated
+        with .iterator(), which uses a server-side cursor on PostgreSQL with
+        Django 1.11+, and only chunk_size rows are materialised as tuples at
+        a time. Django 2.0+ also fetches chunk_size rows per round trip,
+        older versions fetch their own fixed number of rows.
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    if chunk_size < 1:
+        raise ValueError('chunk size must be a positive integer')
+    columns = [get_column(field) for field in fields]
+    rows = queryset.values_list(*[field.attname for field in fields])
+    if django.VERSION[:2] < (2, 0):
+        rows = rows.iterator()
+    else:
+        rows = rows.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for column, values in zip(columns, zip(*chunk)):
+            column.extend(values)
+    return OrderedDict(
+        (name, column.values()) for name, column in zip(names, columns)
+    )
+
+
+def group_arrays(arrays, owner_name):
+    """
+        Splits a dictionary of arrays ordered by owner into a dictionary
+        mapping each owner's primary key to its own dictionary of arrays.
+    """
+    owners = arrays.pop(owner_name)
+    if not len(owners):
+        return {}
+    starts = np.concatenate((
+        [0], np.flatnonzero(owners[1:] != owners[:-1]) + 1
+    ))
+    ends = np.append(starts[1:], len(owners))
+    grouped = {}
+    for start, end in zip(starts, ends):
+        key = owners[start]
+        grouped[key.item() if hasattr(key, 'item') else key] = OrderedDict(
+            (name, array[start:end]) for name, array in arrays.items()
+        )
+    return grouped
+
+
+def decode_array(data, kind):
+    """
+        Vectorized counterpart of timeseries.blocks.decode returning an array
+        of the given kind, datetime64[us] in UTC for timestamps.
+    """
+    data = np.frombuffer(zlib.decompress(bytes(data)), dtype=np.uint8)
+    # undoes the byte shuffle, one row of bytes per word
+    words = data.reshape(WORD_SIZE, -1).T.copy().view('<u8').ravel()
+    if kind == 'float64':
+        return np.bitwise_xor.accumulate(words).view('<f8')
+    one = np.uint64(1)
+    values = np.cumsum(
+        (words >> one).astype(np.int64) ^ -(words & one).astype(np.int64)
+    )
+    if kind == 'int64':
+        return values
+    return np.cumsum(values).view('datetime64[us]')
+
+
+def fetch_block_arrays(queryset, names, fields, start=None, end=None,
+                       chunk_size=None):
+    """
+        Streams the blocks of the queryset, ordered by owner and start, into
+        an ordered dictionary of arrays keyed by names like fetch_arrays. The
+        fields are the owner's ForeignKey, the timestamps and the block
+        fields to decode. Points outside of [start, end) are dropped.
+        Django 2.0+ fetches chunk_size blocks per round trip.
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    if chunk_size < 1:
+        raise ValueError('chunk size must be a positive integer')
+    bounds = [
+        None if value is None else np.datetime64(to_naive_utc(value), 'us')
+        for value in (start, end)
+    ]
+    columns = [[] for _ in fields]
+    rows = queryset.values_list(*[field.attname for field in fields])
+    if django.VERSION[:2] < (2, 0):
+        rows = rows.iterator()
+    else:
+        rows = rows.iterator(chunk_size=chunk_size)
+    for row in rows:
+        timestamps = decode_array(row[1], 'datetime')
+        arrays = [timestamps] + [
+            decode_array(value, field.kind)
+            for field, value in zip(fields[2:], row[2:])
+        ]
+        keep = np.ones(len(timestamps), dtype=bool)
+        if bounds[0] is not None:
+            keep &= timestamps >= bounds[0]
+        if bounds[1] is not None:
+            keep &= timestamps < bounds[1]
+        if not keep.all():
+            arrays = [array[keep] for array in arrays]
+        columns[0].append(np.full(len(arrays[0]), row[0]))
+        for column, array in zip(columns[1:], arrays):
+            column.append(array)
+    arrays = OrderedDict()
+    for name, field, column in zip(names, fields, columns):
+        if column:
+            arrays[name] = np.concatenate(column)
+        elif field.is_relation:
+            arrays[name] = get_column(field).values()[:0]
+        else:
+            arrays[name] = np.empty(0, dtype=BLOCK_DTYPES[field.kind])
+    return arrays
+
+
+def resample_arrays(arrays, field_name, aggregates, seconds):
+    """
+        Aggregates arrays ordered by owner and created (see fetch_arrays) per
+        owner and epoch aligned bucket of the given width in seconds.
+
+        aggregates maps aliases to (function, field name) tuples, function
+        being one of RESAMPLE_FUNCTIONS. NaN values are ignored like NULL
+        values in SQL.
+
+        Returns a list of dictionaries holding the owner's primary key (keyed
+        by field_name), the bucket's start timestamp ("bucket") and the
+        aggregates, ordered by owner and bucket.
+    """
+    owners = arrays[field_name]
+    if not len(owners):
+        return []
+    buckets = arrays['created'].view(np.int64) // (seconds * 1000000)
+    starts = np.flatnonzero(np.concatenate(([True], (
+        (owners[1:] != owners[:-1]) | (buckets[1:] != buckets[:-1])
+    ))))
+    results = OrderedDict()
+    for alias, (function, name) in aggregates.items():
+        values = arrays[name]
+        present = np.ones(len(values), dtype=bool)
+        if values.dtype.kind == 'f':
+            present = ~np.isnan(values)
+        counts = np.add.reduceat(present.astype(np.int64), starts)
+        if function == 'Count':
+            results[alias] = counts
+        elif function == 'Min':
+            results[alias] = np.fmin.reduceat(values, starts)
+        elif function == 'Max':
+            results[alias] = np.fmax.reduceat(values, starts)
+        else:
+            totals = np.add.reduceat(np.where(present, values, 0), starts)
+            if function == 'Avg':
+                with np.errstate(invalid='ignore'):
+                    totals = totals / counts.astype(np.float64)
+            results[alias] = totals.astype(object)
+            results[alias][counts == 0] = None
+    rows = []
+    for index, position in enumerate(starts):
+        bucket = EPOCH + timedelta(seconds=int(buckets[position]) * seconds)
+        row = {
+            field_name: owners[position].item(),
+            'bucket': bucket if settings.USE_TZ else bucket.replace(
+                tzinfo=None
+            ),
+        }
+        for alias, values in results.items():
+            value = values[index]
+            if hasattr(value, 'item'):
+                value = value.item()
+            if isinstance(value, float) and value != value:
+                value = None
+            row[alias] = value
+        rows.append(row)
+    return rows
+
+
+def to_dataframe(arrays):
+    import pandas as pd
+    return pd.DataFrame(arrays, columns=list(arrays))
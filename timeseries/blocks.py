@@ -0,0 +1,156 @@
+"""
+    Compact encoding of the timestamps and values of TimeSeriesBlockModel
+    blocks.
+
+    Each array is turned into 64-bit words that are small for dense, regular
+    series: the delta of deltas of timestamps (in microseconds since the
+    epoch), the deltas of integers and the XOR of consecutive IEEE 754 bit
+    patterns of floats. Signed words are zigzag encoded so that small
+    negative numbers have zero high bytes as well, the bytes of the little
+    endian words are shuffled (every first byte, then every second byte and
+    so on) so that those zero bytes form long runs, and the result is zlib
+    compressed.
+
+    Only the standard library is used, see timeseries.arrays for the
+    vectorized NumPy decoder.
+"""
+from datetime import datetime, timedelta
+import numbers
+import struct
+import zlib
+
+from django.utils.timezone import utc
+
+KINDS = ('datetime', 'int64', 'float64')
+
+WORD_SIZE = 8
+
+MASK = (1 << 64) - 1
+
+SIGN = 1 << 63
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+
+def encode(values, kind):
+    """
+        Encodes a sequence of datetimes (naive ones are assumed to be in
+        UTC), integers or floats (None becomes NaN) as bytes.
+    """
+    if kind == 'float64':
+        words = xor_words(values)
+    elif kind == 'int64':
+        words = [zigzag(delta) for delta in deltas(values)]
+    elif kind == 'datetime':
+        microseconds = [to_microseconds(value) for value in values]
+        words = [zigzag(delta) for delta in deltas(deltas(microseconds))]
+    else:
+        raise ValueError('kind must be one of {}'.format(', '.join(KINDS)))
+    return zlib.compress(
+        shuffle(struct.pack('<{}Q'.format(len(words)), *words))
+    )
+
+
+def decode(data, kind):
+    """
+        Decodes bytes encoded by encode into a list of UTC datetimes,
+        integers or floats.
+    """
+    data = unshuffle(zlib.decompress(bytes(data)))
+    words = struct.unpack('<{}Q'.format(len(data) // WORD_SIZE), data)
+    if kind == 'float64':
+        bits = []
+        previous = 0
+        for word in words:
+            previous ^= word
+            bits.append(previous)
+        return list(struct.unpack(
+            '<{}d'.format(len(bits)), struct.pack(
+                '<{}Q'.format(len(bits)), *bits
+            )
+        ))
+    values = cumulate([unzigzag(word) for word in words])
+    if kind == 'int64':
+        return values
+    return [
+        EPOCH + timedelta(microseconds=value) for value in cumulate(values)
+    ]
+
+
+def is_valid(value, kind):
+    """
+        Returns whether encode accepts the value for the given kind: a
+        datetime, an integer within the int64 range, or a real number or
+        None for float64.
+    """
+    if kind == 'float64':
+        return value is None or isinstance(value, numbers.Real)
+    if kind == 'int64':
+        return isinstance(value, numbers.Integral) and \
+            -SIGN <= value < SIGN
+    return isinstance(value, datetime)
+
+
+def deltas(values):
+    output = []
+    previous = 0
+    for value in values:
+        value = int(value)
+        output.append(wrap(value - previous))
+        previous = value
+    return output
+
+
+def cumulate(values):
+    output = []
+    total = 0
+    for value in values:
+        total = wrap(total + value)
+        output.append(total)
+    return output
+
+
+def xor_words(values):
+    floats = [float('nan') if value is None else value for value in values]
+    bits = struct.unpack(
+        '<{}Q'.format(len(floats)),
+        struct.pack('<{}d'.format(len(floats)), *floats)
+    )
+    words = []
+    previous = 0
+    for value in bits:
+        words.append(value ^ previous)
+        previous = value
+    return words
+
+
+def wrap(value):
+    # deltas wrap around like int64 arithmetic
+    return ((value + SIGN) & MASK) - SIGN
+
+
+def zigzag(value):
+    return ((value << 1) ^ (value >> 63)) & MASK
+
+
+def unzigzag(word):
+    return (word >> 1) ^ -(word & 1)
+
+
+def shuffle(data):
+    return b''.join(data[i::WORD_SIZE] for i in range(WORD_SIZE))
+
+
+def unshuffle(data):
+    count = len(data) // WORD_SIZE
+    output = bytearray(len(data))
+    for i in range(WORD_SIZE):
+        output[i::WORD_SIZE] = data[i * count:(i + 1) * count]
+    return bytes(output)
+
+
+def to_microseconds(value):
+    epoch = EPOCH if value.tzinfo is not None else EPOCH.replace(tzinfo=None)
+    delta = value - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
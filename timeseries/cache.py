@@ -0,0 +1,144 @@
+"""
+    Read-through cache of the latest related instance of each owner.
+
+    Related models setting TIMESERIES_CACHE to the alias of a Django cache
+    have prefetch_latest read the latest instances from it first (see
+    get_cached_latest). Writes refresh the entries of the owners they touch
+    once their transaction commits (see refresh_latest_cache).
+"""
+import django
+from django.db import connections, router, transaction
+from django.utils import six
+
+from timeseries import utils
+
+
+def latest_cache_key(rev_rel, pk):
+    opts = rev_rel.field.model._meta
+    return 'timeseries:latest:{}.{}:{}:{}'.format(
+        opts.app_label, opts.model_name, rev_rel.field.name, pk
+    )
+
+
+def get_cache_fields(model):
+    """
+        Returns the attnames of the fields of the model stored in its
+        TIMESERIES_CACHE: the primary key, ForeignKeys, created and
+        TIMESERIES_CACHE_FIELDS, or every concrete field if it's None.
+    """
+    opts = model._meta
+    names = getattr(model, 'TIMESERIES_CACHE_FIELDS', None)
+    if names is None:
+        return [field.attname for field in opts.concrete_fields]
+    names = set(opts.get_field(name).attname for name in names)
+    return [
+        field.attname for field in opts.concrete_fields
+        if field.primary_key or field.many_to_one or
+        field.name == 'created' or field.attname in names
+    ]
+
+
+def get_cached_latest(queryset, rev_rel, get_latest, pks):
+    """
+        Read-through lookup of the latest related instance of the owners of
+        the queryset with the given primary keys. Cached instances are read
+        with a single get_many from the related model's TIMESERIES_CACHE,
+        the others looked up with the get_latest strategy and cached (see
+        cache_latest). Returns a dictionary mapping the owners' primary keys
+        to their latest related instance, without the owners that have none.
+    """
+    model = rev_rel.field.model
+    cache = utils.get_latest_cache(model)
+    keys = dict((latest_cache_key(rev_rel, pk), pk) for pk in pks)
+    using = router.db_for_read(model)
+    latest = {}
+    for key, values in cache.get_many(list(keys)).items():
+        pk = keys.pop(key)
+        # an empty dictionary caches the absence of related instances
+        if values:
+            latest[pk] = cached_instance(model, values, using)
+    if keys:
+        owners = queryset.model._base_manager.using(queryset.db).filter(
+            pk__in=list(keys.values())
+        )
+        latest.update(cache_latest(
+            owners, rev_rel, get_latest, list(keys.values())
+        ))
+    return latest
+
+
+def cache_latest(owners, rev_rel, get_latest=None, pks=None):
+    """
+        Looks up the latest related instance of each owner of the queryset
+        with the get_latest strategy (the connection's default if None) and
+        stores it, or its absence, in the related model's TIMESERIES_CACHE
+        for TIMESERIES_INTERVAL. pks are the owners' primary keys, looked up
+        if None. Returns a dictionary mapping primary keys to the latest
+        related instances.
+    """
+    model = rev_rel.field.model
+    if get_latest is None:
+        get_latest = utils.get_latest_strategy(connections[owners.db])
+    if pks is None:
+        pks = owners.values_list('pk', flat=True)
+    attname = rev_rel.field.attname
+    latest = dict(
+        (getattr(instance, attname), instance)
+        for instance in get_latest(owners, rev_rel)
+    )
+    names = get_cache_fields(model)
+    entries = {}
+    for pk in pks:
+        values = {}
+        instance = latest.get(pk)
+        if instance is not None:
+            for name in names:
+                value = getattr(instance, name)
+                # e.g. BinaryField values of PostgreSQL aren't picklable
+                if isinstance(value, six.memoryview):
+                    value = bytes(value)
+                values[name] = value
+        entries[latest_cache_key(rev_rel, pk)] = values
+    utils.get_latest_cache(model).set_many(
+        entries, int(utils.get_interval(model).total_seconds())
+    )
+    return latest
+
+
+def cached_instance(model, values, using):
+    """
+        Builds a model instance from the values of a cache entry. The fields
+        missing from it are deferred (Django 1.10+, they get their defaults
+        before).
+    """
+    if django.VERSION[:2] < (1, 10):
+        instance = model(**values)
+        instance._state.adding = False
+        instance._state.db = using
+        return instance
+    names = [
+        field.attname for field in model._meta.concrete_fields
+        if field.attname in values
+    ]
+    return model.from_db(using, names, [values[name] for name in names])
+
+
+def refresh_latest_cache(rev_rel, pks):
+    """
+        Helper function that refreshes the cached latest related instance
+        (if the related model sets TIMESERIES_CACHE) of the owners with the
+        given primary keys, given as an iterable or a values queryset, once
+        the current transaction commits.
+    """
+    model = rev_rel.field.model
+    if utils.get_latest_cache(model) is None:
+        return
+    using = router.db_for_write(model)
+    owners = rev_rel.model._base_manager.using(using).filter(pk__in=pks)
+    if not hasattr(transaction, 'on_commit'):
+        # Django 1.8
+        cache_latest(owners, rev_rel)
+        return
+    transaction.on_commit(
+        lambda: cache_latest(owners, rev_rel), using=using
+    )
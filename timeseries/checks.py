@@ -0,0 +1,42 @@
+from django.apps import apps
+from django.core import checks
+
+from timeseries.utils import TimeSeriesModel, has_latest_index
+
+
+def check_latest_indexes(app_configs=None, **kwargs):
+    """
+        Warns about TimeSeriesModel ForeignKeys that aren't covered by a
+        composite (owner, created) index, without which latest row lookups
+        have to scan each owner's whole history.
+    """
+    if app_configs is None:
+        models = apps.get_models()
+    else:
+        models = [
+            model for app_config in app_configs
+            for model in app_config.get_models()
+        ]
+    errors = []
+    for model in models:
+        if issubclass(model, TimeSeriesModel):
+            errors.extend(check_model_latest_indexes(model))
+    return errors
+
+
+def check_model_latest_indexes(model):
+    errors = []
+    for field in model._meta.fields:
+        if field.many_to_one and not has_latest_index(model, field):
+            errors.append(checks.Warning(
+                '{}.{} has no composite ({}, created) index.'.format(
+                    model.__name__, field.name, field.name
+                ),
+                hint=(
+                    'Set TIMESERIES_INDEX = True or add an index on '
+                    "['{}', '-created'] to Meta.indexes.".format(field.name)
+                ),
+                obj=model,
+                id='timeseries.W001',
+            ))
+    return errors
@@ -0,0 +1,306 @@
+"""
+    Instrumentation of the timeseries pipeline.
+
+    Phases (see PHASES) are measured only while a metrics sink is registered
+    or phase_finished (timeseries.signals) has receivers. Each measured phase
+    emits a PhaseEvent holding its wall clock duration, the number of queries
+    run and the time spent in them on the phase's database, and the rows,
+    owners and errors it handled.
+"""
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from timeit import default_timer
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from timeseries.signals import phase_finished
+
+PHASES = (
+    # a whole update_timeseries call
+    'update',
+    # evaluating a filter_outdated queryset
+    'filter_outdated',
+    # time spent inside the collector, cumulated over its iteration. Phases
+    # nest, so this includes the filter_outdated evaluation triggered by the
+    # collector iterating its queryset
+    'collect',
+    # instantiating related models for bulk_create
+    'instantiate',
+    # writing a batch with the write backend
+    'write',
+    # prefetch_latest queries
+    'prefetch_latest',
+)
+
+_sinks = []
+
+
+class PhaseEvent(namedtuple('PhaseEvent', (
+        'phase model related_name duration queries db_time rows owners '
+        'errors'))):
+    """
+        Outcome of a measured phase.
+
+        phase: one of PHASES
+        model: the model class the phase ran for (the owning model, or the
+               related model for "instantiate" and "write")
+        related_name: the relation the phase ran for, if any
+        duration: wall clock seconds
+        queries, db_time: number of queries and seconds spent in them on the
+                          phase's database
+        rows, owners: number of related rows and owners handled, if known
+        errors: number of errors raised or recorded as failures
+    """
+
+    __slots__ = ()
+
+    @property
+    def label(self):
+        opts = self.model._meta
+        return '{}.{}'.format(opts.app_label, opts.model_name)
+
+
+class Measurement(object):
+    """
+        Counts set by the measured code while a phase is in progress.
+    """
+
+    def __init__(self):
+        self.rows = None
+        self.owners = None
+        self.errors = 0
+
+
+def register_sink(sink):
+    """
+        Registers a callable receiving every PhaseEvent, e.g. a StatsdSink or
+        a MetricsRegistry. Returns the sink so that it can be used as a
+        decorator.
+    """
+    _sinks.append(sink)
+    return sink
+
+
+def unregister_sink(sink):
+    _sinks.remove(sink)
+
+
+def is_enabled():
+    return bool(_sinks) or phase_finished.has_listeners()
+
+
+def emit(event):
+    phase_finished.send(sender=event.model, event=event)
+    for sink in list(_sinks):
+        sink(event)
+
+
+@contextmanager
+def measure(phase, model, related_name=None, using=None):
+    """
+        Context manager measuring a phase and emitting its PhaseEvent on
+        exit. Yields a Measurement whose rows, owners and errors the measured
+        code may set. Exceptions are counted as errors and propagated.
+    """
+    measurement = Measurement()
+    if not is_enabled():
+        yield measurement
+        return
+    counter = QueryCounter(connections[using or DEFAULT_DB_ALIAS])
+    start = default_timer()
+    try:
+        with counter:
+            yield measurement
+    except Exception:
+        measurement.errors += 1
+        raise
+    finally:
+        emit(PhaseEvent(
+            phase, model, related_name, default_timer() - start,
+            counter.queries, counter.db_time, measurement.rows,
+            measurement.owners, measurement.errors
+        ))
+
+
+def measure_iteration(iterable, phase, model, related_name=None,
+                      using=None):
+    """
+        Returns an iterator over the items of iterable that emits a single
+        PhaseEvent once it is exhausted (or closed). The event's duration and
+        queries only cover the time spent producing the items and its rows
+        is the number of items. Returns iterable as is when instrumentation
+        is disabled.
+    """
+    if not is_enabled():
+        return iterable
+    return _measure_iteration(iterable, phase, model, related_name, using)
+
+
+def _measure_iteration(iterable, phase, model, related_name, using):
+    counter = QueryCounter(connections[using or DEFAULT_DB_ALIAS])
+    iterator = iter(iterable)
+    duration = 0.0
+    queries = 0
+    db_time = 0.0
+    rows = 0
+    errors = 0
+    try:
+        while True:
+            start = default_timer()
+            try:
+                with counter:
+                    item = next(iterator)
+            except StopIteration:
+                break
+            except Exception:
+                errors += 1
+                raise
+            finally:
+                duration += default_timer() - start
+                queries += counter.queries
+                db_time += counter.db_time
+            rows += 1
+            yield item
+    finally:
+        # closes generators abandoned by the consumer right away
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        emit(PhaseEvent(
+            phase, model, related_name, duration, queries, db_time, rows,
+            None, errors
+        ))
+
+
+class QueryCounter(object):
+    """
+        Context manager counting the queries run on a connection, and the
+        time spent in them, while it is entered. Uses execute_wrapper where
+        available (Django 2.0+) and the connection's query log otherwise.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __enter__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.wrapper = self.connection.execute_wrapper(self)
+            self.wrapper.__enter__()
+        else:
+            self.forced = self.connection.force_debug_cursor
+            self.connection.force_debug_cursor = True
+            log = self.connection.queries_log
+            self.last = log[-1] if log else None
+        return self
+
+    def __exit__(self, *exc_info):
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.wrapper.__exit__(*exc_info)
+            return
+        self.connection.force_debug_cursor = self.forced
+        # the log is a bounded deque, so the entries logged since entering
+        # are found by walking back to the last entry seen before
+        for entry in reversed(self.connection.queries_log):
+            if entry is self.last:
+                break
+            self.queries += 1
+            self.db_time += float(entry['time'])
+
+    def __call__(self, execute, sql, params, many, context):
+        start = default_timer()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += default_timer() - start
+
+
+class StatsdSink(object):
+    """
+        Sink forwarding events to a StatsD style client, i.e. any object with
+        timing(name, milliseconds) and incr(name, count) methods, as
+        {prefix}.{app_label.model}.{related_name}.{phase}.{metric}.
+    """
+
+    def __init__(self, client, prefix='timeseries'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, event):
+        name = '.'.join(
+            part for part in (
+                self.prefix, event.label, event.related_name, event.phase
+            ) if part
+        )
+        self.client.timing(name + '.duration', event.duration * 1000)
+        self.client.timing(name + '.db_time', event.db_time * 1000)
+        self.client.incr(name + '.queries', event.queries)
+        if event.rows:
+            self.client.incr(name + '.rows', event.rows)
+        if event.owners:
+            self.client.incr(name + '.owners', event.owners)
+        if event.errors:
+            self.client.incr(name + '.errors', event.errors)
+
+
+class MetricsRegistry(object):
+    """
+        Thread safe, in memory sink keeping Prometheus style counters of the
+        events, labelled by model, related_name and phase:
+
+            timeseries_phase_total, timeseries_phase_seconds_total,
+            timeseries_queries_total, timeseries_db_seconds_total,
+            timeseries_rows_total, timeseries_owners_total,
+            timeseries_errors_total
+
+        render() returns them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+
+    def __call__(self, event):
+        labels = (
+            ('model', event.label),
+            ('related_name', event.related_name or ''),
+            ('phase', event.phase),
+        )
+        values = (
+            ('timeseries_phase_total', 1),
+            ('timeseries_phase_seconds_total', event.duration),
+            ('timeseries_queries_total', event.queries),
+            ('timeseries_db_seconds_total', event.db_time),
+            ('timeseries_rows_total', event.rows or 0),
+            ('timeseries_owners_total', event.owners or 0),
+            ('timeseries_errors_total', event.errors),
+        )
+        with self.lock:
+            for name, value in values:
+                self.counters[name, labels] += value
+
+    def get(self, name, **labels):
+        """
+            Returns the sum of the counter over the series matching the given
+            labels.
+        """
+        with self.lock:
+            return sum(
+                value for (counter, series), value in self.counters.items()
+                if counter == name and
+                set(labels.items()).issubset(series)
+            )
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{{{}}} {}'.format(name, ','.join(
+                    '{}="{}"'.format(key, label) for key, label in labels
+                ), repr(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,37 @@
+from django.apps import apps
+from django.core.management.base import CommandError
+
+from timeseries.utils import TimeSeriesModel
+
+
+def get_timeseries_models(labels, get_option, option):
+    """
+        Returns the TimeSeriesModel subclasses named by the
+        app_label.ModelName labels, or every installed one whose
+        get_option(model) isn't None if no labels are given. Raises a
+        CommandError for labels that don't name a TimeSeriesModel or name
+        one without the given option.
+    """
+    if not labels:
+        return [
+            model for model in apps.get_models()
+            if issubclass(model, TimeSeriesModel) and
+            get_option(model) is not None
+        ]
+
+    models = []
+    for label in labels:
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError) as err:
+            raise CommandError(str(err))
+        if not issubclass(model, TimeSeriesModel):
+            raise CommandError(
+                '{} is not a TimeSeriesModel'.format(model.__name__)
+            )
+        if get_option(model) is None:
+            raise CommandError(
+                '{} has no {}'.format(model.__name__, option)
+            )
+        models.append(model)
+    return models
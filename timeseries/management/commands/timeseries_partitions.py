@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from timeseries.management.base import get_timeseries_models
+from timeseries.partitions import (
+    create_partitions, drop_expired_partitions, is_partitioned
+)
+from timeseries.utils import get_partition_width, get_retention
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Creates the upcoming partitions of partitioned timeseries tables and '
+        'drops the partitions older than their model\'s TIMESERIES_RETENTION.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*', metavar='app_label.ModelName',
+            help='Restricts maintenance to the given timeseries models.'
+        )
+        parser.add_argument(
+            '--ahead', type=int, default=2, dest='ahead',
+            help='Number of partitions to create past the current one.'
+        )
+        parser.add_argument(
+            '--detach', action='store_true', dest='detach',
+            help='Detaches expired partitions instead of dropping them.'
+        )
+
+    def handle(self, *args, **options):
+        if options['ahead'] < 0:
+            raise CommandError('--ahead must not be negative')
+        models = get_timeseries_models(
+            options['labels'], get_partition_width, 'TIMESERIES_PARTITION'
+        )
+        for model in models:
+            if not is_partitioned(model):
+                raise CommandError(
+                    '{} table is not partitioned'.format(model.__name__)
+                )
+            created = create_partitions(model, ahead=options['ahead'])
+            expired = []
+            if get_retention(model) is not None:
+                expired = drop_expired_partitions(
+                    model, detach_only=options['detach']
+                )
+            if options['verbosity']:
+                self.stdout.write(
+                    'Created {} and {} {} {} partitions'.format(
+                        len(created),
+                        'detached' if options['detach'] else 'dropped',
+                        len(expired), model.__name__
+                    )
+                )
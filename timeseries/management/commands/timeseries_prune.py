@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from timeseries.management.base import get_timeseries_models
+from timeseries.retention import prune_timeseries
+from timeseries.utils import get_retention
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Deletes timeseries rows older than their model\'s '
+        'TIMESERIES_RETENTION in small batches, downsampling them first when '
+        'the model declares a TIMESERIES_DOWNSAMPLE rollup. The latest row of '
+        'each owner is always kept.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*', metavar='app_label.ModelName',
+            help='Restricts pruning to the given timeseries models.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, dest='batch_size',
+            help='Maximum number of rows deleted per transaction.'
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0, dest='sleep',
+            help='Seconds to sleep between batches.'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        models = get_timeseries_models(
+            options['labels'], get_retention, 'TIMESERIES_RETENTION'
+        )
+        for model in models:
+            deleted = prune_timeseries(
+                model, batch_size=options['batch_size'],
+                sleep=options['sleep']
+            )
+            if options['verbosity']:
+                self.stdout.write(
+                    'Pruned {} {} rows'.format(deleted, model.__name__)
+                )
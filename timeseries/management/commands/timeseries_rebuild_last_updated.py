@@ -0,0 +1,104 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from timeseries.utils import (
+    LastUpdated, check_reverse_relation, get_last_updated_field,
+    iter_timeseries_relations
+)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Rebuilds the denormalized {related_name}_last_updated fields from '
+        'the timeseries tables they summarise.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*',
+            metavar='app_label.ModelName[.related_name]',
+            help='Restricts the rebuild to the given models or relations.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, dest='batch_size',
+            help='Number of owning rows updated per statement.'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        for model, rev_rel in self.get_relations(options['labels']):
+            count = self.rebuild(model, rev_rel, batch_size)
+            if options['verbosity']:
+                self.stdout.write(
+                    'Rebuilt {}.{}_last_updated for {} rows'.format(
+                        model.__name__, rev_rel.get_accessor_name(), count
+                    )
+                )
+
+    def get_relations(self, labels):
+        if not labels:
+            for model in apps.get_models():
+                for rev_rel in iter_timeseries_relations(model):
+                    name = rev_rel.get_accessor_name()
+                    if get_last_updated_field(model, name) is not None:
+                        yield model, rev_rel
+            return
+
+        for label in labels:
+            parts = label.split('.')
+            if len(parts) not in (2, 3):
+                raise CommandError(
+                    '"{}" is not of the form '
+                    'app_label.ModelName[.related_name]'.format(label)
+                )
+            try:
+                model = apps.get_model(parts[0], parts[1])
+            except LookupError as err:
+                raise CommandError(str(err))
+
+            if len(parts) == 2:
+                names = [
+                    rev_rel.get_accessor_name()
+                    for rev_rel in iter_timeseries_relations(model)
+                ]
+            else:
+                names = parts[2:]
+            for name in names:
+                if get_last_updated_field(model, name) is None:
+                    if len(parts) == 2:
+                        continue
+                    raise CommandError(
+                        '{} has no {}_last_updated field'.format(
+                            model.__name__, name
+                        )
+                    )
+                try:
+                    yield model, check_reverse_relation(model, name)
+                except (NotImplementedError, TypeError) as err:
+                    raise CommandError(str(err))
+
+    def rebuild(self, model, rev_rel, batch_size):
+        # walks the owning table in primary key order so that each UPDATE
+        # only ever locks batch_size rows
+        field = get_last_updated_field(model, rev_rel.get_accessor_name())
+        using = router.db_for_write(model)
+        manager = model._base_manager.using(using)
+        expression = LastUpdated(rev_rel)
+        count = 0
+        last_pk = None
+        while True:
+            queryset = manager.order_by('pk')
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return count
+            with transaction.atomic(using=using):
+                count += manager.filter(pk__in=pks).update(
+                    **{field.name: expression}
+                )
+            last_pk = pks[-1]
@@ -0,0 +1,90 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from timeseries.scheduler import Scheduler
+from timeseries.utils import TimeSeriesQuerySet, check_reverse_relation
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Keeps timeseries data fresh by updating each owner as soon as its '
+        'data is outdated, sleeping until the next owner is due in between.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'jobs', nargs='+',
+            metavar='app_label.ModelName.related_name:path.to.collector',
+            help='Relations to keep up to date and their collectors.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100, dest='batch_size',
+            help='Maximum number of owners updated per update_timeseries '
+                 'call.'
+        )
+        parser.add_argument(
+            '--reload', type=float, default=300, dest='reload',
+            help='Seconds after which the owners created since are '
+                 'scheduled.'
+        )
+        parser.add_argument(
+            '--full-reload', type=float, default=None, dest='full_reload',
+            help='Seconds after which the due times of all owners are '
+                 'reloaded from the database, never by default.'
+        )
+        parser.add_argument(
+            '--once', action='store_true', dest='once',
+            help='Updates the owners that are due and exits.'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be a positive integer')
+        scheduler = Scheduler(
+            batch_size=options['batch_size'],
+            reload_interval=options['reload'],
+            full_reload_interval=options['full_reload'],
+            on_error=self.on_error
+        )
+        for job in options['jobs']:
+            scheduler.add(*self.parse_job(job))
+
+        if options['once']:
+            count = scheduler.run_pending()
+            if options['verbosity']:
+                self.stdout.write('Updated {} owners'.format(count))
+            return
+        scheduler.run()
+
+    def parse_job(self, job):
+        label, _, path = job.partition(':')
+        parts = label.split('.')
+        if len(parts) != 3 or not path:
+            raise CommandError(
+                '"{}" is not of the form '
+                'app_label.ModelName.related_name:path.to.collector'.format(
+                    job
+                )
+            )
+        try:
+            model = apps.get_model(parts[0], parts[1])
+        except LookupError as err:
+            raise CommandError(str(err))
+        queryset = model._default_manager.all()
+        if not isinstance(queryset, TimeSeriesQuerySet):
+            raise CommandError(
+                '{} has no TimeSeriesManager'.format(model.__name__)
+            )
+        try:
+            check_reverse_relation(model, parts[2])
+            collector = import_string(path)
+        except (NotImplementedError, TypeError, ImportError) as err:
+            raise CommandError(str(err))
+        return queryset, parts[2], collector
+
+    def on_error(self, job, pks, err):
+        self.stderr.write('Updating {} of {} owners failed: {!r}'.format(
+            job.related_name, len(pks), err
+        ))
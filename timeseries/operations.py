@@ -0,0 +1,50 @@
+from django.apps import apps
+from django.db.migrations.operations.base import Operation
+
+
+class PartitionTimeSeries(Operation):
+    """
+        Migration operation converting a TimeSeriesModel's table into a
+        PostgreSQL range partitioned table, see
+        timeseries.partitions.partition_table. Add it to a migration after the
+        one creating the model:
+
+            operations = [PartitionTimeSeries('RawAdData')]
+
+        N.B. the conversion rewrites the table and can't be reversed.
+    """
+
+    reduces_to_sql = False
+    reversible = False
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def deconstruct(self):
+        return self.__class__.__name__, [self.model_name], {}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        from timeseries.partitions import partition_table
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        # historical models don't carry class attributes such as
+        # TIMESERIES_PARTITION, so the current model is partitioned
+        partition_table(
+            apps.get_model(app_label, self.model_name),
+            using=schema_editor.connection.alias
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        raise NotImplementedError(
+            'Partitioning a timeseries table can\'t be reversed'
+        )
+
+    def describe(self):
+        return 'Partition the {} timeseries table'.format(self.model_name)
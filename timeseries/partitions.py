@@ -0,0 +1,313 @@
+"""
+    PostgreSQL declarative range partitioning of TimeSeriesModel tables.
+
+    N.B. requires PostgreSQL 11+ (default partitions and partitioned primary
+    keys). Models opt in by setting TIMESERIES_PARTITION to the width of each
+    partition, converting their table with the PartitionTimeSeries migration
+    operation (or partition_table) and periodically running the
+    timeseries_partitions management command.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from timeseries import utils
+from timeseries.retention import downsample_expired
+
+PARTITION_FORMAT = '%Y%m%d%H%M'
+
+
+def check_partitioned_model(model, using):
+    width = utils.get_partition_width(model)
+    if width is None:
+        raise TypeError(
+            '{} has no TIMESERIES_PARTITION'.format(model.__name__)
+        )
+    if utils.get_upsert_mode(model) is not None:
+        # unique constraints of partitioned tables must include created
+        raise TypeError(
+            '{} sets TIMESERIES_UPSERT, its unique (owner, interval_bucket) '
+            'constraints rule out partitioning'.format(model.__name__)
+        )
+    if utils.get_block_width(model) is not None:
+        raise TypeError(
+            '{} is a TimeSeriesBlockModel, its unique (owner, start) '
+            'constraints rule out partitioning'.format(model.__name__)
+        )
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        raise NotImplementedError(
+            'Partitioning is only supported on PostgreSQL'
+        )
+    return connection, int(width.total_seconds())
+
+
+def is_partitioned(model, using=None):
+    """
+        Returns whether the model's table is a partitioned table.
+    """
+    using = using or router.db_for_write(model)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+            [model._meta.db_table]
+        )
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def partition_table(model, using=None):
+    """
+        Converts the model's existing table into a table range partitioned on
+        created, moving its rows into a default partition. The model's
+        indexes, foreign keys and check and unique constraints are recreated
+        on the partitioned table. As PostgreSQL requires, the primary key
+        becomes (pk, created) and created is appended to unique constraints
+        that don't include it, which then only hold per timestamp.
+
+        Call create_partitions afterwards to move rows out of the default
+        partition.
+    """
+    using = using or router.db_for_write(model)
+    connection, _ = check_partitioned_model(model, using)
+    if is_partitioned(model, using):
+        return
+
+    opts = model._meta
+    qn = connection.ops.quote_name
+    table = opts.db_table
+    template = '{}_template'.format(table)
+    pk = opts.pk.column
+    created = opts.get_field('created').column
+
+    # built from the model, the definitions read from the catalog name the
+    # (possibly schema qualified) table they were read from
+    schema_editor = connection.schema_editor()
+    indexes = [str(sql) for sql in schema_editor._model_indexes_sql(model)]
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype IN ('f', 'c')",
+            [table]
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(
+            "SELECT c.conname, ARRAY(SELECT a.attname::text "
+            "FROM unnest(c.conkey) WITH ORDINALITY AS k(attnum, ordinal) "
+            "JOIN pg_attribute a ON a.attrelid = c.conrelid "
+            "AND a.attnum = k.attnum ORDER BY k.ordinal) "
+            "FROM pg_constraint c "
+            "WHERE c.conrelid = to_regclass(%s) AND c.contype = 'u'",
+            [table]
+        )
+        for name, columns in cursor.fetchall():
+            if created not in columns:
+                columns.append(created)
+            constraints.append((name, 'UNIQUE ({})'.format(
+                ', '.join(qn(column) for column in columns)
+            )))
+        cursor.execute(
+            "SELECT pg_get_serial_sequence(%s, %s)", [table, pk]
+        )
+        sequence = cursor.fetchone()[0]
+
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+            qn(table), qn(template)
+        ))
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE ({})'.format(
+                qn(table), qn(template), qn(created)
+            )
+        )
+        cursor.execute(
+            'ALTER TABLE {} ADD PRIMARY KEY ({}, {})'.format(
+                qn(table), qn(pk), qn(created)
+            )
+        )
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            qn('{}_default'.format(table)), qn(table)
+        ))
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(
+            qn(table), qn(template)
+        ))
+        if sequence:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(
+                sequence, qn(table), qn(pk)
+            ))
+        # frees the names of the template's indexes and constraints
+        cursor.execute('DROP TABLE {}'.format(qn(template)))
+        for index in indexes:
+            cursor.execute(index)
+        for name, definition in constraints:
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+                qn(table), qn(name), definition
+            ))
+
+
+def get_partitions(model, using=None):
+    """
+        Returns a list of (start, table name) pairs of the model's range
+        partitions, oldest first. The default partition is not included.
+    """
+    using = using or router.db_for_write(model)
+    table = model._meta.db_table
+    prefix = '{}_p'.format(table)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [table]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = []
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            start = datetime.strptime(name[len(prefix):], PARTITION_FORMAT)
+        except ValueError:
+            continue
+        if settings.USE_TZ:
+            start = start.replace(tzinfo=utils.utc)
+        partitions.append((start, name))
+    return sorted(partitions)
+
+
+def create_partitions(model, ahead=2, using=None):
+    """
+        Creates the missing partitions from the oldest row in the default
+        partition (or the current time) up to "ahead" partitions past the
+        current one, but not past the model's TIMESERIES_RETENTION.
+        Partitions are aligned to the epoch like resample buckets. Rows of
+        the default partition that fall into a new partition are moved into
+        it.
+
+        Returns the names of the partitions created.
+    """
+    if ahead < 0:
+        raise ValueError('ahead must not be negative')
+    using = using or router.db_for_write(model)
+    connection, seconds = check_partitioned_model(model, using)
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    default = '{}_default'.format(table)
+    created = model._meta.get_field('created').column
+    existing = set(start for start, _ in get_partitions(model, using))
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT MIN({}) FROM {}'.format(
+            qn(created), qn(default)
+        ))
+        oldest = cursor.fetchone()[0]
+
+    now = utils.floor_bucket(utils.utcnow(), seconds)
+    start = now if oldest is None else min(
+        now, utils.floor_bucket(oldest, seconds)
+    )
+    retention = utils.get_retention(model)
+    if retention is not None:
+        # rows past retention stay in the default partition, these are the
+        # latest rows kept by drop_expired_partitions
+        start = max(start, utils.floor_bucket(
+            utils.utcnow() - retention, seconds
+        ))
+    end = now + timedelta(seconds=seconds * (ahead + 1))
+
+    created_names = []
+    for bucket in utils.iter_bucket_range(start, end, seconds):
+        if bucket in existing:
+            continue
+        name = '{}_p{}'.format(table, bucket.strftime(PARTITION_FORMAT))
+        upper = bucket + timedelta(seconds=seconds)
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            # a new partition can't be attached while the default partition
+            # holds rows belonging to it
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+                qn(table), qn(default)
+            ))
+            cursor.execute(
+                'CREATE TABLE {} PARTITION OF {} '
+                'FOR VALUES FROM (%s) TO (%s)'.format(qn(name), qn(table)),
+                [bucket, upper]
+            )
+            cursor.execute(
+                'WITH moved AS (DELETE FROM {default} '
+                'WHERE {created} >= %s AND {created} < %s RETURNING *) '
+                'INSERT INTO {name} SELECT * FROM moved'.format(
+                    default=qn(default), created=qn(created), name=qn(name)
+                ),
+                [bucket, upper]
+            )
+            cursor.execute('ALTER TABLE {} ATTACH PARTITION {} DEFAULT'.format(
+                qn(table), qn(default)
+            ))
+        created_names.append(name)
+    return created_names
+
+
+def drop_expired_partitions(model, cutoff=None, detach_only=False,
+                            downsample=True, using=None):
+    """
+        Detaches the partitions whose whole range is older than cutoff
+        (defaults to now minus TIMESERIES_RETENTION), oldest first, and drops
+        them unless detach_only is set.
+
+        The latest row of each owner held by such a partition is copied back
+        into the table (it lands in the default partition) so that
+        prefetch_latest keeps returning it. Expired rows are downsampled into
+        the model's TIMESERIES_DOWNSAMPLE rollup first unless downsample is
+        False.
+
+        Returns the names of the partitions detached.
+    """
+    using = using or router.db_for_write(model)
+    connection, seconds = check_partitioned_model(model, using)
+    if cutoff is None:
+        retention = utils.get_retention(model)
+        if retention is None:
+            raise TypeError(
+                '{} has no TIMESERIES_RETENTION'.format(model.__name__)
+            )
+        cutoff = utils.utcnow() - retention
+
+    expired = [
+        name for start, name in get_partitions(model, using)
+        if start + timedelta(seconds=seconds) <= cutoff
+    ]
+    if not expired:
+        return []
+    if downsample:
+        downsample_expired(model, cutoff, using)
+
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    fields = [f for f in model._meta.fields if f.many_to_one]
+    for name in expired:
+        partition = qn(name)
+        # keeps the rows that no other row of the same owner supersedes,
+        # neither in the rest of the table nor in the partition itself, for
+        # any of their ForeignKeys like prune_timeseries
+        latest = ' OR '.join(
+            'NOT ({} OR {})'.format(
+                utils.newer_row_exists(model, field, 'ts_row', table, qn),
+                utils.newer_row_exists(model, field, 'ts_row', partition, qn)
+            )
+            for field in fields
+        ) or 'FALSE'
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+                table, partition
+            ))
+            cursor.execute(
+                'INSERT INTO {} SELECT * FROM {} ts_row WHERE {}'.format(
+                    table, partition, latest
+                )
+            )
+            if not detach_only:
+                cursor.execute('DROP TABLE {}'.format(partition))
+    return expired
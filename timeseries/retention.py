@@ -0,0 +1,110 @@
+"""
+    Retention of TimeSeriesModel rows.
+
+    Models setting TIMESERIES_RETENTION have their expired rows deleted by
+    prune_timeseries (or the timeseries_prune management command), which
+    first brings their TIMESERIES_DOWNSAMPLE rollup (if any) up to date.
+"""
+import time
+
+from django.db import connections, router, transaction
+
+from timeseries import utils
+from timeseries.rollups import insert_rollup
+
+
+def prune_timeseries(model, batch_size=1000, sleep=0):
+    """
+        Deletes the model's rows that are older than its TIMESERIES_RETENTION
+        in primary key ordered batches of at most batch_size rows, each in its
+        own transaction, optionally sleeping between batches. The latest row
+        of each owner is never deleted.
+
+        If the model declares a TIMESERIES_DOWNSAMPLE rollup, the rollup of
+        every owner with expiring rows that haven't been rolled up yet is
+        brought up to date first.
+
+        Partitioned tables (see timeseries.partitions) first have their
+        fully expired partitions dropped.
+
+        Returns the number of rows deleted by the batched DELETEs.
+    """
+    retention = utils.get_retention(model)
+    if retention is None:
+        return 0
+    if batch_size < 1:
+        raise ValueError('batch size must be a positive integer')
+    cutoff = utils.utcnow() - retention
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    manager = model._base_manager.using(using)
+
+    downsample_expired(model, cutoff, using)
+
+    if utils.get_partition_width(model) is not None and \
+            connection.vendor == 'postgresql':
+        from timeseries.partitions import (
+            drop_expired_partitions, is_partitioned
+        )
+        if is_partitioned(model, using):
+            drop_expired_partitions(
+                model, cutoff=cutoff, using=using, downsample=False
+            )
+
+    table = qn(model._meta.db_table)
+    expired = manager.filter(created__lt=cutoff).extra(where=[
+        utils.newer_row_exists(model, field, table, table, qn)
+        for field in model._meta.fields if field.many_to_one
+    ])
+
+    deleted = 0
+    while True:
+        pks = list(
+            expired.order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return deleted
+        with transaction.atomic(using=using):
+            manager.filter(pk__in=pks).delete()
+        deleted += len(pks)
+        # deletes only ever make rows lose newer rows, so none of the rows
+        # before the last one deleted can have become expired since
+        expired = expired.filter(pk__gt=pks[-1])
+        if sleep:
+            time.sleep(sleep)
+
+
+def downsample_expired(model, cutoff, using):
+    """
+        Brings the model's TIMESERIES_DOWNSAMPLE rollup (if any) up to date for
+        every owner with rows older than cutoff that haven't been rolled up
+        yet.
+    """
+    downsample = utils.get_downsample_relations(model)
+    if downsample is None:
+        return None
+    source_rel, rollup_rel = downsample
+    qn = connections[using].ops.quote_name
+    opts = model._meta
+    rollup_opts = rollup_rel.field.model._meta
+    pending = (
+        'NOT EXISTS (SELECT 1 FROM {rollup} ts_rollup '
+        'WHERE ts_rollup.{rollup_fk} = {table}.{fk} '
+        'AND COALESCE(ts_rollup.{rollup_end}, ts_rollup.{rollup_created}) '
+        '>= {table}.{created})'
+    ).format(
+        rollup=qn(rollup_opts.db_table),
+        rollup_fk=qn(rollup_rel.field.column),
+        rollup_end=qn(rollup_opts.get_field(utils.ROLLUP_END_FIELD).column),
+        rollup_created=qn(rollup_opts.get_field('created').column),
+        table=qn(opts.db_table),
+        fk=qn(source_rel.field.column),
+        created=qn(opts.get_field('created').column),
+    )
+    owners = source_rel.model._base_manager.using(using).filter(
+        pk__in=model._base_manager.using(using).filter(
+            created__lt=cutoff
+        ).extra(where=[pending]).order_by().values(source_rel.field.name)
+    )
+    return insert_rollup(owners, rollup_rel)
@@ -0,0 +1,135 @@
+"""
+    Rollup models, filled in the database from their source relation.
+
+    A rollup model (see TimeSeriesModel) declares TIMESERIES_ROLLUP_SOURCE
+    and TIMESERIES_ROLLUP_AGGREGATES. insert_rollup aggregates the source
+    rows each owner gained since its latest rollup row with a single
+    INSERT ... SELECT statement.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.utils.timezone import utc
+
+from timeseries import utils
+from timeseries.cache import refresh_latest_cache
+
+
+def insert_rollup(owners, rev_rel):
+    """
+        Fills the rollup model of the reverse relation for the given owners
+        with a single INSERT ... SELECT aggregating every source row that is
+        newer than the owner's watermark, the rollup_end of its latest
+        rollup row. Owners without any such source rows are skipped, and
+        source rows written late with older timestamps aren't aggregated.
+
+        Returns an UpdateSummary.
+    """
+    RollupModel = rev_rel.field.model
+    source_name, aggregates = utils.get_rollup(RollupModel)
+    source_rel = utils.get_reverse_relation(owners.model, source_name)
+    SourceModel = source_rel.field.model
+    using = router.db_for_write(RollupModel)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    rollup_opts = RollupModel._meta
+    source_opts = SourceModel._meta
+    owner_opts = owners.model._meta
+    now = utils.utcnow()
+    created_field = source_opts.get_field('created')
+
+    # each owner's watermark is looked up once, off the (owner, -created)
+    # index, and bounds an index range scan of its new source rows
+    owners_sql, owners_params = owners.order_by().values(
+        'pk'
+    ).query.get_compiler(using).as_sql()
+    # owners without rollup rows aggregate their whole history
+    floor = datetime(1, 1, 1, tzinfo=utc if settings.USE_TZ else None)
+    newer = (
+        'SELECT ts_new.{source_pk} FROM (SELECT ts_owner.{owner_pk} AS '
+        'ts_owner_id, COALESCE((SELECT COALESCE(ts_rollup.{rollup_end}, '
+        'ts_rollup.{rollup_created}) FROM {rollup} ts_rollup '
+        'WHERE ts_rollup.{rollup_fk} = ts_owner.{owner_pk} '
+        'ORDER BY ts_rollup.{rollup_created} DESC LIMIT 1), %s) AS '
+        'ts_watermark FROM {owner} ts_owner WHERE ts_owner.{owner_pk} IN '
+        '({owners})) ts_mark INNER JOIN {source} ts_new '
+        'ON ts_new.{source_fk} = ts_mark.ts_owner_id '
+        'AND ts_new.{source_created} > ts_mark.ts_watermark '
+        'WHERE ts_new.{source_created} <= %s'
+    ).format(
+        source_pk=qn(source_opts.pk.column),
+        owner_pk=qn(owner_opts.pk.column),
+        rollup_end=qn(rollup_opts.get_field(utils.ROLLUP_END_FIELD).column),
+        rollup_created=qn(rollup_opts.get_field('created').column),
+        rollup=qn(rollup_opts.db_table),
+        rollup_fk=qn(rev_rel.field.column),
+        owner=qn(owner_opts.db_table),
+        owners=owners_sql,
+        source=qn(source_opts.db_table),
+        source_fk=qn(source_rel.field.column),
+        source_created=qn(created_field.column),
+    )
+    newer_params = (
+        [created_field.get_db_prep_value(floor, connection)] +
+        list(owners_params) +
+        [created_field.get_db_prep_value(now, connection)]
+    )
+    # aggregates are aliased so that they can't clash with source fields
+    aliases = dict(
+        ('ts_rollup_{}'.format(i), name)
+        for i, name in enumerate(sorted(aggregates))
+    )
+    aggregates = dict(
+        (alias, aggregates[name]) for alias, name in aliases.items()
+    )
+    aggregates['ts_rollup_end'] = models.Max('created')
+    source = SourceModel._default_manager.using(using).extra(
+        where=['{}.{} IN ({})'.format(
+            qn(source_opts.db_table), qn(source_opts.pk.column), newer
+        )],
+        params=newer_params,
+    ).order_by().values(source_rel.field.name).annotate(**aggregates)
+    select_sql, select_params = source.query.get_compiler(using).as_sql()
+
+    columns = [
+        rev_rel.field.column, rollup_opts.get_field('created').column,
+        rollup_opts.get_field(utils.ROLLUP_END_FIELD).column,
+    ]
+    values = [
+        'ts_src.' + qn(source_rel.field.column), '%s',
+        'ts_src.' + qn('ts_rollup_end'),
+    ]
+    params = [rollup_opts.get_field('created').get_db_prep_save(
+        now, connection
+    )]
+    for alias, name in sorted(aliases.items()):
+        columns.append(rollup_opts.get_field(name).column)
+        values.append('ts_src.' + qn(alias))
+    # fields that aren't aggregated get their python defaults
+    for field in rollup_opts.concrete_fields:
+        if field.primary_key or field.column in columns:
+            continue
+        columns.append(field.column)
+        values.append('%s')
+        params.append(field.get_db_prep_save(field.get_default(), connection))
+
+    sql = 'INSERT INTO {table} ({columns}) SELECT {values} FROM ({select}) ' \
+        'ts_src'.format(
+            table=qn(rollup_opts.db_table),
+            columns=', '.join(qn(column) for column in columns),
+            values=', '.join(values),
+            select=select_sql,
+        )
+    summary = utils.UpdateSummary()
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, tuple(params) + tuple(select_params))
+            summary.rows = cursor.rowcount
+        summary.batches = 1
+        owners = RollupModel._default_manager.using(using).filter(
+            created=now
+        ).values(rev_rel.field.name)
+        utils.refresh_owners_last_updated(rev_rel, owners)
+        refresh_latest_cache(rev_rel, owners)
+    return summary
@@ -0,0 +1,212 @@
+"""
+    Due time scheduling of update_timeseries calls.
+
+    Instead of periodically running filter_outdated over every owner, the
+    Scheduler loads each owner's next due time (last updated plus the related
+    model's TIMESERIES_INTERVAL) into a heap once, sleeps until the earliest
+    due time and only updates the owners that are due. See the
+    timeseries_scheduler management command.
+"""
+from collections import namedtuple
+import heapq
+import time
+
+from django.db import connections
+
+from timeseries import utils
+
+Job = namedtuple(
+    'Job', 'queryset related_name collector batch_size backend interval'
+)
+
+
+class Scheduler(object):
+    """
+        Keeps the timeseries of one or more jobs (an owning queryset, a
+        related_name and a collector, see add) fresh.
+
+        batch_size: maximum number of due owners updated per
+                    update_timeseries call.
+        reload_interval: seconds (or a timedelta) after which the owners
+                         created since are added to the heap (see refresh).
+        full_reload_interval: seconds (or a timedelta) after which the heap
+                              is rebuilt from the database (see load), None
+                              (the default) to never rebuild it. Owners
+                              that joined a job's queryset with a lower
+                              primary key than those loaded are only picked
+                              up by a rebuild.
+        on_error: callable taking (job, pks, exception), called instead of
+                  propagating exceptions raised while updating a batch. The
+                  batch's owners are then retried an interval later.
+
+        Due owners are updated without force, so that those updated by
+        other processes in the meantime are skipped and rescheduled.
+    """
+
+    def __init__(self, batch_size=100, reload_interval=300,
+                 full_reload_interval=None, sleep=time.sleep, on_error=None):
+        if batch_size < 1:
+            raise ValueError('batch size must be a positive integer')
+        self.batch_size = batch_size
+        self.reload_interval = reload_interval
+        self.full_reload_interval = full_reload_interval
+        self.sleep = sleep
+        self.on_error = on_error
+        self.jobs = []
+        self.heap = []
+        # the greatest primary key loaded per job index
+        self.last_pks = {}
+        self.loaded = None
+        self.refreshed = None
+
+    def add(self, queryset, related_name, collector, batch_size=None,
+            backend=None):
+        """
+            Schedules the instances of queryset (a TimeSeriesQuerySet) to be
+            updated with update_timeseries(related_name, collector) as soon
+            as their data is outdated. batch_size and backend are passed on
+            to update_timeseries.
+        """
+        rev_rel = utils.check_reverse_relation(queryset.model, related_name)
+        self.jobs.append(Job(
+            queryset, related_name, collector, batch_size, backend,
+            utils.get_interval(rev_rel.field.model)
+        ))
+        self.loaded = None
+
+    def load(self):
+        """
+            Rebuilds the heap of (due time, job index, primary key) entries
+            from the database, one query per job computing the last updated
+            timestamp of every owner.
+        """
+        now = utils.utcnow()
+        self.heap = []
+        self.last_pks = {}
+        for index, job in enumerate(self.jobs):
+            self.load_owners(index, job, now)
+        heapq.heapify(self.heap)
+        self.loaded = self.refreshed = now
+
+    def refresh(self):
+        """
+            Adds the owners created since the heap was last loaded or
+            refreshed, one query per job limited to the owners with a
+            greater primary key than any loaded.
+        """
+        now = utils.utcnow()
+        for index, job in enumerate(self.jobs):
+            self.load_owners(index, job, now, self.last_pks.get(index))
+        heapq.heapify(self.heap)
+        self.refreshed = now
+
+    def load_owners(self, index, job, now, after=None):
+        for pk, last in self.iter_last_updated(job, after=after):
+            self.heap.append((self.due(job, last, now), index, pk))
+            if after is None or pk > after:
+                after = pk
+        if after is not None:
+            self.last_pks[index] = after
+
+    def iter_last_updated(self, job, pks=None, after=None):
+        queryset = job.queryset
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        return queryset.last_updated(job.related_name).order_by().values_list(
+            'pk', '{}_last_updated'.format(job.related_name)
+        ).iterator()
+
+    def due(self, job, last, now):
+        if last is None:
+            return now
+        return last + job.interval
+
+    def run_pending(self):
+        """
+            Updates every owner that is due, at most batch_size owners of a
+            job per update_timeseries call, and reschedules them. Returns the
+            number of owners updated.
+        """
+        now = utils.utcnow()
+        if self.loaded is None or (
+                self.full_reload_interval is not None and
+                now - self.loaded >=
+                utils.parse_interval(self.full_reload_interval)):
+            self.load()
+        elif now - self.refreshed >= \
+                utils.parse_interval(self.reload_interval):
+            self.refresh()
+
+        now = utils.utcnow()
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            _, index, pk = heapq.heappop(self.heap)
+            due.setdefault(index, []).append(pk)
+
+        count = 0
+        for index, pks in sorted(due.items()):
+            job = self.jobs[index]
+            for start in range(0, len(pks), self.batch_size):
+                batch = pks[start:start + self.batch_size]
+                try:
+                    self.update(job, batch)
+                except Exception as err:
+                    if self.on_error is None:
+                        raise
+                    self.on_error(job, batch, err)
+                self.reschedule(index, job, batch)
+                count += len(batch)
+        return count
+
+    def update(self, job, pks):
+        # filter_outdated is cheap on a batch of owners and skips the owners
+        # another process updated since they were scheduled
+        job.queryset.filter(pk__in=pks).update_timeseries(
+            job.related_name, job.collector, batch_size=job.batch_size,
+            backend=job.backend
+        )
+
+    def reschedule(self, index, job, pks):
+        # owners whose collector returned nothing are retried an interval
+        # later rather than immediately
+        now = utils.utcnow()
+        for pk, last in self.iter_last_updated(job, pks):
+            due = self.due(job, last, now)
+            if due <= now:
+                due = now + job.interval
+            heapq.heappush(self.heap, (due, index, pk))
+
+    def next_due(self):
+        """
+            Returns the earliest due time, or None if nothing is scheduled.
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def run(self, iterations=None):
+        """
+            Runs pending updates and sleeps until the next due time (or the
+            next refresh or reload), forever or for the given number of
+            iterations.
+        """
+        while iterations is None or iterations > 0:
+            self.run_pending()
+            # idle connections may be closed by the server while sleeping
+            for connection in connections.all():
+                if not connection.in_atomic_block:
+                    connection.close_if_unusable_or_obsolete()
+            now = utils.utcnow()
+            wake = self.refreshed + utils.parse_interval(
+                self.reload_interval
+            )
+            if self.full_reload_interval is not None:
+                wake = min(wake, self.loaded + utils.parse_interval(
+                    self.full_reload_interval
+                ))
+            next_due = self.next_due()
+            if next_due is not None:
+                wake = min(wake, next_due)
+            self.sleep(max((wake - now).total_seconds(), 0))
+            if iterations is not None:
+                iterations -= 1
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# sent by timeseries.instrumentation whenever a measured phase of the update
+# pipeline ends, with the phase's model as sender and a PhaseEvent as event
+phase_finished = Signal(providing_args=['event'])
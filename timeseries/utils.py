@@ -1,71 +1,244 @@
-from datetime import datetime, timedelta
-from django.db import models
-from django.db.models import Prefetch, Max, Q, F
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
+from functools import partial
+from itertools import islice
+import calendar
+import inspect
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, connections, router, transaction
+from django.db.models import Prefetch, Q, F
+from django.db.models.expressions import Expression, RawSQL
+from django.db.models.query import prefetch_related_objects
+from django.db.models.signals import class_prepared
+from django.utils import six, timezone
 from django.db.models.fields.related import ManyToOneRel
 from django.db.models.options import FieldDoesNotExist
 
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import utc
+
+from timeseries import blocks
+from timeseries.instrumentation import measure, measure_iteration
+
 try:
 
     from django.utils.timezone import utcnow
 
 except ImportError:
 
-    from django.utils.timezone import utc
-
     def utcnow():
         return datetime.utcnow().replace(tzinfo=utc)
 
 
+DEFAULT_ITER_CHUNK_SIZE = 2000
+
+
 class TimeSeriesQuerySet(models.QuerySet):
     """
-        Adds 4 main methods to the Django QuerySet API that can be used to
-        update and maintain timeseries data. These methods include:
-            prefetch_latest
-            filter_outdated
-            last_updated
-            update_timeseries
+        Extends the Django QuerySet API with methods that can be used to
+        update, maintain and query timeseries data:
+            update_timeseries, backfill: collect and write related rows
+            filter_outdated, last_updated, refresh_last_updated, find_gaps:
+                find the owners (or intervals) that need updating
+            prefetch_latest, annotate_latest, as_of, iter_chunks: read the
+                latest (or point in time) related rows
+            resample, to_arrays, to_dataframe: aggregate and export series
     """
 
     def __init__(self, *args, **kwargs):
         super(TimeSeriesQuerySet, self).__init__(*args, **kwargs)
 
         self.latest_registry = set()
+        # maps the prefetch_latest related names to their latest strategy
+        self._latest_strategies = {}
+        # prefetch_latest related names read through TIMESERIES_CACHE
+        self._cached_latest = set()
         self._latest_included = False
+        # (phase, related_name) measured when the queryset is evaluated
+        self._instrumented_phase = None
 
     def _clone(self, **kwargs):
         # overriding _clone is required so retain the latest_registry set
         # information
         clone = super(TimeSeriesQuerySet, self)._clone(**kwargs)
         clone.latest_registry = self.latest_registry.copy()
+        clone._latest_strategies = self._latest_strategies.copy()
+        clone._cached_latest = self._cached_latest.copy()
         clone._latest_included = self._latest_included
+        clone._instrumented_phase = self._instrumented_phase
         return clone
 
-    def prefetch_latest(self, *related_names):
+    def _fetch_all(self):
+        if self._result_cache is not None:
+            return super(TimeSeriesQuerySet, self)._fetch_all()
+        if self._instrumented_phase is None:
+            super(TimeSeriesQuerySet, self)._fetch_all()
+        else:
+            phase, related_name = self._instrumented_phase
+            with measure(phase, self.model, related_name,
+                         self.db) as measured:
+                super(TimeSeriesQuerySet, self)._fetch_all()
+                measured.owners = len(self._result_cache)
+        self._prefetch_cached_latest(self._result_cache)
+
+    def _prefetch_related_objects(self):
+        if not self.latest_registry:
+            return super(TimeSeriesQuerySet, self)._prefetch_related_objects()
+        related_name = ','.join(sorted(
+            name[len('latest_'):] for name in self.latest_registry
+        ))
+        with measure('prefetch_latest', self.model, related_name,
+                     self.db) as measured:
+            super(TimeSeriesQuerySet, self)._prefetch_related_objects()
+            measured.owners = len(self._result_cache)
+
+    def prefetch_latest(self, *related_names, **kwargs):
         """
             Exposes the latest associated reverse relation.
 
             Adds a query per related name.
+
+            The optional "strategy" keyword argument selects how the latest
+            instances are looked up. It is either the name of one of
+            LATEST_STRATEGIES or a callable with the same signature. By
+            default "lateral" is used on PostgreSQL and "window" elsewhere.
+
+            Relations whose model sets TIMESERIES_CACHE are read from the
+            cache first, with a single get_many, and only the owners missing
+            from it are looked up (see timeseries.cache.get_cached_latest).
+
+            The optional "as_of" keyword argument exposes the latest related
+            instance created at or before the given timestamp instead, see
+            as_of. Such lookups bypass the cache, and callable strategies
+            must then accept an as_of keyword argument.
         """
+        strategy = kwargs.pop('strategy', None)
+        as_of = kwargs.pop('as_of', None)
+        if kwargs:
+            raise TypeError(
+                'Unexpected keyword arguments: {}'.format(', '.join(kwargs))
+            )
+        get_latest = get_latest_strategy(connections[self.db], strategy)
+        if as_of is not None:
+            get_latest = partial(get_latest, as_of=to_datetime(as_of))
+
         prefetch_set = []
         for related_name in set(related_names):
             rev_rel = get_reverse_relation(self.model, related_name)
-
-            field_name = rev_rel.field.name
-            RelatedModel = rev_rel.field.model
+            if as_of is not None:
+                check_row_model(rev_rel.field.model)
 
             attr_name = 'latest_{}'.format(related_name)
-            prefetch = Prefetch(
-                related_name,
-                queryset=RelatedModel.objects.filter(
-                    **{field_name + '__in': self}
-                ).order_by(field_name, '-created').distinct(field_name),
-                to_attr=attr_name
-            )
-            prefetch_set.append(prefetch)
+            if as_of is None and \
+                    get_latest_cache(rev_rel.field.model) is not None:
+                self._cached_latest.add(related_name)
+            else:
+                self._cached_latest.discard(related_name)
+                prefetch_set.append(Prefetch(
+                    related_name,
+                    queryset=get_latest(self, rev_rel),
+                    to_attr=attr_name
+                ))
             self.latest_registry.add(attr_name)
+            self._latest_strategies[related_name] = get_latest
 
         return self.prefetch_related(*prefetch_set)
 
+    def iter_chunks(self, size=DEFAULT_ITER_CHUNK_SIZE):
+        """
+            Streams the instances of the queryset with .iterator(), which
+            uses a server-side cursor on PostgreSQL with Django 1.11+, and
+            yields them in lists of at most size instances.
+
+            prefetch_latest, and any other prefetch_related lookup, is
+            resolved per chunk with a query per chunk and related name, so
+            only a chunk of owners and their latest instances is held in
+            memory at a time.
+        """
+        if size < 1:
+            raise ValueError('chunk size must be a positive integer')
+        # parse_latest flags the queryset it's called on as parsed
+        queryset = self._clone()
+        rows = super(TimeSeriesQuerySet, queryset).iterator()
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                return
+            queryset._prefetch_chunk(chunk)
+            yield chunk
+
+    def iterator(self, chunk_size=None):
+        """
+            Like QuerySet.iterator, which ignores prefetch lookups, unless
+            chunk_size is given. The instances are then streamed through
+            iter_chunks(chunk_size), resolving prefetch_latest per chunk.
+        """
+        if chunk_size is None:
+            return super(TimeSeriesQuerySet, self).iterator()
+        return (
+            instance for chunk in self.iter_chunks(chunk_size)
+            for instance in chunk
+        )
+
+    def _prefetch_chunk(self, chunk):
+        instances = [obj for obj in chunk if isinstance(obj, self.model)]
+        lookups = [
+            lookup for lookup in self._prefetch_related_lookups
+            if getattr(lookup, 'to_attr', None) not in self.latest_registry
+        ]
+        if not instances or not (lookups or self._latest_strategies):
+            return
+        if not self._latest_strategies:
+            prefetch_lookups(instances, lookups)
+            return
+
+        self._prefetch_cached_latest(instances)
+        # the latest strategies look up the chunk's owners only instead of
+        # every owner of the queryset
+        owners = self.model._base_manager.using(self.db).filter(
+            pk__in=[obj.pk for obj in instances]
+        )
+        for related_name, get_latest in self._latest_strategies.items():
+            if related_name in self._cached_latest:
+                continue
+            rev_rel = get_reverse_relation(self.model, related_name)
+            lookups.append(Prefetch(
+                related_name,
+                queryset=get_latest(owners, rev_rel),
+                to_attr='latest_{}'.format(related_name)
+            ))
+        related_name = ','.join(sorted(self._latest_strategies))
+        with measure('prefetch_latest', self.model, related_name,
+                     self.db) as measured:
+            prefetch_lookups(instances, lookups)
+            measured.owners = len(instances)
+        for obj in instances:
+            self.parse_latest(obj)
+
+    def _prefetch_cached_latest(self, instances):
+        from timeseries.cache import get_cached_latest
+
+        # sets the latest_{related_name} lists of the relations read through
+        # TIMESERIES_CACHE, which have no Prefetch lookup
+        instances = [obj for obj in instances if isinstance(obj, self.model)]
+        if not instances:
+            return
+        for related_name in self._cached_latest:
+            get_latest = self._latest_strategies[related_name]
+            rev_rel = get_reverse_relation(self.model, related_name)
+            with measure('prefetch_latest', self.model, related_name,
+                         self.db) as measured:
+                latest = get_cached_latest(
+                    self, rev_rel, get_latest, [obj.pk for obj in instances]
+                )
+                measured.owners = len(instances)
+            attr_name = 'latest_{}'.format(related_name)
+            for obj in instances:
+                instance = latest.get(obj.pk)
+                setattr(obj, attr_name, [] if instance is None else [instance])
+
     def parse_latest(self, res):
         """
             Checks the prefetched data and assigns either the found object or
@@ -103,10 +276,19 @@ class TimeSeriesQuerySet(models.QuerySet):
                     self.parse_latest(res)
                 yield res
 
-    def last_updated(self, related_name):
+    def last_updated(self, *related_names):
         """
             Annotates the created timestamp of the latest related instance as
-            given by the reverse relation's related_name.
+            given by each of the reverse relations' related_names, as
+            {related_name}_last_updated.
+
+            Each annotation is a correlated subquery (see LastUpdated) rather
+            than a join, so that annotating several relations doesn't
+            multiply the rows the query has to group.
+
+            If the model has a denormalized {related_name}_last_updated field
+            (see refresh_last_updated) it is used as is and no annotation is
+            added.
 
             Usage:
                 ad = Ad.objects.last_updated('rawdata').first()
@@ -115,33 +297,400 @@ class TimeSeriesQuerySet(models.QuerySet):
                 # prints the timestamp associated to when the ad's raw data was
                 # last updated
         """
-        return self.annotate(
-            **{
-                related_name + '_last_updated': Max(
-                    related_name + '__created'
+        if not related_names:
+            raise TypeError('At least one related_name is required')
+        annotations = {}
+        for related_name in related_names:
+            rev_rel = get_reverse_relation(self.model, related_name)
+            if get_last_updated_field(self.model, related_name) is None:
+                annotations[related_name + '_last_updated'] = LastUpdated(
+                    rev_rel
                 )
-            }
+        if not annotations:
+            return self.all()
+        return self.annotate(**annotations)
+
+    def annotate_latest(self, related_name, *field_names):
+        """
+            Annotates the values of the given fields of the latest related
+            instance (as given by related_name) as
+            {related_name}_latest_{field_name}, e.g. rawdata_latest_views.
+
+            Each annotation is a correlated subquery (see LatestValue) served
+            by the (owner, -created) index, so that the annotations can be
+            used in filter, order_by and values without joining the related
+            table's history. Ties on created are broken by the highest
+            primary key, as with prefetch_latest.
+
+            Usage:
+                Ad.objects.annotate_latest('rawdata', 'views').order_by(
+                    '-rawdata_latest_views'
+                )
+        """
+        if not field_names:
+            raise TypeError('At least one field name is required')
+        rev_rel = check_reverse_relation(self.model, related_name)
+        check_row_model(rev_rel.field.model)
+        return self.annotate(**dict(
+            ('{}_latest_{}'.format(related_name, name),
+             LatestValue(rev_rel, name))
+            for name in field_names
+        ))
+
+    def as_of(self, related_name, timestamp, strategy=None):
+        """
+            Point in time lookup of the latest related instance (as given by
+            related_name) of each owner of the queryset created at or before
+            timestamp.
+
+            Given a single datetime (or date or ISO 8601 string, see
+            to_datetime), a queryset of these related instances is returned,
+            looked up with the latest strategy (see prefetch_latest)
+            restricted to created <= timestamp, which the (owner, -created)
+            index serves.
+
+            Given a list or tuple of datetimes, an ordered dictionary mapping
+            each of them to a dictionary of the owners' primary keys and
+            their latest related instance at that time is returned, looked
+            up in a single query for all the timestamps (see
+            select_snapshots). Owners without related instances by then are
+            left out.
+
+            Usage:
+                Ad.objects.as_of('rawdata', month_start).aggregate(
+                    Sum('views')
+                )
+        """
+        rev_rel = check_reverse_relation(self.model, related_name)
+        check_row_model(rev_rel.field.model)
+        if not isinstance(timestamp, (list, tuple)):
+            timestamp = to_datetime(timestamp)
+            if not isinstance(timestamp, datetime):
+                raise TypeError(
+                    'timestamp must be a datetime, a date, an ISO 8601 '
+                    'string or a list or tuple of them'
+                )
+            get_latest = get_latest_strategy(connections[self.db], strategy)
+            return get_latest(self, rev_rel, as_of=timestamp)
+
+        timestamps = list(timestamp)
+        snapshots = OrderedDict((value, {}) for value in timestamps)
+        if not timestamps:
+            return snapshots
+        attname = rev_rel.field.attname
+        for instance in select_snapshots(self, rev_rel, timestamps):
+            snapshots[timestamps[instance.ts_snapshot]][
+                getattr(instance, attname)
+            ] = instance
+        return snapshots
+
+    def refresh_last_updated(self, related_name):
+        """
+            Sets the denormalized {related_name}_last_updated field of every
+            instance in the queryset to the created timestamp of its latest
+            related instance, using a single UPDATE statement.
+
+            update_timeseries keeps the field up to date on its own. This
+            method only needs calling when related instances are written (or
+            deleted) by other means.
+
+            Returns the number of updated rows.
+        """
+        rev_rel = get_reverse_relation(self.model, related_name)
+        field = get_last_updated_field(self.model, related_name)
+        if field is None:
+            raise FieldDoesNotExist(
+                '{} has no {}_last_updated field'.format(
+                    self.model.__name__, related_name
+                )
+            )
+        return self.update(
+            **{field.name: LastUpdated(rev_rel)}
         )
 
-    def filter_outdated(self, related_name):
+    def filter_outdated(self, *related_names, **kwargs):
         """
             Returns a queryset that will yield the model instances that have
             "outdated" data associated to reverse related model as given by
             the specified related_name
+
+            Given several related_names, mode="any" (the default) yields the
+            instances with outdated data in any of the relations and
+            mode="all" those with outdated data in all of them.
+        """
+        mode = kwargs.pop('mode', 'any')
+        if kwargs:
+            raise TypeError(
+                'Unexpected keyword arguments: {}'.format(', '.join(kwargs))
+            )
+        if mode not in ('any', 'all'):
+            raise ValueError('mode must either be "any" or "all"')
+
+        now = utcnow()
+        condition = None
+        for related_name in related_names:
+            rev_rel = get_reverse_relation(self.model, related_name)
+            RelatedModel = rev_rel.field.model
+            is_safe_cutoff = now - get_interval(RelatedModel)
+            last_updated_query = {
+                '{}_last_updated__lt'.format(related_name): is_safe_cutoff
+            }
+            outdated = Q(**last_updated_query) | Q(
+                **{'{}_last_updated__isnull'.format(related_name): True}
+            )
+            if condition is None:
+                condition = outdated
+            elif mode == 'any':
+                condition |= outdated
+            else:
+                condition &= outdated
+        queryset = self.last_updated(*related_names).filter(condition)
+        queryset._instrumented_phase = (
+            'filter_outdated', ','.join(related_names)
+        )
+        return queryset
+
+    def resample(self, related_name, aggregates, bucket=timedelta(hours=1),
+                 start=None, end=None, fill=False):
+        """
+            Aggregates the related instances (as given by related_name) of the
+            queryset per owner and per time bucket, entirely in SQL.
+
+            aggregates: dictionary mapping field names to aggregate classes,
+                        e.g. {'views': Avg}, aliased like Django's default
+                        aggregate aliases ("views__avg"). An aggregate
+                        instance may be given instead of a class in which
+                        case its key is used as its alias.
+            bucket: bucket width as a timedelta or in seconds. Buckets are
+                    aligned to the Unix epoch (UTC).
+            start, end: optional created range [start, end)
+
+            Returns a values queryset of dictionaries holding the owner's
+            primary key (keyed by the ForeignKey's name), the bucket's start
+            timestamp ("bucket") and the aggregates, ordered by owner and
+            bucket.
+
+            If "fill" is True (start and end are then required) a list is
+            returned instead that also holds a row, with None aggregates, for
+            every owner and bucket without related instances. On PostgreSQL
+            the gaps are filled in SQL with generate_series.
+
+            The points of TimeSeriesBlockModel relations are decoded and
+            aggregated with NumPy instead (see resample_blocks) and a list
+            is always returned.
         """
         rev_rel = get_reverse_relation(self.model, related_name)
+        field_name = rev_rel.field.name
         RelatedModel = rev_rel.field.model
-        is_safe_cutoff = utcnow() - get_interval(RelatedModel)
-        annotated_queryset = self.last_updated(related_name)
-        last_updated_query = {
-            '{}_last_updated__lt'.format(related_name): is_safe_cutoff
-        }
-        return annotated_queryset.filter(
-            Q(**last_updated_query) |
-            Q(**{'{}_last_updated__isnull'.format(related_name): True})
+        connection = connections[self.db]
+        seconds = int(parse_interval(bucket).total_seconds())
+        if seconds < 1:
+            raise ValueError('bucket must be at least one second wide')
+        if fill and (start is None or end is None):
+            raise ValueError('start and end are required to fill gaps')
+        if get_block_width(RelatedModel) is not None:
+            return resample_blocks(
+                self, related_name, aggregates, seconds, start, end, fill
+            )
+
+        queryset = RelatedModel.objects.using(self.db).filter(
+            **{field_name + '__in': self.order_by().values('pk')}
         )
+        if start is not None:
+            queryset = queryset.filter(created__gte=start)
+        if end is not None:
+            queryset = queryset.filter(created__lt=end)
 
-    def update_timeseries(self, related_name, collector, force=False):
+        annotations = {}
+        for name, aggregate in aggregates.items():
+            if isinstance(aggregate, type):
+                aggregate = aggregate(name)
+                name = aggregate.default_alias
+            annotations[name] = aggregate
+
+        resampled = queryset.annotate(
+            bucket=bucket_expression(connection, RelatedModel, seconds)
+        ).values(field_name, 'bucket').annotate(
+            **annotations
+        ).order_by(field_name, 'bucket')
+
+        if not fill:
+            return resampled
+        if connection.vendor == 'postgresql':
+            return fill_buckets_sql(
+                self, resampled, field_name, annotations, seconds, start, end
+            )
+        return fill_buckets(
+            self, resampled, field_name, annotations, seconds, start, end
+        )
+
+    def find_gaps(self, related_name, start=None, end=None, tolerance=None):
+        """
+            Returns a list of Gap(owner, start, end) tuples, ordered by owner
+            and start, for every stretch of more than TIMESERIES_INTERVAL
+            plus tolerance (half the interval by default) without related
+            instances (as given by related_name) between start (optional)
+            and end (defaults to now). A gap's start and end are the created
+            timestamps of the instances around it, or the start and end
+            arguments.
+
+            The gaps are found in a single query comparing each instance's
+            created timestamp with the previous one using the LAG window
+            function. N.B. owners without any related instance only have a
+            gap if start is given.
+        """
+        rev_rel = get_reverse_relation(self.model, related_name)
+        check_row_model(rev_rel.field.model)
+        interval = get_interval(rev_rel.field.model)
+        if tolerance is None:
+            tolerance = interval // 2
+        min_gap = (interval + parse_interval(tolerance)).total_seconds()
+        if end is None:
+            end = utcnow()
+        return select_gaps(self, rev_rel, start, end, min_gap)
+
+    def backfill(self, related_name, collector, start=None, end=None,
+                 batch_size=None, tolerance=None):
+        """
+            Fills the gaps found by find_gaps with the data of a backfill
+            collector.
+
+            "collector" is called with a queryset of the owners missing data
+            in a given window and the window's start and end timestamps, once
+            per distinct window and per batch_size owners. It must return an
+            iterable of dictionaries like update_timeseries collectors, but
+            including the created timestamps of the missing data points,
+            which are written as given.
+
+            Rows are inserted batch_size (all if None) at a time, each batch
+            in its own transaction, and upserted for models setting
+            TIMESERIES_UPSERT. Returns an UpdateSummary.
+        """
+        from timeseries.writers import (
+            insert_rows, iter_batches, write_batches
+        )
+
+        rev_rel = get_reverse_relation(self.model, related_name)
+        RelatedModel = rev_rel.field.model
+        windows = OrderedDict()
+        for gap in self.find_gaps(related_name, start, end, tolerance):
+            windows.setdefault((gap.start, gap.end), []).append(gap.owner)
+
+        mode = get_upsert_mode(RelatedModel)
+
+        def write(rev_rel, rows, using):
+            return insert_rows(rev_rel, rows, using, mode, keep_created=True)
+
+        summary = UpdateSummary()
+        for (gap_start, gap_end), pks in windows.items():
+            for batch in iter_batches(pks, batch_size):
+                owners = self.filter(pk__in=batch)
+                results = measure_iteration(
+                    collector(owners, gap_start, gap_end), 'collect',
+                    self.model, related_name, self.db
+                )
+                write_batches(rev_rel, results, batch_size, summary, write)
+        return summary
+
+    def to_arrays(self, related_name, fields=None, start=None, end=None,
+                  group_by_owner=False, chunk_size=None):
+        """
+            Fetches the related instances (as given by related_name) of the
+            queryset into NumPy arrays without building model instances
+            (requires NumPy, see timeseries.arrays).
+
+            fields: names of the related model's fields to fetch, defaults to
+                    all of its fields except the primary key, the
+                    ForeignKeys and created.
+            start, end: optional created range [start, end)
+            group_by_owner: see below
+            chunk_size: number of rows turned into array values at a time,
+                        and on Django 2.0+ fetched from the database per
+                        round trip as well
+
+            Returns a dictionary of arrays holding the owner's primary key
+            (keyed by the ForeignKey's name), "created" (as datetime64 in
+            UTC) and the fields, ordered by owner and created. If
+            group_by_owner is True a dictionary mapping each owner's primary
+            key to its dictionary of "created" and field arrays is returned
+            instead.
+
+            The blocks of TimeSeriesBlockModel relations overlapping the
+            range are streamed a block at a time and their points decoded
+            with vectorized NumPy operations. fields then defaults to the
+            BlockFields holding values.
+        """
+        from timeseries.arrays import (
+            fetch_arrays, fetch_block_arrays, group_arrays
+        )
+
+        rev_rel = get_reverse_relation(self.model, related_name)
+        field_name = rev_rel.field.name
+        RelatedModel = rev_rel.field.model
+        opts = RelatedModel._meta
+        is_block = get_block_width(RelatedModel) is not None
+        if fields is None and is_block:
+            fields = [field.name for field in get_block_fields(RelatedModel)]
+        elif fields is None:
+            fields = [
+                field.name for field in opts.concrete_fields
+                if not field.primary_key and not field.is_relation and
+                field.name != 'created'
+            ]
+
+        queryset = RelatedModel._base_manager.using(self.db).filter(
+            **{field_name + '__in': self.order_by().values('pk')}
+        )
+        names = [field_name, 'created'] + list(fields)
+        if is_block:
+            unknown = set(fields) - set(
+                field.name for field in get_block_fields(RelatedModel)
+            )
+            if unknown:
+                raise ValueError('{} are not BlockFields of {}'.format(
+                    ', '.join(sorted(unknown)), RelatedModel.__name__
+                ))
+            # created is the timestamp of a block's latest point
+            if start is not None:
+                queryset = queryset.filter(created__gte=start)
+            if end is not None:
+                queryset = queryset.filter(start__lt=end)
+            arrays = fetch_block_arrays(
+                queryset.order_by(field_name, 'start'), names, [
+                    opts.get_field(name)
+                    for name in [field_name, 'timestamps'] + list(fields)
+                ], start, end, chunk_size
+            )
+        else:
+            if start is not None:
+                queryset = queryset.filter(created__gte=start)
+            if end is not None:
+                queryset = queryset.filter(created__lt=end)
+            arrays = fetch_arrays(
+                queryset.order_by(field_name, 'created'), names,
+                [opts.get_field(name) for name in names], chunk_size
+            )
+        if group_by_owner:
+            return group_arrays(arrays, field_name)
+        return arrays
+
+    def to_dataframe(self, related_name, fields=None, start=None, end=None,
+                     chunk_size=None):
+        """
+            Same as to_arrays but returns the related instances as a single
+            pandas DataFrame (requires pandas).
+        """
+        from timeseries.arrays import to_dataframe
+
+        return to_dataframe(self.to_arrays(
+            related_name, fields=fields, start=start, end=end,
+            chunk_size=chunk_size
+        ))
+
+    def update_timeseries(self, related_name, collector=None, force=False,
+                          batch_size=None, workers=None, pool='thread',
+                          concurrency=None, backend=None, claim=False,
+                          since=False):
         """
             Updates the queryset's related model table
             (as given by related_name) using a provider "collector" callable.
@@ -151,9 +700,77 @@ class TimeSeriesQuerySet(models.QuerySet):
             that can be used to construct and save instances of the related
             model.
 
+            If "batch_size" is given the collector's results are consumed
+            lazily and written in chunks of at most batch_size instances, each
+            chunk in its own transaction (or savepoint). An UpdateSummary is
+            returned instead of the list of created instances.
+
+            "backend" picks how rows are written, see get_write_backend. By
+            default batches are streamed into COPY on PostgreSQL and saved
+            with bulk_create elsewhere. Unbatched updates use bulk_create
+            unless a backend is given, in which case the rows are written
+            as a single batch and an UpdateSummary is returned. Models
+            setting TIMESERIES_UPSERT are always written with the "upsert"
+            backend, so that retried or forced updates replace (or keep) the
+            row of an owner's current interval instead of appending one, and
+            TimeSeriesBlockModel subclasses with the "block" backend.
+
+            If "workers" is given the outdated instances are split into that
+            many primary key ordered shards which are collected and written
+            concurrently, each on its own database connection, using either
+            a "thread" or a "process" pool. An UpdateSummary is returned whose
+            "shards" attribute holds the summary of each individual shard. In
+            process mode the collector must be picklable.
+
+            If "claim" is True several processes or hosts can update the same
+            queryset at once without collecting or writing an owner twice.
+            Each call repeatedly claims (locks) up to batch_size outdated
+            owners that no other transaction holds, collects and writes them
+            in that transaction, and releases them on commit (see
+            timeseries.workers.claim_owners, PostgreSQL only). An
+            UpdateSummary is returned.
+
+            "collector" may also be an async generator function taking the
+            queryset, or a coroutine function taking a single model instance
+            and returning a dictionary, an iterable of dictionaries or None.
+            Coroutine collectors are run with at most "concurrency" calls in
+            flight (see timeseries.aio, Python 3.5+ only).
+
+            If "since" is True the collector's queryset is annotated with
+            each owner's {related_name}_last_updated timestamp, so that only
+            the data created since can be requested from upstream. "since"
+            may also be an iterable of field names of the related model whose
+            latest values are annotated as {related_name}_latest_{field_name}
+            as well. The annotations are correlated subqueries resolved with
+            the owners, in a single query.
+
+            "collector" can be omitted for rollup models (see
+            TimeSeriesModel), which are then filled in the database by a
+            single INSERT ... SELECT statement aggregating the source rows
+            created after the rollup_end of each owner's latest rollup row.
+            An UpdateSummary is returned.
+
             N.B. Only instances that have outdated data will be updated unless
             explicitly forced using the "force" keyword argument.
         """
+        with measure('update', self.model, related_name, self.db) as measured:
+            output = self._update_timeseries(
+                related_name, collector, force, batch_size, workers, pool,
+                concurrency, backend, claim, since
+            )
+            if isinstance(output, UpdateSummary):
+                measured.rows = output.rows
+                measured.errors = len(output.failures)
+            else:
+                measured.rows = len(output)
+        return output
+
+    def _update_timeseries(self, related_name, collector, force, batch_size,
+                           workers, pool, concurrency, backend, claim, since):
+        from timeseries.rollups import insert_rollup
+        from timeseries.workers import update_claimed, update_sharded
+        from timeseries.writers import write_batches
+
         # N.B. runs two queries as such is subject to errors resulting from
         # multitenancy race conditions.
         rev_rel = get_reverse_relation(self.model, related_name)
@@ -163,12 +780,87 @@ class TimeSeriesQuerySet(models.QuerySet):
         else:
             models = self.filter_outdated(related_name)
 
-        results = collector(models)
-        instances = [RelatedModel(**data) for data in results]
-        output = RelatedModel.objects.bulk_create(instances)
+        if claim:
+            if workers is not None:
+                raise ValueError('claim and workers are mutually exclusive')
+            return update_claimed(
+                self, related_name, collector, batch_size, concurrency,
+                backend, force, since
+            )
+
+        if collector is None:
+            if get_rollup(RelatedModel) is None:
+                raise ValueError(
+                    '{} is not a rollup model, a collector is required'.format(
+                        RelatedModel.__name__
+                    )
+                )
+            return insert_rollup(models, rev_rel)
+
+        if workers is not None:
+            return update_sharded(
+                self, related_name, collector, batch_size, workers, pool,
+                concurrency, backend, force, since
+            )
+
+        results = collect(
+            collector, models, concurrency, related_name, since
+        )
+        if batch_size is not None or backend is not None or \
+                get_upsert_mode(RelatedModel) is not None or \
+                get_block_width(RelatedModel) is not None:
+            return write_batches(rev_rel, results, batch_size, backend=backend)
+        rows = list(results)
+        using = router.db_for_write(RelatedModel)
+        with measure('instantiate', RelatedModel, related_name, using) as \
+                measured:
+            instances = [RelatedModel(**data) for data in rows]
+            measured.rows = len(instances)
+        with measure('write', RelatedModel, related_name, using) as measured, \
+                transaction.atomic(using=using):
+            output = RelatedModel.objects.bulk_create(instances)
+            sync_last_updated(rev_rel, output)
+            measured.rows = len(output)
         return output
 
 
+def prefetch_lookups(instances, lookups):
+    # prefetch_related_objects takes the lookups as a list before Django 1.10
+    if django.VERSION[:2] < (1, 10):
+        return prefetch_related_objects(instances, lookups)
+    return prefetch_related_objects(instances, *lookups)
+
+
+class UpdateSummary(object):
+    """
+        Outcome of a batched update_timeseries call.
+
+        rows: number of related instances written
+        batches: number of batches written
+        failures: list of (batch_number, exception) tuples for the batches
+                  that were rolled back. batch_number is None when the
+                  collector itself raised.
+        shards: list of the per shard summaries of a sharded update
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.failures = []
+        self.shards = []
+
+    def add_shard(self, summary):
+        self.rows += summary.rows
+        self.batches += summary.batches
+        self.failures.extend(summary.failures)
+        self.shards.append(summary)
+
+    def __repr__(self):
+        return '<UpdateSummary rows={} batches={} failures={}>'.format(
+            self.rows, self.batches, len(self.failures)
+        )
+
+
 class TimeSeriesManager(models.Manager.from_queryset(TimeSeriesQuerySet)):
     pass
 
@@ -180,8 +872,58 @@ class TimeSeriesModel(models.Model):
 
         N.B. TimeSeries models should have a ForeignKey reference to an
         "owning" model and TIMESERIES_INTERVAL timedelta instance.
+
+        A composite (owner, -created) index is added for each ForeignKey
+        unless TIMESERIES_INDEX is set to False.
+
+        Rollup models are computed from a finer grained timeseries of the
+        same owning model. They name the owning model's reverse relation to
+        their source in TIMESERIES_ROLLUP_SOURCE and map their fields to
+        aggregates of the source's fields in TIMESERIES_ROLLUP_AGGREGATES,
+        e.g. {'avg_views': Avg('views')}. A rollup_end column holding the
+        created timestamp of the latest source row aggregated into each row
+        is added to them.
+
+        Rows older than TIMESERIES_RETENTION (a timedelta or seconds, None to
+        keep every row) are deleted by timeseries.retention.prune_timeseries,
+        except for the latest row of each owner. TIMESERIES_DOWNSAMPLE
+        optionally names the owning model's reverse relation to a rollup of
+        this model which is brought up to date before rows are deleted.
+
+        On PostgreSQL 11+ the table can be range partitioned on created, see
+        timeseries.partitions. TIMESERIES_PARTITION sets the width of each
+        partition as a timedelta or seconds.
+
+        Setting TIMESERIES_UPSERT to "update" or "ignore" adds an
+        interval_bucket column, holding created floored to the epoch aligned
+        TIMESERIES_INTERVAL, and a unique (owner, interval_bucket) constraint
+        for each ForeignKey. update_timeseries then writes with the "upsert"
+        backend, which updates (or keeps) the row already written for an
+        owner's current interval instead of appending a duplicate.
+
+        Setting TIMESERIES_CACHE to the alias of a Django cache makes
+        prefetch_latest read the latest row of each owner through that cache
+        (see timeseries.cache), optionally storing only the fields named in
+        TIMESERIES_CACHE_FIELDS. update_timeseries refreshes the entries of
+        the owners it writes once its transaction commits and entries expire
+        after TIMESERIES_INTERVAL, which bounds the staleness caused by rows
+        written by other means.
     """
 
+    TIMESERIES_INDEX = True
+
+    TIMESERIES_UPSERT = None
+
+    TIMESERIES_CACHE = None
+
+    TIMESERIES_CACHE_FIELDS = None
+
+    TIMESERIES_RETENTION = None
+
+    TIMESERIES_DOWNSAMPLE = None
+
+    TIMESERIES_PARTITION = None
+
     created = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
@@ -190,6 +932,279 @@ class TimeSeriesModel(models.Model):
         get_latest_by = 'created'
 
 
+def add_latest_indexes(sender, **kwargs):
+    """
+        class_prepared receiver that adds a composite (owner, -created) index
+        for each ForeignKey of concrete TimeSeriesModel subclasses.
+        Meta.indexes is used where available (Django 1.11+) and
+        index_together otherwise.
+    """
+    if not issubclass(sender, TimeSeriesModel) or sender._meta.abstract or \
+            not sender.TIMESERIES_INDEX:
+        return
+    opts = sender._meta
+    for field in opts.fields:
+        if not field.many_to_one or has_latest_index(sender, field):
+            continue
+        if hasattr(models, 'Index'):
+            index = models.Index(fields=[field.name, '-created'])
+            index.set_name_with_model(sender)
+            opts.indexes.append(index)
+        else:
+            opts.index_together = tuple(opts.index_together) + (
+                (field.name, 'created'),
+            )
+
+
+class_prepared.connect(add_latest_indexes)
+
+
+UPSERT_MODES = ('update', 'ignore')
+
+INTERVAL_BUCKET_FIELD = 'interval_bucket'
+
+
+class IntervalBucketField(models.DateTimeField):
+    """
+        DateTimeField computing its value from the instance's created
+        timestamp floored to the epoch aligned TIMESERIES_INTERVAL of its
+        model. Nullable so that it can be added to existing tables.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super(IntervalBucketField, self).__init__(*args, **kwargs)
+
+    def get_bucket(self, created):
+        if created is None:
+            return None
+        seconds = int(get_interval(self.model).total_seconds())
+        return floor_bucket(created, seconds)
+
+    def pre_save(self, model_instance, add):
+        # created is an earlier field, so auto_now_add has already set it
+        value = self.get_bucket(model_instance.created)
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def add_interval_bucket(sender, **kwargs):
+    """
+        class_prepared receiver that adds an IntervalBucketField and a unique
+        (owner, interval_bucket) constraint for each ForeignKey to concrete
+        TimeSeriesModel subclasses that set TIMESERIES_UPSERT.
+    """
+    if not issubclass(sender, TimeSeriesModel) or sender._meta.abstract or \
+            get_upsert_mode(sender) is None:
+        return
+    opts = sender._meta
+    try:
+        field = opts.get_field(INTERVAL_BUCKET_FIELD)
+    except FieldDoesNotExist:
+        IntervalBucketField().contribute_to_class(
+            sender, INTERVAL_BUCKET_FIELD
+        )
+    else:
+        if not isinstance(field, IntervalBucketField):
+            raise TypeError('{}.{} must be an IntervalBucketField'.format(
+                sender.__name__, INTERVAL_BUCKET_FIELD
+            ))
+    unique_together = [tuple(fields) for fields in opts.unique_together]
+    for field in opts.fields:
+        key = (field.name, INTERVAL_BUCKET_FIELD)
+        if field.many_to_one and key not in unique_together:
+            unique_together.append(key)
+    opts.unique_together = tuple(unique_together)
+
+
+class_prepared.connect(add_interval_bucket)
+
+
+ROLLUP_END_FIELD = 'rollup_end'
+
+
+def add_rollup_end(sender, **kwargs):
+    """
+        class_prepared receiver that adds a rollup_end DateTimeField to
+        concrete rollup models, holding the created timestamp of the latest
+        source row aggregated into each row. Nullable so that it can be
+        added to existing tables.
+    """
+    if not issubclass(sender, TimeSeriesModel) or sender._meta.abstract or \
+            get_rollup(sender) is None:
+        return
+    try:
+        sender._meta.get_field(ROLLUP_END_FIELD)
+    except FieldDoesNotExist:
+        models.DateTimeField(null=True, editable=False).contribute_to_class(
+            sender, ROLLUP_END_FIELD
+        )
+
+
+class_prepared.connect(add_rollup_end)
+
+
+def get_upsert_mode(model):
+    """
+        Helper method to facilitate the retrieval of TIMESERIES_UPSERT, either
+        "update", "ignore" or None if rows are always appended.
+    """
+    mode = getattr(model, 'TIMESERIES_UPSERT', None)
+    if mode is not None and mode not in UPSERT_MODES:
+        raise ValueError('TIMESERIES_UPSERT must be one of {} or None'.format(
+            ', '.join(UPSERT_MODES)
+        ))
+    return mode
+
+
+class BlockField(models.BinaryField):
+    """
+        BinaryField holding a TimeSeriesBlockModel block's array of
+        timestamps ("datetime"), integers ("int64") or floats ("float64"),
+        encoded by timeseries.blocks.
+    """
+
+    def __init__(self, kind='int64', *args, **kwargs):
+        if kind not in blocks.KINDS:
+            raise ValueError('kind must be one of {}'.format(
+                ', '.join(blocks.KINDS)
+            ))
+        self.kind = kind
+        kwargs.setdefault('default', blocks.encode([], kind))
+        super(BlockField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(BlockField, self).deconstruct()
+        kwargs['kind'] = self.kind
+        kwargs.pop('default', None)
+        return name, path, args, kwargs
+
+
+class TimeSeriesBlockModel(TimeSeriesModel):
+    """
+        Abstract TimeSeriesModel storing a row per owner and per epoch
+        aligned TIMESERIES_BLOCK (a timedelta or seconds, a day by default)
+        instead of a row per data point, for dense series where the per row
+        overhead outweighs the data.
+
+        The block's points are held by its BlockFields: "timestamps" and
+        one BlockField per value, e.g. views = BlockField('int64'). "start"
+        is the block's start, "size" its number of points and "created" the
+        timestamp of its latest point, so that last_updated,
+        filter_outdated, prefetch_latest (see latest_point) and retention
+        work as with a row per point. A unique (owner, start) constraint is
+        added for each ForeignKey.
+
+        update_timeseries writes with the "block" backend (see
+        timeseries.writers.write_blocks), appending the collected points to
+        their open block. Blocks are read with decode and latest_point, or
+        per owner with TimeSeriesQuerySet.to_arrays and resample (which
+        require NumPy).
+        Rollups, upserts, annotate_latest and find_gaps work on rows and
+        aren't supported.
+    """
+
+    TIMESERIES_BLOCK = timedelta(days=1)
+
+    start = models.DateTimeField()
+    size = models.IntegerField(default=0)
+    timestamps = BlockField('datetime')
+
+    class Meta(TimeSeriesModel.Meta):
+        abstract = True
+
+    def decode(self):
+        """
+            Returns an ordered dictionary of the lists of the block's point
+            timestamps ("created") and values, keyed by field name.
+        """
+        created = blocks.decode(self.timestamps, 'datetime')
+        if not settings.USE_TZ:
+            created = [value.replace(tzinfo=None) for value in created]
+        points = OrderedDict([('created', created)])
+        for field in get_block_fields(type(self)):
+            points[field.name] = blocks.decode(
+                getattr(self, field.attname), field.kind
+            )
+        return points
+
+    def latest_point(self):
+        """
+            Returns a dictionary of the block's latest point "created"
+            timestamp and values, None if the block is empty.
+        """
+        points = self.decode()
+        if not points['created']:
+            return None
+        return dict((name, values[-1]) for name, values in points.items())
+
+
+def add_block_keys(sender, **kwargs):
+    """
+        class_prepared receiver that adds a unique (owner, start) constraint
+        for each ForeignKey of concrete TimeSeriesBlockModel subclasses.
+    """
+    if not issubclass(sender, TimeSeriesBlockModel) or \
+            sender._meta.abstract:
+        return
+    if get_upsert_mode(sender) is not None:
+        raise TypeError(
+            '{} is a TimeSeriesBlockModel, blocks are always merged and '
+            "can't set TIMESERIES_UPSERT".format(sender.__name__)
+        )
+    opts = sender._meta
+    unique_together = [tuple(fields) for fields in opts.unique_together]
+    for field in opts.fields:
+        key = (field.name, 'start')
+        if field.many_to_one and key not in unique_together:
+            unique_together.append(key)
+    opts.unique_together = tuple(unique_together)
+
+
+class_prepared.connect(add_block_keys)
+
+
+def get_block_width(model):
+    """
+        Helper method to facilitate the retrieval of TIMESERIES_BLOCK as a
+        timedelta, or None if the model isn't a TimeSeriesBlockModel.
+    """
+    if not issubclass(model, TimeSeriesBlockModel):
+        return None
+    return parse_interval(model.TIMESERIES_BLOCK)
+
+
+def get_block_fields(model):
+    """
+        Returns the BlockFields of a TimeSeriesBlockModel holding values,
+        i.e. all of them but the timestamps.
+    """
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, BlockField) and field.name != 'timestamps'
+    ]
+
+
+def has_latest_index(model, field):
+    """
+        Checks whether the model declares an index whose leading columns are
+        the given ForeignKey field and created.
+    """
+    opts = model._meta
+    declared = [
+        [name.lstrip('-') for name in index.fields]
+        for index in getattr(opts, 'indexes', [])
+    ]
+    declared.extend(list(fields) for fields in opts.index_together)
+    declared.extend(list(fields) for fields in opts.unique_together)
+    return any(
+        fields[:2] == [field.name, 'created'] or
+        fields[:2] == [field.attname, 'created']
+        for fields in declared
+    )
+
+
 def LatestQ(related_name, **kwargs):
     """
         Constructs a django.db.models.Q instance that allows queries to be
@@ -206,7 +1221,7 @@ def LatestQ(related_name, **kwargs):
     parsed_kwargs = {
         related_name + "__created": F(related_name + '_last_updated')
     }
-    for key, value in kwargs.iteritems():
+    for key, value in kwargs.items():
         parsed_kwargs[related_name + '__' + key] = value
     return Q(**parsed_kwargs)
 
@@ -229,6 +1244,779 @@ def q_factory(related_name, q_func=LatestQ):
     return wrapper
 
 
+def latest_distinct(queryset, rev_rel, as_of=None):
+    """
+        Latest strategy that sorts the related instances of the queryset by
+        owner and created timestamp and keeps the first of each owner using
+        DISTINCT ON. N.B. PostgreSQL only.
+
+        Latest strategies ignore the related instances created after as_of
+        if given.
+    """
+    field_name = rev_rel.field.name
+    RelatedModel = rev_rel.field.model
+    related = RelatedModel.objects.using(queryset.db).filter(
+        **{field_name + '__in': queryset}
+    )
+    if as_of is not None:
+        related = related.filter(created__lte=as_of)
+    return related.order_by(field_name, '-created').distinct(field_name)
+
+
+def latest_lateral(queryset, rev_rel, as_of=None):
+    """
+        Latest strategy that looks up the latest related instance of each
+        owner in the queryset with a LATERAL join limited to a single row,
+        which can be answered by an index on (owner, created).
+        N.B. PostgreSQL 9.3+ only.
+    """
+    sql = (
+        'SELECT ts_latest.{pk} FROM {owner_table} ts_owner '
+        'CROSS JOIN LATERAL ('
+        'SELECT {pk} FROM {table} WHERE {fk} = ts_owner.{owner_pk}{as_of} '
+        'ORDER BY {created} DESC, {pk} DESC LIMIT 1'
+        ') ts_latest WHERE ts_owner.{owner_pk} IN ({owners})'
+    )
+    return latest_extra(queryset, rev_rel, sql, as_of)
+
+
+def latest_window(queryset, rev_rel, as_of=None):
+    """
+        Latest strategy that ranks the related instances of each owner in the
+        queryset with the ROW_NUMBER window function and keeps the first.
+        Portable to any backend supporting window functions (e.g. SQLite
+        3.25+).
+    """
+    sql = (
+        'SELECT ts_ranked.{pk} FROM ('
+        'SELECT {pk}, ROW_NUMBER() OVER ('
+        'PARTITION BY {fk} ORDER BY {created} DESC, {pk} DESC'
+        ') AS ts_rank FROM {table} WHERE {fk} IN ({owners}){as_of}'
+        ') ts_ranked WHERE ts_ranked.ts_rank = 1'
+    )
+    return latest_extra(queryset, rev_rel, sql, as_of)
+
+
+def latest_extra(queryset, rev_rel, sql, as_of=None):
+    """
+        Helper function that restricts the related model's instances to the
+        primary keys selected by the given sql template, formatted with the
+        quoted table and column names of the relation, the owning
+        queryset's primary key subquery as "owners" and, if as_of is given,
+        an " AND created <= as_of" condition on the related table as
+        "as_of".
+    """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    RelatedModel = rev_rel.field.model
+    related_opts = RelatedModel._meta
+    owner_opts = queryset.model._meta
+    created = related_opts.get_field('created')
+
+    owners_sql, owners_params = queryset.order_by().values('pk').query \
+        .get_compiler(queryset.db).as_sql()
+    params = list(owners_params)
+    as_of_sql = ''
+    if as_of is not None:
+        if '{as_of}' not in sql:
+            raise ValueError('The latest sql template has no {as_of}')
+        as_of_sql = ' AND {}.{} <= %s'.format(
+            qn(related_opts.db_table), qn(created.column)
+        )
+        # the parameters follow the order of the placeholders
+        as_of_params = [created.get_db_prep_value(as_of, connection)]
+        if sql.index('{as_of}') < sql.index('{owners}'):
+            params = as_of_params + params
+        else:
+            params = params + as_of_params
+    sql = sql.format(
+        pk=qn(related_opts.pk.column),
+        table=qn(related_opts.db_table),
+        fk=qn(rev_rel.field.column),
+        created=qn(created.column),
+        owner_table=qn(owner_opts.db_table),
+        owner_pk=qn(owner_opts.pk.column),
+        owners=owners_sql,
+        as_of=as_of_sql,
+    )
+    where = '{}.{} IN ({})'.format(
+        qn(related_opts.db_table), qn(related_opts.pk.column), sql
+    )
+    return RelatedModel.objects.using(queryset.db).extra(
+        where=[where], params=params
+    )
+
+
+def select_snapshots(owners, rev_rel, timestamps):
+    """
+        Helper function that selects the latest related instance of each of
+        the owners at or before each of the timestamps in a single query
+        (see TimeSeriesQuerySet.as_of). The owners are crossed with the
+        timestamps and the primary key of each pair's latest related
+        instance is looked up by a subquery limited to a single row, which
+        the (owner, -created) index answers with a single seek. The
+        instances keep the index of their timestamp as ts_snapshot.
+    """
+    connection = connections[owners.db]
+    qn = connection.ops.quote_name
+    RelatedModel = rev_rel.field.model
+    opts = RelatedModel._meta
+    owner_opts = owners.model._meta
+    created = opts.get_field('created')
+    owners_sql, owners_params = owners.order_by().values('pk').query \
+        .get_compiler(owners.db).as_sql()
+
+    params = []
+    for index, timestamp in enumerate(timestamps):
+        params.extend([index, created.get_db_prep_value(
+            to_datetime(timestamp), connection
+        )])
+    params.extend(owners_params)
+    sql = (
+        'SELECT {table}.*, ts_pick.ts_snapshot FROM ('
+        'SELECT ts_at.ts_snapshot, ('
+        'SELECT {pk} FROM {table} WHERE {fk} = ts_owner.{owner_pk} '
+        'AND {created} <= ts_at.ts_at '
+        'ORDER BY {created} DESC, {pk} DESC LIMIT 1'
+        ') AS ts_pk FROM {owner_table} ts_owner CROSS JOIN ({snapshots}) '
+        'ts_at WHERE ts_owner.{owner_pk} IN ({owners})'
+        ') ts_pick INNER JOIN {table} ON {table}.{pk} = ts_pick.ts_pk '
+        'ORDER BY ts_pick.ts_snapshot, {table}.{fk}'
+    ).format(
+        table=qn(opts.db_table),
+        fk=qn(rev_rel.field.column),
+        created=qn(created.column),
+        pk=qn(opts.pk.column),
+        owner_table=qn(owner_opts.db_table),
+        owner_pk=qn(owner_opts.pk.column),
+        snapshots=' UNION ALL '.join(
+            ['SELECT %s AS ts_snapshot, %s AS ts_at'] * len(timestamps)
+        ),
+        owners=owners_sql,
+    )
+    return RelatedModel._base_manager.db_manager(owners.db).raw(sql, params)
+
+
+def to_datetime(value):
+    """
+        Helper function that converts a date to a datetime at midnight in
+        the current time zone, as DateTimeField lookups do. Strings are
+        parsed as ISO 8601 datetimes or dates, naive datetimes then being
+        in the current time zone. Other values are returned as is.
+    """
+    if isinstance(value, six.string_types):
+        parsed = parse_datetime(value) or parse_date(value)
+        if parsed is None:
+            raise ValueError(
+                '{!r} is not a valid datetime or date'.format(value)
+            )
+        value = parsed
+        if isinstance(value, datetime) and settings.USE_TZ and \
+                timezone.is_naive(value):
+            return timezone.make_aware(value)
+    if isinstance(value, datetime) or not isinstance(value, date):
+        return value
+    value = datetime(value.year, value.month, value.day)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value)
+    return value
+
+
+LATEST_STRATEGIES = {
+    'distinct': latest_distinct,
+    'lateral': latest_lateral,
+    'window': latest_window,
+}
+
+
+def get_latest_strategy(connection, strategy=None):
+    """
+        Helper function that returns the latest strategy callable for the
+        given database connection. strategy can be the name of one of
+        LATEST_STRATEGIES, a callable or None to pick the best strategy
+        supported by the connection's backend.
+    """
+    if callable(strategy):
+        return strategy
+    if strategy is None:
+        strategy = 'lateral' if connection.vendor == 'postgresql' \
+            else 'window'
+    try:
+        return LATEST_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(
+            'Unknown latest strategy "{}", choose one of {}'.format(
+                strategy, ', '.join(sorted(LATEST_STRATEGIES))
+            )
+        )
+
+
+BUCKET_SQL = {
+    'postgresql': (
+        'to_timestamp(floor(extract(epoch from {column}) / %s) * %s)'
+    ),
+    'sqlite': (
+        "datetime(CAST(strftime('%%s', {column}) AS INTEGER) / %s * %s, "
+        "'unixepoch')"
+    ),
+    'mysql': 'FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP({column}) / %s) * %s)',
+}
+
+
+# seconds since an arbitrary epoch, only ever subtracted
+EPOCH_SQL = {
+    'postgresql': 'extract(epoch from {column})',
+    'sqlite': '(julianday({column}) * 86400.0)',
+    'mysql': 'UNIX_TIMESTAMP({column})',
+}
+
+Gap = namedtuple('Gap', 'owner start end')
+
+
+def select_gaps(owners, rev_rel, start, end, min_gap):
+    """
+        Helper function that selects the gaps of more than min_gap seconds
+        between the related instances of the owners (see find_gaps). Each
+        owner also gets a row at end and, if given, at start so that missing
+        data before the first and after the last instance is found too.
+    """
+    connection = connections[owners.db]
+    try:
+        epoch = EPOCH_SQL[connection.vendor]
+    except KeyError:
+        raise NotImplementedError(
+            'Gap detection is not supported on {}'.format(connection.vendor)
+        )
+    qn = connection.ops.quote_name
+    opts = rev_rel.field.model._meta
+    created = opts.get_field('created')
+    owners_sql, owners_params = owners.order_by().values('pk').query \
+        .get_compiler(owners.db).as_sql()
+    owner_pk = qn(owners.model._meta.pk.column)
+
+    points = [
+        'SELECT {fk} AS ts_owner, {created} AS ts_created FROM {table} '
+        'WHERE {fk} IN ({owners}) AND {created} < %s'
+    ]
+    params = list(owners_params) + [created.get_db_prep_value(
+        end, connection
+    )]
+    if start is not None:
+        points[0] += ' AND {created} >= %s'
+        params.append(created.get_db_prep_value(start, connection))
+    for bound in (start, end):
+        if bound is not None:
+            points.append(
+                'SELECT {owner_pk}, %s FROM ({owners}) ts_owner_bound'
+            )
+            params.append(created.get_db_prep_value(bound, connection))
+            params.extend(owners_params)
+    sql = (
+        'SELECT ts_owner, ts_previous, ts_created FROM ('
+        'SELECT ts_owner, ts_created, LAG(ts_created) OVER ('
+        'PARTITION BY ts_owner ORDER BY ts_created'
+        ') AS ts_previous FROM ({points}) ts_point'
+        ') ts_gap WHERE {created_epoch} - {previous_epoch} > %s '
+        'ORDER BY ts_owner, ts_created'
+    ).format(
+        points=' UNION ALL '.join(points).format(
+            fk=qn(rev_rel.field.column),
+            created=qn(created.column),
+            table=qn(opts.db_table),
+            owners=owners_sql,
+            owner_pk=owner_pk,
+        ),
+        created_epoch=epoch.format(column='ts_created'),
+        previous_epoch=epoch.format(column='ts_previous'),
+    )
+    params.append(min_gap)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [
+            Gap(owner, parse_db_datetime(previous), parse_db_datetime(last))
+            for owner, previous, last in cursor.fetchall()
+        ]
+
+
+def resample_blocks(owners, related_name, aggregates, seconds, start, end,
+                    fill):
+    """
+        resample for TimeSeriesBlockModel relations, decoding the points of
+        the owners' blocks into NumPy arrays (see to_arrays) and aggregating
+        them per owner and bucket with ufunc.reduceat. Only aggregates of
+        RESAMPLE_FUNCTIONS over a single BlockField are supported, Count
+        counting every point unless given a BlockField.
+    """
+    from timeseries.arrays import RESAMPLE_FUNCTIONS, resample_arrays
+
+    rev_rel = get_reverse_relation(owners.model, related_name)
+    field_name = rev_rel.field.name
+    names = set(
+        field.name for field in get_block_fields(rev_rel.field.model)
+    )
+    functions = OrderedDict()
+    for alias, aggregate in aggregates.items():
+        if isinstance(aggregate, type):
+            aggregate = aggregate(alias)
+            alias = aggregate.default_alias
+        expressions = aggregate.get_source_expressions()
+        name = getattr(expressions[0], 'name', None) \
+            if len(expressions) == 1 else None
+        if aggregate.name == 'Count' and name not in names:
+            name = 'created'
+        if aggregate.name not in RESAMPLE_FUNCTIONS or \
+                (name not in names and name != 'created'):
+            raise ValueError(
+                'Blocks can only be resampled with {} of a BlockField'.format(
+                    ', '.join(RESAMPLE_FUNCTIONS)
+                )
+            )
+        functions[alias] = (aggregate.name, name)
+
+    arrays = owners.to_arrays(
+        related_name, fields=sorted(
+            set(name for _, name in functions.values()) - set(['created'])
+        ), start=start, end=end
+    )
+    rows = resample_arrays(arrays, field_name, functions, seconds)
+    if fill:
+        return fill_buckets(
+            owners, rows, field_name, functions, seconds, start, end
+        )
+    return rows
+
+
+def parse_db_datetime(value):
+    # SQLite returns computed timestamps as strings in UTC
+    if isinstance(value, six.string_types):
+        value = parse_datetime(value)
+    if value is not None and settings.USE_TZ and value.tzinfo is None:
+        value = value.replace(tzinfo=utc)
+    return value
+
+
+def bucket_expression(connection, model, seconds):
+    """
+        Builds an expression flooring the model's created timestamp to the
+        start of its epoch aligned bucket of the given width in seconds.
+    """
+    try:
+        template = BUCKET_SQL[connection.vendor]
+    except KeyError:
+        raise NotImplementedError(
+            'Time buckets are not supported on {}'.format(connection.vendor)
+        )
+    qn = connection.ops.quote_name
+    column = '{}.{}'.format(
+        qn(model._meta.db_table), qn(model._meta.get_field('created').column)
+    )
+    return RawSQL(
+        template.format(column=column), (seconds, seconds),
+        output_field=models.DateTimeField()
+    )
+
+
+def floor_bucket(value, seconds):
+    """
+        Floors a datetime to the start of its epoch aligned bucket. Naive
+        datetimes are assumed to be in UTC.
+    """
+    epoch = calendar.timegm(value.utctimetuple())
+    bucket = datetime.utcfromtimestamp(epoch - epoch % seconds)
+    if settings.USE_TZ:
+        bucket = bucket.replace(tzinfo=utc)
+    return bucket
+
+
+def iter_bucket_range(start, end, seconds):
+    """
+        Yields the starts of the buckets overlapping the range [start, end).
+    """
+    bucket = floor_bucket(start, seconds)
+    width = timedelta(seconds=seconds)
+    end = floor_bucket(end - timedelta(microseconds=1), seconds)
+    while bucket <= end:
+        yield bucket
+        bucket += width
+
+
+def fill_buckets(owners, resampled, field_name, annotations, seconds, start,
+                 end):
+    """
+        Gap filling for resample computed in Python from the SQL aggregated
+        rows. Used on backends without generate_series.
+    """
+    rows = dict(
+        ((row[field_name], row['bucket']), row) for row in resampled
+    )
+    buckets = list(iter_bucket_range(start, end, seconds))
+    output = []
+    for pk in owners.order_by('pk').values_list('pk', flat=True):
+        for bucket in buckets:
+            row = rows.get((pk, bucket))
+            if row is None:
+                row = dict.fromkeys(annotations)
+                row.update({field_name: pk, 'bucket': bucket})
+            output.append(row)
+    return output
+
+
+def fill_buckets_sql(owners, resampled, field_name, annotations, seconds,
+                     start, end):
+    """
+        Gap filling for resample computed in PostgreSQL by left joining the
+        aggregated rows onto a generate_series grid of owners and buckets.
+    """
+    connection = connections[owners.db]
+    qn = connection.ops.quote_name
+    owner_pk = qn(owners.model._meta.pk.column)
+    fk = qn(resampled.model._meta.get_field(field_name).column)
+    owners_sql, owners_params = owners.order_by().values('pk').query \
+        .get_compiler(owners.db).as_sql()
+    resampled_sql, resampled_params = resampled.order_by().query \
+        .get_compiler(owners.db).as_sql()
+    aliases = list(annotations)
+    buckets = list(iter_bucket_range(start, end, seconds))
+    sql = (
+        'SELECT ts_owner.{owner_pk}, ts_grid.bucket{columns} '
+        'FROM ({owners}) ts_owner '
+        'CROSS JOIN generate_series('
+        "%s::timestamptz, %s::timestamptz, %s * interval '1 second'"
+        ') AS ts_grid(bucket) '
+        'LEFT JOIN ({resampled}) ts_agg ON ts_agg.{fk} = ts_owner.{owner_pk} '
+        'AND ts_agg.bucket = ts_grid.bucket '
+        'ORDER BY ts_owner.{owner_pk}, ts_grid.bucket'
+    ).format(
+        owner_pk=owner_pk,
+        columns=''.join(', ts_agg.' + qn(alias) for alias in aliases),
+        owners=owners_sql,
+        resampled=resampled_sql,
+        fk=fk,
+    )
+    params = tuple(owners_params) + (buckets[0], buckets[-1], seconds) + \
+        tuple(resampled_params)
+    output = []
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for pk, bucket, values in (
+                (row[0], row[1], row[2:]) for row in cursor.fetchall()):
+            row = {field_name: pk, 'bucket': bucket}
+            for alias, value in zip(aliases, values):
+                if value is not None:
+                    field = annotations[alias].output_field
+                    value = field.to_python(value)
+                row[alias] = value
+            output.append(row)
+    return output
+
+
+def get_rollup(model):
+    """
+        Helper function that returns the (source related_name, aggregates)
+        pair declared by a rollup model, or None for other models.
+    """
+    source = getattr(model, 'TIMESERIES_ROLLUP_SOURCE', None)
+    if source is None:
+        return None
+    return source, model.TIMESERIES_ROLLUP_AGGREGATES
+
+
+def get_retention(model):
+    """
+        Helper method to facilitate the retrieval of TIMESERIES_RETENTION as
+        a timedelta, or None if the model keeps every row.
+    """
+    retention = getattr(model, 'TIMESERIES_RETENTION', None)
+    if retention is None:
+        return None
+    return parse_interval(retention)
+
+
+def get_downsample_relations(model):
+    """
+        Helper function that returns the (source reverse relation, rollup
+        reverse relation) pair for the model's TIMESERIES_DOWNSAMPLE rollup,
+        or None if it doesn't declare one.
+    """
+    downsample = getattr(model, 'TIMESERIES_DOWNSAMPLE', None)
+    if downsample is None:
+        return None
+    for field in model._meta.fields:
+        if not field.many_to_one:
+            continue
+        rollup_rel = get_reverse_relation(field.related_model, downsample)
+        if rollup_rel is None:
+            continue
+        rollup = get_rollup(rollup_rel.field.model)
+        source_rel = rollup and get_reverse_relation(
+            field.related_model, rollup[0]
+        )
+        if source_rel is not None and source_rel.field == field:
+            return source_rel, rollup_rel
+    raise ValueError(
+        'TIMESERIES_DOWNSAMPLE of {} must name a rollup of {}'.format(
+            model.__name__, model.__name__
+        )
+    )
+
+
+def newer_row_exists(model, field, row, source, qn):
+    """
+        Builds an EXISTS condition matching when the source table holds a
+        newer row than "row" for the same owner, as given by the ForeignKey
+        field. row and source are quoted table names or aliases.
+    """
+    opts = model._meta
+    return (
+        'EXISTS (SELECT 1 FROM {source} ts_newer '
+        'WHERE ts_newer.{fk} = {row}.{fk} '
+        'AND (ts_newer.{created} > {row}.{created} '
+        'OR (ts_newer.{created} = {row}.{created} '
+        'AND ts_newer.{pk} > {row}.{pk})))'
+    ).format(
+        source=source,
+        row=row,
+        fk=qn(field.column),
+        created=qn(opts.get_field('created').column),
+        pk=qn(opts.pk.column),
+    )
+
+
+def check_row_model(model):
+    """
+        Helper method raising a TypeError for TimeSeriesBlockModel
+        subclasses, whose values can't be queried per point in SQL.
+    """
+    if get_block_width(model) is not None:
+        raise TypeError('{} stores blocks of points, not a row per point'
+                        .format(model.__name__))
+
+
+def get_partition_width(model):
+    """
+        Helper method to facilitate the retrieval of TIMESERIES_PARTITION as a
+        timedelta, or None if the model's table isn't partitioned.
+    """
+    width = getattr(model, 'TIMESERIES_PARTITION', None)
+    if width is None:
+        return None
+    return parse_interval(width)
+
+
+def is_async_collector(collector):
+    """
+        Checks whether a collector is a coroutine function or an async
+        generator function.
+    """
+    checks = ('iscoroutinefunction', 'isasyncgenfunction')
+    return any(
+        getattr(inspect, check)(collector)
+        for check in checks if hasattr(inspect, check)
+    )
+
+
+def collect(collector, queryset, concurrency=None, related_name=None,
+            since=False):
+    """
+        Calls the collector with the queryset and returns its iterable of
+        dictionaries, measured as the "collect" phase of the relation. Async
+        collectors are run on an event loop and their results are yielded
+        synchronously. The queryset is annotated first if since is given,
+        see annotate_since.
+    """
+    if since:
+        queryset = annotate_since(queryset, related_name, since)
+    if is_async_collector(collector):
+        from timeseries.aio import iter_async_results
+        results = iter_async_results(collector, queryset, concurrency)
+    else:
+        results = collector(queryset)
+    return measure_iteration(
+        results, 'collect', queryset.model, related_name, queryset.db
+    )
+
+
+def annotate_since(queryset, related_name, since=True):
+    """
+        Helper function that annotates the owners of the queryset with their
+        {related_name}_last_updated timestamp (unless it is a denormalized
+        field) and, if since is an iterable of field names, the values of
+        their latest related instance as {related_name}_latest_{field_name}.
+    """
+    rev_rel = get_reverse_relation(queryset.model, related_name)
+    annotations = {}
+    if get_last_updated_field(queryset.model, related_name) is None:
+        annotations[related_name + '_last_updated'] = LastUpdated(rev_rel)
+    if since is not True:
+        if isinstance(since, six.string_types):
+            since = [since]
+        for name in since:
+            annotations['{}_latest_{}'.format(related_name, name)] = \
+                LatestValue(rev_rel, name)
+    # filter_outdated has already annotated the last updated timestamps
+    existing = queryset.query.annotations
+    return queryset.annotate(**dict(
+        (name, annotation) for name, annotation in annotations.items()
+        if name not in existing
+    ))
+
+
+def get_last_updated_field(model, related_name):
+    """
+        Helper function that returns the model's opt-in denormalized
+        {related_name}_last_updated DateTimeField, or None if it doesn't have
+        one.
+    """
+    try:
+        field = model._meta.get_field(related_name + '_last_updated')
+    except FieldDoesNotExist:
+        return None
+    if isinstance(field, models.DateTimeField):
+        return field
+    return None
+
+
+class OwnerCorrelated(Expression):
+    """
+        Base class of the correlated subquery expressions selecting from the
+        related table (as given by the reverse relation) for each row of the
+        owning model, without joining the related table into the outer
+        query.
+
+        N.B. the owning table's alias is tracked through relabeled_clone so
+        that the expression stays correlated when its query is nested as a
+        subquery.
+    """
+
+    def __init__(self, rev_rel, output_field, alias=None):
+        super(OwnerCorrelated, self).__init__(output_field=output_field)
+        self.rev_rel = rev_rel
+        self.alias = alias or rev_rel.model._meta.db_table
+
+    def relabeled_clone(self, change_map):
+        clone = self.copy()
+        clone.alias = change_map.get(self.alias, self.alias)
+        return clone
+
+    def format_sql(self, sql, compiler, connection, **kwargs):
+        qn = connection.ops.quote_name
+        opts = self.rev_rel.field.model._meta
+        return sql.format(
+            created=qn(opts.get_field('created').column),
+            table=qn(opts.db_table),
+            related_pk=qn(opts.pk.column),
+            fk=qn(self.rev_rel.field.column),
+            owner=compiler.quote_name_unless_alias(self.alias),
+            pk=qn(self.rev_rel.model._meta.pk.column),
+            **kwargs
+        )
+
+
+class LastUpdated(OwnerCorrelated):
+    """
+        Selects the created timestamp of the latest related instance of each
+        row of the owning model, e.g. in an UPDATE of the owning table.
+        Served by the (owner, -created) index.
+    """
+
+    def __init__(self, rev_rel, alias=None):
+        super(LastUpdated, self).__init__(
+            rev_rel, models.DateTimeField(), alias
+        )
+
+    def as_sql(self, compiler, connection):
+        sql = (
+            '(SELECT MAX(ts_last.{created}) FROM {table} ts_last '
+            'WHERE ts_last.{fk} = {owner}.{pk})'
+        )
+        return self.format_sql(sql, compiler, connection), []
+
+
+class LatestValue(OwnerCorrelated):
+    """
+        Selects the value of a field of the latest related instance of each
+        row of the owning model, ties on created being broken by the highest
+        primary key. Served by the (owner, -created) index.
+    """
+
+    def __init__(self, rev_rel, field_name, alias=None):
+        field = rev_rel.field.model._meta.get_field(field_name)
+        if not field.concrete:
+            raise TypeError(
+                '{} is not a concrete field'.format(field_name)
+            )
+        output_field = field.foreign_related_fields[0] \
+            if field.is_relation else field
+        super(LatestValue, self).__init__(rev_rel, output_field, alias)
+        self.latest_field = field
+
+    def as_sql(self, compiler, connection):
+        sql = (
+            '(SELECT ts_latest.{column} FROM {table} ts_latest '
+            'WHERE ts_latest.{fk} = {owner}.{pk} '
+            'ORDER BY ts_latest.{created} DESC, ts_latest.{related_pk} DESC '
+            'LIMIT 1)'
+        )
+        return self.format_sql(
+            sql, compiler, connection,
+            column=connection.ops.quote_name(self.latest_field.column)
+        ), []
+
+
+def sync_last_updated(rev_rel, instances):
+    """
+        Helper function that refreshes the denormalized last updated field
+        and the cached latest instance (if any) of the owners of the given
+        related instances.
+    """
+    from timeseries.cache import refresh_latest_cache
+
+    if not instances:
+        return
+    attname = rev_rel.field.attname
+    pks = set(getattr(instance, attname) for instance in instances)
+    refresh_owners_last_updated(rev_rel, pks)
+    refresh_latest_cache(rev_rel, pks)
+
+
+def refresh_owners_last_updated(rev_rel, pks):
+    """
+        Helper function that refreshes the denormalized last updated field
+        (if any) of the owners with the given primary keys, given as an
+        iterable or a values queryset.
+    """
+    owner_model = rev_rel.model
+    field = get_last_updated_field(owner_model, rev_rel.get_accessor_name())
+    if field is None:
+        return
+    using = router.db_for_write(owner_model)
+    owner_model._base_manager.using(using).filter(pk__in=pks).update(
+        **{field.name: LastUpdated(rev_rel)}
+    )
+
+
+def get_latest_cache(model):
+    """
+        Helper method returning the Django cache named by TIMESERIES_CACHE,
+        or None if the model's latest rows aren't cached.
+    """
+    alias = getattr(model, 'TIMESERIES_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def iter_timeseries_relations(model):
+    """
+        Yields the reverse relations of the given model whose related models
+        are TimeSeriesModel subclasses.
+    """
+    for rel in model._meta.related_objects:
+        if isinstance(rel, ManyToOneRel) and \
+                issubclass(rel.field.model, TimeSeriesModel):
+            yield rel
+
+
 def get_reverse_relation(model, related_name):
     """
         Helper function that returns a reverse relation instance for a
@@ -293,12 +2081,25 @@ def get_interval(model):
 
         model must be a Django model class.
     """
-    interval = model.TIMESERIES_INTERVAL
+    try:
+        return parse_interval(model.TIMESERIES_INTERVAL)
+    except ValueError:
+        raise ValueError(
+            'TIMESERIES_INTERVAL must either be in seconds or an instance of '
+            'datetime.timedelta'
+        )
+
+
+def parse_interval(interval):
+    """
+        Helper method that converts an interval given in seconds to a
+        datetime.timedelta instance.
+    """
     if isinstance(interval, timedelta):
         return interval
-    elif isinstance(interval, (int, float, basestring)):
+    elif isinstance(interval, (int, float) + six.string_types):
         return timedelta(seconds=int(interval))
     raise ValueError(
-        'TIMESERIES_INTERVAL must either be in seconds or an instance of '
+        'Intervals must either be in seconds or an instance of '
         'datetime.timedelta'
     )
@@ -0,0 +1,216 @@
+"""
+    Parallel update strategies of update_timeseries.
+
+    update_sharded splits the outdated owners into primary key ordered
+    shards updated on a thread or process pool, update_claimed lets any
+    number of concurrent workers claim batches of them with row locks.
+"""
+import zlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import django
+from django.apps import apps
+from django.db import connections, transaction
+
+from timeseries import utils
+from timeseries.writers import write_batches
+
+
+def update_sharded(queryset, related_name, collector, batch_size, workers,
+                   pool='thread', concurrency=None, backend=None, force=False,
+                   since=False):
+    """
+        Helper function that splits the outdated (or with force, all)
+        instances of the queryset into primary key ranges holding as many
+        instances each and runs the collector and bulk insert of each shard
+        on a thread or process pool of the given number of workers.
+
+        Only the bounds of each shard are looked up and handed to the
+        workers, which filter the queryset to their range and, unless
+        forced, re-evaluate which of its owners are outdated.
+
+        Returns an UpdateSummary aggregating the summaries of all shards.
+    """
+    if pool not in ('thread', 'process'):
+        raise ValueError('pool must either be "thread" or "process"')
+    if workers < 1:
+        raise ValueError('workers must be a positive integer')
+
+    candidates = queryset if force else queryset.filter_outdated(related_name)
+    pks = candidates.order_by('pk').values_list('pk', flat=True)
+    count = pks.count()
+    summary = utils.UpdateSummary()
+    if not count:
+        return summary
+
+    shard_size = (count + workers - 1) // workers
+    opts = queryset.model._meta
+    label = '{}.{}'.format(opts.app_label, opts.model_name)
+    # a query rather than a queryset, which would be evaluated when pickled
+    query = queryset.query
+    tasks = [
+        (label, queryset.db, query, related_name, pks[start],
+         pks[min(start + shard_size, count) - 1], force, collector,
+         batch_size, concurrency, backend, since)
+        for start in range(0, count, shard_size)
+    ]
+
+    if pool == 'thread':
+        executor = ThreadPool(min(workers, len(tasks)))
+    else:
+        executor = Pool(
+            min(workers, len(tasks)), initializer=init_shard_worker
+        )
+    try:
+        for shard_summary in executor.map(run_shard, tasks):
+            summary.add_shard(shard_summary)
+    finally:
+        executor.close()
+        executor.join()
+    return summary
+
+
+def init_shard_worker():
+    """
+        Process pool initializer. Forked workers inherit the parent's open
+        database connections which must not be shared, so they are dropped
+        (not closed) for each worker to open its own.
+    """
+    if not apps.ready:
+        django.setup()
+    for conn in connections.all():
+        conn.connection = None
+
+
+def run_shard(task):
+    """
+        Collects and writes a single shard as built by update_sharded.
+        Errors raised by the collector are recorded on the returned
+        UpdateSummary rather than propagated.
+    """
+    (label, using, query, related_name, lower, upper, force, collector,
+     batch_size, concurrency, backend, since) = task
+    model = apps.get_model(label)
+    rev_rel = utils.get_reverse_relation(model, related_name)
+    summary = utils.UpdateSummary()
+    try:
+        queryset = model._default_manager.using(using).all()
+        queryset.query = query
+        queryset = queryset.filter(pk__gte=lower, pk__lte=upper)
+        if not force:
+            queryset = queryset.filter_outdated(related_name)
+        results = utils.collect(
+            collector, queryset, concurrency, related_name, since
+        )
+        write_batches(rev_rel, results, batch_size, summary, backend)
+    except Exception as err:
+        summary.failures.append((None, err))
+    finally:
+        # each worker thread holds its own connections
+        connections.close_all()
+    return summary
+
+
+def update_claimed(queryset, related_name, collector, batch_size=None,
+                   concurrency=None, backend=None, force=False, since=False):
+    """
+        Helper function that repeatedly claims a batch of outdated owners of
+        the queryset (see claim_owners), then collects and writes them in the
+        claiming transaction until none are left.
+
+        Owners whose data was written by another worker between being
+        selected and being locked are skipped. The queryset is scanned once
+        in primary key order, so each owner is claimed at most once per call
+        and owners held by another worker are left to it. Errors raised by
+        the collector are recorded on the returned UpdateSummary rather than
+        propagated, the batch's writes being rolled back.
+    """
+    rev_rel = utils.get_reverse_relation(queryset.model, related_name)
+    size = batch_size or DEFAULT_CLAIM_SIZE
+    summary = utils.UpdateSummary()
+    after = None
+    while True:
+        with transaction.atomic(using=queryset.db):
+            claimed, scanned = claim_owners(
+                queryset, related_name, size, after=after, force=force
+            )
+            if not scanned:
+                return summary
+            after = scanned[-1]
+            if not claimed:
+                continue
+            owners = queryset.filter(pk__in=claimed)
+            if not force:
+                # re-evaluated in a new snapshot, the claim's snapshot may
+                # predate another worker's commit
+                owners = owners.filter_outdated(related_name)
+            try:
+                # a savepoint, so that a failed batch leaves the claiming
+                # transaction usable
+                with transaction.atomic(using=queryset.db):
+                    results = utils.collect(
+                        collector, owners, concurrency, related_name, since
+                    )
+                    write_batches(rev_rel, results, None, summary, backend)
+            except Exception as err:
+                summary.failures.append((None, err))
+
+
+DEFAULT_CLAIM_SIZE = 100
+
+
+def claim_owners(queryset, related_name, size, after=None, force=False):
+    """
+        Helper function that locks up to size outdated (or with force, any)
+        instances of the queryset with a primary key greater than after (if
+        given) that aren't locked by another transaction, in primary key
+        order. Must be called in a transaction, which holds the locks until
+        it ends.
+
+        Uses SELECT ... FOR UPDATE SKIP LOCKED where supported and otherwise
+        falls back to transaction level advisory locks on PostgreSQL, keyed
+        by the table and the (integer or bigint) primary key.
+
+        Returns the claimed primary keys and the primary keys scanned, which
+        includes the candidates that another transaction holds. The latter
+        are in ascending order, the last one being the next call's after.
+    """
+    connection = connections[queryset.db]
+    candidates = queryset if force else queryset.filter_outdated(related_name)
+    if after is not None:
+        candidates = candidates.filter(pk__gt=after)
+    candidates = candidates.order_by('pk')
+    manager = queryset.model._base_manager.using(queryset.db)
+
+    if getattr(connection.features, 'has_select_for_update_skip_locked',
+               False):
+        claimed = list(
+            manager.filter(pk__in=candidates.values('pk'))
+            .select_for_update(skip_locked=True)
+            .order_by('pk').values_list('pk', flat=True)[:size]
+        )
+        return claimed, claimed
+
+    if connection.vendor != 'postgresql':
+        raise NotImplementedError(
+            'Claiming requires SELECT ... FOR UPDATE SKIP LOCKED or '
+            'PostgreSQL advisory locks'
+        )
+    scanned = list(candidates.values_list('pk', flat=True)[:size])
+    if not scanned:
+        return [], []
+    key = zlib.crc32(queryset.model._meta.db_table.encode('utf-8')) \
+        & 0x7fffffff
+    # a single bigint key holds the table in its high and the primary key
+    # in its low 32 bits, so that bigint primary keys can't overflow it;
+    # keys shared by primary keys 2 ** 32 apart only make claims skip
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT ts_claim.pk FROM unnest(%s) AS ts_claim(pk) '
+            'WHERE pg_try_advisory_xact_lock('
+            '(%s::bigint << 32) | (ts_claim.pk::bigint & 4294967295))',
+            [scanned, key]
+        )
+        claimed = [row[0] for row in cursor.fetchall()]
+    return claimed, scanned
@@ -0,0 +1,566 @@
+"""
+    Write backends of update_timeseries.
+
+    A write backend takes (rev_rel, rows, using), writes the rows (an
+    iterable of dictionaries) into the table of the reverse relation's model
+    and returns the owner primary key of each row written. write_batches
+    streams a collector's rows through one of them, see get_write_backend.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
+import binascii
+
+from django.conf import settings
+from django.db import (
+    connections, models, router, transaction, DatabaseError, DataError
+)
+from django.utils import six
+
+from timeseries import blocks, utils
+from timeseries.cache import refresh_latest_cache
+from timeseries.instrumentation import measure
+
+try:
+    from psycopg2.extensions import Binary as PsycopgBinary
+    from psycopg2.extras import Json
+except ImportError:
+    PsycopgBinary = Json = ()
+
+
+def iter_batches(iterable, size):
+    """
+        Lazily splits an iterable into lists of at most size items. A size
+        of None yields a single list of every item.
+    """
+    if size is not None and size < 1:
+        raise ValueError('batch size must be a positive integer')
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_batches(rev_rel, results, batch_size, summary=None,
+                  backend=None):
+    """
+        Helper function that streams an iterable of dictionaries into the
+        table of the reverse relation's model, batch_size rows at a time,
+        using the given write backend (see get_write_backend).
+
+        Each batch is written atomically; a batch that raises a DatabaseError
+        is rolled back and recorded as a failure without aborting the
+        remaining batches. Returns the given (or a new) UpdateSummary.
+    """
+    if summary is None:
+        summary = utils.UpdateSummary()
+    model = rev_rel.field.model
+    using = router.db_for_write(model)
+    write = get_write_backend(connections[using], backend, model)
+    related_name = rev_rel.get_accessor_name()
+    for number, batch in enumerate(iter_batches(results, batch_size)):
+        with measure('write', model, related_name, using) as measured:
+            try:
+                with transaction.atomic(using=using):
+                    owners = write(rev_rel, batch, using)
+                    if owners:
+                        owners_set = set(owners)
+                        utils.refresh_owners_last_updated(rev_rel, owners_set)
+                        refresh_latest_cache(rev_rel, owners_set)
+            except DatabaseError as err:
+                measured.errors += 1
+                summary.failures.append((number, err))
+            else:
+                measured.rows = len(owners)
+                measured.owners = len(set(owners))
+                summary.rows += len(owners)
+                summary.batches += 1
+    return summary
+
+
+def write_bulk_create(rev_rel, rows, using):
+    """
+        Write backend saving the rows (an iterable of dictionaries) with
+        bulk_create. Returns the owner primary key of each row written.
+    """
+    model = rev_rel.field.model
+    with measure('instantiate', model, rev_rel.get_accessor_name(),
+                 using) as measured:
+        instances = [model(**data) for data in rows]
+        measured.rows = len(instances)
+    model.objects.using(using).bulk_create(instances)
+    attname = rev_rel.field.attname
+    return [getattr(instance, attname) for instance in instances]
+
+
+def write_copy(rev_rel, rows, using):
+    """
+        PostgreSQL write backend streaming the rows (an iterable of
+        dictionaries) into COPY ... FROM STDIN in text format without
+        instantiating models. Values are prepared with their fields'
+        get_db_prep_save, missing values get their fields' defaults and
+        auto_now(_add) fields such as created the current time, as with
+        bulk_create. Returns the owner primary key of each row written.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        raise NotImplementedError('COPY is only supported on PostgreSQL')
+    model = rev_rel.field.model
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = [
+        field for field in opts.concrete_fields
+        if not isinstance(field, models.AutoField)
+    ]
+    owners = []
+    lines = iter_copy_lines(
+        fields, rows, connection, rev_rel.field, owners.append
+    )
+    sql = 'COPY {} ({}) FROM STDIN'.format(
+        qn(opts.db_table), ', '.join(qn(field.column) for field in fields)
+    )
+    with connection.cursor() as cursor, connection.wrap_database_errors:
+        cursor.copy_expert(sql, CopyReader(lines))
+    return owners
+
+
+def iter_copy_lines(fields, rows, connection, owner_field, add_owner):
+    """
+        Helper function that yields the COPY text format lines of the rows,
+        calling add_owner with each row's owner primary key.
+    """
+    for values in iter_row_values(
+            fields, rows, connection, owner_field, add_owner):
+        yield '\t'.join(copy_text(value) for value in values) + '\n'
+
+
+def iter_row_values(fields, rows, connection, owner_field, add_owner,
+                    keep_created=False):
+    """
+        Helper function that yields the list of database values of the given
+        fields for each row (a dictionary), calling add_owner with each row's
+        owner primary key. Missing values get their fields' defaults,
+        auto_now(_add) fields such as created the current time and interval
+        buckets are computed from created, as when saving instances.
+
+        If keep_created is True auto_now_add fields keep the values given by
+        the rows, e.g. to backfill history.
+    """
+    now = utils.utcnow() if settings.USE_TZ else datetime.now()
+    names = set()
+    for field in fields:
+        names.update((field.name, field.attname))
+    for data in rows:
+        if not names.issuperset(data):
+            raise TypeError('Unexpected fields {} for {}'.format(
+                ', '.join(sorted(set(data) - names)),
+                owner_field.model.__name__
+            ))
+        values = []
+        created = None
+        for field in fields:
+            given = field.name in data or field.attname in data
+            if getattr(field, 'auto_now', False) or (
+                    getattr(field, 'auto_now_add', False) and
+                    not (keep_created and given)):
+                value = now
+            elif isinstance(field, utils.IntervalBucketField):
+                value = field.get_bucket(created)
+            elif field.name in data:
+                value = data[field.name]
+                if field.is_relation and isinstance(value, models.Model):
+                    value = getattr(
+                        value, field.foreign_related_fields[0].attname
+                    )
+            elif field.attname in data:
+                value = data[field.attname]
+            else:
+                value = field.get_default()
+            if field is owner_field:
+                add_owner(value)
+            if field.name == 'created':
+                created = value
+            values.append(field.get_db_prep_save(value, connection))
+        yield values
+
+
+COPY_ESCAPES = {
+    ord('\\'): u'\\\\',
+    ord('\t'): u'\\t',
+    ord('\n'): u'\\n',
+    ord('\r'): u'\\r',
+}
+
+
+def copy_text(value):
+    """
+        Formats a database value for the COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    return copy_literal(value).translate(COPY_ESCAPES)
+
+
+# bytes are text on Python 2, where BinaryField values are psycopg2 Binary
+BINARY_TYPES = (bytearray, memoryview, PsycopgBinary) + (
+    (bytes,) if six.PY3 else ()
+)
+
+
+def copy_literal(value):
+    """
+        Helper function that returns the PostgreSQL input text of a
+        database value, before COPY escaping: bytes as hex bytea, lists as
+        arrays, dictionaries as hstore and Json adapters as their JSON.
+        Raises TypeError for other psycopg2 adapters, which only have SQL
+        literals.
+    """
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if isinstance(value, float):
+        return six.text_type(repr(value))
+    if hasattr(value, 'isoformat'):
+        return six.text_type(value.isoformat())
+    if isinstance(value, Json):
+        return six.text_type(value.dumps(value.adapted))
+    if isinstance(value, BINARY_TYPES):
+        if isinstance(value, PsycopgBinary):
+            value = value.adapted
+        return u'\\x' + binascii.hexlify(bytes(bytearray(value))).decode(
+            'ascii'
+        )
+    if isinstance(value, (list, tuple)):
+        return u'{{{}}}'.format(u','.join(
+            copy_element(element) for element in value
+        ))
+    if isinstance(value, dict):
+        return u','.join(u'{}=>{}'.format(
+            copy_element(key), copy_element(element)
+        ) for key, element in value.items())
+    if hasattr(value, 'getquoted'):
+        raise TypeError(
+            'COPY cannot write {} values, use the bulk_create write '
+            'backend'.format(type(value).__name__)
+        )
+    return six.text_type(value)
+
+
+def copy_element(value):
+    """
+        Helper function that formats an array or hstore element: NULL,
+        nested arrays as is and anything else double quoted.
+    """
+    if value is None:
+        return u'NULL'
+    text = copy_literal(value)
+    if isinstance(value, (list, tuple)):
+        return text
+    return u'"{}"'.format(
+        text.replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+    )
+
+
+class CopyReader(object):
+    """
+        File-like object lazily reading an iterable of COPY lines, as UTF-8
+        bytes, for cursor.copy_expert.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunk = line.encode('utf-8')
+            chunks.append(chunk)
+            length += len(chunk)
+            if 0 <= size <= length:
+                break
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+INSERT_SQL = 'INSERT INTO {table} ({columns}) VALUES {rows}'
+
+
+UPSERT_SQL = {
+    'update': (
+        'INSERT INTO {table} ({columns}) VALUES {rows} '
+        'ON CONFLICT ({keys}) DO UPDATE SET {updates}'
+    ),
+    'ignore': (
+        'INSERT INTO {table} ({columns}) VALUES {rows} '
+        'ON CONFLICT ({keys}) DO NOTHING'
+    ),
+}
+
+
+# maximum number of rows per statement, bounding the number of parameters
+INSERT_CHUNK_SIZE = 1000
+
+
+MYSQL_UPSERT_SQL = {
+    'update': (
+        'INSERT INTO {table} ({columns}) VALUES {rows} '
+        'ON DUPLICATE KEY UPDATE {updates}'
+    ),
+    'ignore': 'INSERT IGNORE INTO {table} ({columns}) VALUES {rows}',
+}
+
+
+def write_upsert(rev_rel, rows, using):
+    """
+        Write backend inserting the rows (an iterable of dictionaries) with
+        INSERT ... ON CONFLICT on the unique (owner, interval_bucket)
+        constraint of models setting TIMESERIES_UPSERT, which either updates
+        the conflicting row ("update") or keeps it ("ignore"). Requires
+        PostgreSQL 9.5+, SQLite 3.24+ or MySQL. Rows of the same owner and
+        interval bucket within rows are merged, the last one winning.
+        Returns the owner primary key of each row written or merged.
+    """
+    model = rev_rel.field.model
+    mode = utils.get_upsert_mode(model)
+    if mode is None:
+        raise TypeError('{} has no TIMESERIES_UPSERT'.format(model.__name__))
+    return insert_rows(rev_rel, rows, using, mode)
+
+
+def insert_rows(rev_rel, rows, using, mode=None, keep_created=False,
+                key=utils.INTERVAL_BUCKET_FIELD):
+    """
+        Helper function inserting the rows (an iterable of dictionaries) with
+        multi-row INSERT statements, upserting them if mode is one of
+        UPSERT_MODES (see write_upsert) on the unique (owner, key)
+        constraint. If keep_created is True the created timestamps given by
+        the rows are written instead of the current time. Returns the owner
+        primary key of each row.
+    """
+    connection = connections[using]
+    template = INSERT_SQL
+    update = None
+    if mode is None:
+        pass
+    elif connection.vendor == 'mysql':
+        template = MYSQL_UPSERT_SQL[mode]
+        update = '{0} = VALUES({0})'
+    elif (connection.vendor == 'sqlite' and
+            connection.Database.sqlite_version_info >= (3, 24, 0)) or \
+            (connection.vendor == 'postgresql' and
+             connection.pg_version >= 90500):
+        template = UPSERT_SQL[mode]
+        update = '{0} = EXCLUDED.{0}'
+    else:
+        raise NotImplementedError(
+            'Upserts require PostgreSQL 9.5+, SQLite 3.24+ or MySQL'
+        )
+
+    opts = rev_rel.field.model._meta
+    qn = connection.ops.quote_name
+    fields = [
+        field for field in opts.concrete_fields
+        if not isinstance(field, models.AutoField)
+    ]
+    owners = []
+    values = iter_row_values(
+        fields, rows, connection, rev_rel.field, owners.append, keep_created
+    )
+    columns = [qn(field.column) for field in fields]
+    keys = []
+    if mode is not None:
+        owner_index = fields.index(rev_rel.field)
+        bucket_index = fields.index(opts.get_field(key))
+        keys = [columns[owner_index], columns[bucket_index]]
+        # a single statement can't insert and update the same row
+        latest = OrderedDict()
+        for row in values:
+            latest[row[owner_index], row[bucket_index]] = row
+        values = latest.values()
+    values = list(values)
+    if not values:
+        return owners
+
+    placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+    size = max(min(
+        connection.ops.bulk_batch_size(fields, values), INSERT_CHUNK_SIZE
+    ), 1)
+    with connection.cursor() as cursor:
+        for start in range(0, len(values), size):
+            chunk = values[start:start + size]
+            cursor.execute(template.format(
+                table=qn(opts.db_table),
+                columns=', '.join(columns),
+                rows=', '.join([placeholder] * len(chunk)),
+                keys=', '.join(keys),
+                updates=update and ', '.join(
+                    update.format(column) for column in columns
+                    if column not in keys
+                ),
+            ), [value for row in chunk for value in row])
+    return owners
+
+
+def write_blocks(rev_rel, rows, using):
+    """
+        Write backend of TimeSeriesBlockModel subclasses appending the rows
+        (dictionaries of a data point's owner, values and optional created
+        timestamp, now by default) to the block of their owner and created
+        timestamp. The blocks concerned are locked and read in a single
+        query, merged with the new points, re-encoded and written back with
+        a multi-row upsert on the unique (owner, start) constraint (see
+        insert_rows). Missing blocks are first inserted empty, so that they
+        are locked like existing ones. A point replaces any point of the
+        same owner and timestamp. Returns the owner primary key of each
+        point.
+    """
+    model = rev_rel.field.model
+    owner_field = rev_rel.field
+    width = utils.get_block_width(model)
+    if width is None:
+        raise TypeError(
+            '{} is not a TimeSeriesBlockModel'.format(model.__name__)
+        )
+    seconds = int(width.total_seconds())
+    fields = utils.get_block_fields(model)
+    names = set([owner_field.name, owner_field.attname, 'created'])
+    names.update(field.name for field in fields)
+    now = utils.utcnow() if settings.USE_TZ else datetime.now()
+    owners = []
+    # maps (owner, start) to the block's points, keyed by timestamp
+    points = OrderedDict()
+    for data in rows:
+        if not names.issuperset(data):
+            raise TypeError('Unexpected fields {} for {}'.format(
+                ', '.join(sorted(set(data) - names)), model.__name__
+            ))
+        owner = data.get(owner_field.name, data.get(owner_field.attname))
+        if isinstance(owner, models.Model):
+            owner = getattr(
+                owner, owner_field.foreign_related_fields[0].attname
+            )
+        created = data.get('created') or now
+        values = [data.get(field.name) for field in fields]
+        # invalid points fail their batch, as the database would reject them
+        invalid = [
+            field.name for field, value in zip(fields, values)
+            if not blocks.is_valid(value, field.kind)
+        ] + ([] if blocks.is_valid(created, 'datetime') else ['created'])
+        if invalid:
+            raise DataError('Invalid {} value of {} for {}'.format(
+                ', '.join(invalid), owner, model.__name__
+            ))
+        owners.append(owner)
+        points.setdefault((owner, utils.floor_bucket(created, seconds)), {})[
+            created
+        ] = values
+    if not points:
+        return owners
+
+    def lock_blocks(keys):
+        # in a consistent order, so that concurrent writers can't deadlock
+        return [
+            block for block in model._base_manager.using(using)
+            .select_for_update().filter(**{
+                owner_field.attname + '__in': set(key[0] for key in keys),
+                'start__in': set(key[1] for key in keys),
+            }).order_by(owner_field.attname, 'start')
+            if (getattr(block, owner_field.attname), block.start) in keys
+        ]
+
+    existing = lock_blocks(points)
+    missing = set(points).difference(
+        (getattr(block, owner_field.attname), block.start)
+        for block in existing
+    )
+    if missing:
+        # concurrent writers of a new block would both find none to lock
+        # and the last upsert would drop the other's points. The insert
+        # waits for a concurrent insert of the same block to commit and
+        # leaves it be, so that either block gets locked and merged.
+        empty = dict(
+            (field.name, blocks.encode([], field.kind)) for field in fields
+        )
+        empty.update(size=0, timestamps=blocks.encode([], 'datetime'))
+        insert_rows(rev_rel, [
+            dict(empty, created=start, start=start, **{
+                owner_field.attname: owner
+            })
+            for owner, start in sorted(missing)
+        ], using, 'ignore', keep_created=True, key='start')
+        existing.extend(lock_blocks(missing))
+    for block in existing:
+        block_points = points[
+            (getattr(block, owner_field.attname), block.start)
+        ]
+        decoded = block.decode()
+        for index, created in enumerate(decoded['created']):
+            block_points.setdefault(
+                created, [decoded[field.name][index] for field in fields]
+            )
+
+    updated = []
+    for (owner, start), block_points in points.items():
+        timestamps = sorted(block_points)
+        row = {
+            owner_field.attname: owner,
+            'start': start,
+            'created': timestamps[-1],
+            'size': len(timestamps),
+            'timestamps': blocks.encode(timestamps, 'datetime'),
+        }
+        for index, field in enumerate(fields):
+            row[field.name] = blocks.encode(
+                [block_points[created][index] for created in timestamps],
+                field.kind
+            )
+        updated.append(row)
+    insert_rows(
+        rev_rel, updated, using, 'update', keep_created=True, key='start'
+    )
+    return owners
+
+
+WRITE_BACKENDS = {
+    'block': write_blocks,
+    'bulk_create': write_bulk_create,
+    'copy': write_copy,
+    'upsert': write_upsert,
+}
+
+
+def get_write_backend(connection, backend=None, model=None):
+    """
+        Helper function that returns the write backend callable for the
+        given database connection. backend can be the name of one of
+        WRITE_BACKENDS, a callable taking (rev_rel, rows, using) and
+        returning the owner primary key of each row written, or None to
+        pick block for TimeSeriesBlockModel subclasses, upsert for models
+        setting TIMESERIES_UPSERT, COPY on PostgreSQL and bulk_create
+        elsewhere.
+    """
+    if callable(backend):
+        return backend
+    if backend is None and model is not None and \
+            utils.get_block_width(model) is not None:
+        backend = 'block'
+    elif backend is None and model is not None and \
+            utils.get_upsert_mode(model) is not None:
+        backend = 'upsert'
+    elif backend is None:
+        backend = 'copy' if connection.vendor == 'postgresql' \
+            else 'bulk_create'
+    try:
+        return WRITE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            'Unknown write backend "{}", choose one of {}'.format(
+                backend, ', '.join(sorted(WRITE_BACKENDS))
+            )
+        )